@@ -15,6 +15,7 @@
 
 from __future__ import absolute_import
 
+import errno
 import os
 import shutil
 from abc import ABCMeta, abstractmethod
@@ -22,7 +23,7 @@ from collections import namedtuple
 
 from bd2k.util.objects import abstractclassmethod
 
-from toil.common import Toil, cacheDirName
+from toil.common import Toil, cacheDirName, pickleDirName, trashDirName
 
 # A class containing the information required for worker cleanup on shutdown of the batch system.
 WorkerCleanupInfo = namedtuple('WorkerCleanupInfo', (
@@ -31,7 +32,11 @@ WorkerCleanupInfo = namedtuple('WorkerCleanupInfo', (
     # The value of config.workflowID (used to identify files specific to this workflow)
     'workflowID',
     # The value of the cleanWorkDir flag
-    'cleanWorkDir'))
+    'cleanWorkDir',
+    # The value of config.nodeCache (where files are kept for later workflows), or None
+    'nodeCache',
+    # The value of config.nodeCacheSize
+    'nodeCacheSize'))
 
 
 class AbstractBatchSystem(object):
@@ -205,7 +210,9 @@ class BatchSystemSupport(AbstractBatchSystem):
         """
         self.workerCleanupInfo = WorkerCleanupInfo(workDir=self.config.workDir,
                                                    workflowID=self.config.workflowID,
-                                                   cleanWorkDir=self.config.cleanWorkDir)
+                                                   cleanWorkDir=self.config.cleanWorkDir,
+                                                   nodeCache=self.config.nodeCache,
+                                                   nodeCacheSize=self.config.nodeCacheSize)
 
     def checkResourceRequest(self, memory, cores, disk):
         """
@@ -289,11 +296,25 @@ class BatchSystemSupport(AbstractBatchSystem):
         """
         assert isinstance(info, WorkerCleanupInfo)
         workflowDir = Toil.getWorkflowDir(info.workflowID, info.workDir)
-        workflowDirContents = os.listdir(workflowDir)
+        # Worker directories in the trash are being deleted already
+        workflowDirContents = [name for name in os.listdir(workflowDir)
+                               if name != trashDirName(info.workflowID)]
+        # Unless a worker failed, only the cache and the local copies of the objects shared by
+        # pickled jobs are left
         if (info.cleanWorkDir == 'always'
             or info.cleanWorkDir in ('onSuccess', 'onError')
-            and workflowDirContents in ([], [cacheDirName(info.workflowID)])):
-            shutil.rmtree(workflowDir)
+            and set(workflowDirContents) <= {cacheDirName(info.workflowID),
+                                             pickleDirName(info.workflowID)}):
+            def ignoreMissing(function, path, excInfo):
+                # A reaper may be deleting the contents of the trash concurrently
+                if not (isinstance(excInfo[1], OSError) and excInfo[1].errno == errno.ENOENT):
+                    raise excInfo[0], excInfo[1], excInfo[2]
+            if info.nodeCache is not None:
+                # Keep the files downloaded by this workflow for the workflows to come
+                from toil.job import Job
+                Job.CachedFileStore.moveToNodeCache(workflowDir, info.workflowID,
+                                                    info.nodeCache, info.nodeCacheSize)
+            shutil.rmtree(workflowDir, onerror=ignoreMissing)
 
 
 class NodeInfo(namedtuple("_NodeInfo", "cores memory workers")):
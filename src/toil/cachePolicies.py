@@ -0,0 +1,240 @@
+# Copyright (C) 2015 UCSC Computational Genomics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Policies deciding which files are evicted from the caches of the file stores on the worker nodes,
+see :class:`toil.job.Job.FileStore` and :class:`toil.job.Job.CachedFileStore`, and a simulator to
+compare them on recorded traces of file reads.
+"""
+
+from __future__ import absolute_import
+
+from abc import ABCMeta, abstractmethod
+from collections import namedtuple
+
+# The accesses to a cached file that are tracked by the caches
+AccessRecord = namedtuple('AccessRecord', (
+    # The size of the file in bytes
+    'size',
+    # The time of the last access to the file
+    'lastAccess',
+    # The number of accesses to the file since it was added to the cache
+    'accessCount',
+    # The priority of the file as determined by the eviction policy on its last access
+    'priority'))
+
+
+class EvictionPolicy(object):
+    """
+    A policy for choosing the files to evict from a cache. On every access to a cached file the
+    policy assigns it a priority, and the files with the lowest priorities are evicted first.
+    """
+    __metaclass__ = ABCMeta
+
+    # The name of the policy as given to the --cacheEvictionPolicy option
+    name = None
+
+    @abstractmethod
+    def priority(self, size, lastAccess, accessCount, inflation):
+        """
+        :param int size: the size of the file in bytes
+        :param float lastAccess: the time of the access
+        :param int accessCount: the number of accesses to the file including this one
+        :param float inflation: the inflation value of the cache, see :meth:`inflate`
+        :return: the priority of the file
+        :rtype: float
+        """
+        raise NotImplementedError()
+
+    def inflate(self, inflation, evictedPriority):
+        """
+        :param float inflation: the current inflation value of the cache
+        :param float evictedPriority: the priority of a file that was just evicted
+        :return: the inflation value of the cache after the eviction, which is passed to
+                 :meth:`priority` on subsequent accesses. Policies that age files this way
+                 should override this method.
+        :rtype: float
+        """
+        return inflation
+
+    def access(self, record, size, now, inflation):
+        """
+        Records an access to a file.
+
+        :param AccessRecord|None record: the record of the previous accesses to the file, or
+               None if the file was not cached
+        :param int size: the size of the file in bytes
+        :param float now: the time of the access
+        :param float inflation: the inflation value of the cache
+        :rtype: AccessRecord
+        """
+        accessCount = 1 if record is None else record.accessCount + 1
+        return AccessRecord(size=size, lastAccess=now, accessCount=accessCount,
+                            priority=self.priority(size, now, accessCount, inflation))
+
+    @staticmethod
+    def evictionOrder(records):
+        """
+        :param dict records: maps the keys of cached files to their AccessRecords
+        :return: the keys of the given files in the order they should be evicted in
+        :rtype: list
+        """
+        return sorted(records, key=lambda key: (records[key].priority, records[key].lastAccess))
+
+
+class LeastRecentlyUsed(EvictionPolicy):
+    """
+    Evicts the files that were accessed least recently first.
+    """
+    name = 'lru'
+
+    def priority(self, size, lastAccess, accessCount, inflation):
+        return lastAccess
+
+
+class LeastFrequentlyUsed(EvictionPolicy):
+    """
+    Evicts the files that were accessed least often first, and among those the least recently
+    accessed ones.
+    """
+    name = 'lfu'
+
+    def priority(self, size, lastAccess, accessCount, inflation):
+        return accessCount
+
+
+class GreedyDualSizeFrequency(EvictionPolicy):
+    """
+    The GreedyDual-Size-Frequency policy weighs the number of accesses to a file against the cost
+    of downloading it again per byte of cache space it occupies. Files that are not accessed age
+    as the inflation value of the cache grows with every eviction, so files that were popular a
+    long time ago are eventually evicted.
+
+    The cost of downloading a file is modelled as a fixed overhead per request plus its size, so
+    big files are not evicted in favour of small ones unless they are accessed less often.
+    """
+    name = 'gdsf'
+
+    def __init__(self, requestOverhead=1024 * 1024):
+        """
+        :param int requestOverhead: the cost of a download on top of its size, in bytes
+        """
+        self.requestOverhead = requestOverhead
+
+    def priority(self, size, lastAccess, accessCount, inflation):
+        cost = float(self.requestOverhead + size)
+        return inflation + accessCount * cost / max(size, 1)
+
+    def inflate(self, inflation, evictedPriority):
+        return max(inflation, evictedPriority)
+
+
+evictionPolicies = {policy.name: policy for policy in (LeastRecentlyUsed,
+                                                       LeastFrequentlyUsed,
+                                                       GreedyDualSizeFrequency)}
+
+
+def getEvictionPolicy(name):
+    """
+    :param str name: the name of a policy, see :attr:`EvictionPolicy.name`
+    :rtype: EvictionPolicy
+    """
+    try:
+        return evictionPolicies[name]()
+    except KeyError:
+        raise RuntimeError("Unknown cache eviction policy '%s'. Choose one of %s."
+                           % (name, ', '.join(sorted(evictionPolicies))))
+
+
+class CacheSimulator(object):
+    """
+    Replays a trace of file reads against a cache of the given capacity that uses the given
+    eviction policy, counting hits and misses. Like the caches of the file stores, a file is
+    added to the cache when it is read and the cache is over capacity, and files are evicted
+    until it is not.
+    """
+
+    def __init__(self, policy, capacity):
+        """
+        :param EvictionPolicy policy: the eviction policy
+        :param int capacity: the size of the cache in bytes
+        """
+        self.policy = policy
+        self.capacity = capacity
+        self.records = {}
+        self.cached = 0
+        self.inflation = 0.0
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.hitBytes = 0
+        self.missBytes = 0
+
+    def read(self, fileID, size):
+        """
+        Simulates a read of the given file.
+
+        :param str fileID: the ID of the file
+        :param int size: the size of the file in bytes
+        :return: True if the read was a cache hit and False otherwise
+        :rtype: bool
+        """
+        # The order of the reads in the trace is all the policies need to know about time
+        self.clock += 1
+        record = self.records.get(fileID)
+        if record is None:
+            self.misses += 1
+            self.missBytes += size
+            self.cached += size
+        else:
+            self.hits += 1
+            self.hitBytes += size
+        self.records[fileID] = self.policy.access(record, size, self.clock, self.inflation)
+        if self.cached > self.capacity:
+            for victim in self.policy.evictionOrder(self.records):
+                if self.cached <= self.capacity:
+                    break
+                if victim == fileID:
+                    continue  # The file is in use by the reader
+                evicted = self.records.pop(victim)
+                self.cached -= evicted.size
+                self.inflation = self.policy.inflate(self.inflation, evicted.priority)
+        return record is not None
+
+    def replay(self, trace):
+        """
+        :param trace: an iterable of (fileID, size) tuples, one for each read
+        :return: self
+        """
+        for fileID, size in trace:
+            self.read(fileID, size)
+        return self
+
+    @property
+    def hitRatio(self):
+        """
+        :return: the fraction of reads that were cache hits
+        :rtype: float
+        """
+        reads = self.hits + self.misses
+        return float(self.hits) / reads if reads else 0.0
+
+    @property
+    def byteHitRatio(self):
+        """
+        :return: the fraction of bytes read that were served from the cache
+        :rtype: float
+        """
+        bytesRead = self.hitBytes + self.missBytes
+        return float(self.hitBytes) / bytesRead if bytesRead else 0.0
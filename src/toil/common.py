@@ -25,6 +25,7 @@ from argparse import ArgumentParser
 
 from bd2k.util.humanize import bytes2human
 
+from toil.cachePolicies import evictionPolicies
 from toil.lib.bioio import addLoggingOptions, getLogLevelString, setLoggingFromOptions
 from toil.realtimeLogger import RealtimeLogger
 
@@ -46,6 +47,8 @@ class Config(object):
         self.logLevel = getLogLevelString()
         self.workDir = None
         self.stats = False
+        self.statsInterval = 1.0
+        self.statsDiskInterval = 60.0
 
         # Because the stats option needs the jobStore to persist past the end of the run,
         # the clean default value depends the specified stats option and is determined in setOptions
@@ -85,6 +88,11 @@ class Config(object):
         self.disableSharedCache = False
         self.readGlobalFileMutableByDefault = False
         self.defaultCache = self.defaultDisk
+        self.nodeCache = None
+        self.nodeCacheSize = 53687091200
+        self.sharedPicklesSize = 2147483648
+        self.cacheEvictionPolicy = 'lru'
+        self.cacheTrace = None
         self.defaultPreemptable = False
         self.maxCores = sys.maxint
         self.maxMemory = sys.maxint
@@ -101,6 +109,10 @@ class Config(object):
         self.cseKey = None
         self.servicePollingInterval = 60
         self.useAsync = True
+        self.uploadThreads = None
+        self.downloadThreads = None
+        self.uploadQueueSize = 16
+        self.uploadBufferSize = 1048576
 
 
         #Debug options
@@ -151,6 +163,9 @@ class Config(object):
         #TODO: LOG LEVEL STRING
         setOption("workDir")
         setOption("stats")
+        # A zero interval would make the resource monitor spin, sampling as fast as it can
+        setOption("statsInterval", float, fC(0.1))
+        setOption("statsDiskInterval", float, fC(0.1))
         setOption("cleanWorkDir")
         setOption("clean")
         if self.stats:
@@ -194,6 +209,11 @@ class Config(object):
         setOption("disableSharedCache")
         setOption("readGlobalFileMutableByDefault")
         setOption("defaultCache", h2b, iC(0))
+        setOption("nodeCache", os.path.abspath)
+        setOption("nodeCacheSize", h2b, iC(0))
+        setOption("sharedPicklesSize", h2b, iC(0))
+        setOption("cacheEvictionPolicy")
+        setOption("cacheTrace", os.path.abspath)
         setOption("maxCores", int, iC(1))
         setOption("maxMemory", h2b, iC(1))
         setOption("maxDisk", h2b, iC(1))
@@ -212,6 +232,10 @@ class Config(object):
         setOption("sseKey", checkFn=checkSse)
         setOption("cseKey", checkFn=checkSse)
         setOption("servicePollingInterval", float, fC(0.0))
+        setOption("uploadThreads", int, iC(1))
+        setOption("downloadThreads", int, iC(1))
+        setOption("uploadQueueSize", int, iC(0))
+        setOption("uploadBufferSize", h2b, iC(1))
 
         #Debug options
         setOption("badWorker", float, fC(0.0, 1.0))
@@ -242,6 +266,14 @@ def _addOptions(addGroupFn, config):
                      "all machines running jobs.")
     addOptionFn("--stats", dest="stats", action="store_true", default=None,
                       help="Records statistics about the toil workflow to be used by 'toil stats'.")
+    addOptionFn("--statsInterval", dest="statsInterval", default=None,
+                help="The number of seconds between samples of the memory used by a job when "
+                     "recording statistics, at least 0.1. default=%s" % config.statsInterval)
+    addOptionFn("--statsDiskInterval", dest="statsDiskInterval", default=None,
+                help="The maximum number of seconds between measurements of the disk space used "
+                     "by a job when recording statistics. Measuring it walks the job's temporary "
+                     "directory, so it is done less often the longer the job runs. Must be at "
+                     "least 0.1. default=%s" % config.statsDiskInterval)
     addOptionFn("--clean", dest="clean", choices=['always', 'onError','never', 'onSuccess'], default=None,
                       help=("Determines the deletion of the jobStore upon completion of the program. "
                             "Choices: 'always', 'onError','never', 'onSuccess'. The --stats option requires "
@@ -369,6 +401,41 @@ def _addOptions(addGroupFn, config):
                      'jobs. Only applicable to jobs that do not specify an explicit value for '
                      'this requirement. Standard suffixes like K, Ki, M, Mi, G or Gi are '
                      'supported. Default is %s' % bytes2human( config.defaultCache, symbols='iec' ))
+    addOptionFn('--nodeCache', dest='nodeCache', default=None,
+                help='Path to a directory on the worker nodes in which files downloaded by a '
+                     'workflow are kept after it finishes, keyed by the digests of their '
+                     'contents, so that later workflows on the same node can reuse them instead '
+                     'of downloading them again. The directory should be on the same file system '
+                     'as the directory given by --workDir. Only applicable with the shared cache '
+                     'and job stores that can report digests of their files. The files in this '
+                     'directory are not part of the disk requirements of jobs, so --nodeCacheSize '
+                     'must be subtracted from the disk space available to jobs on each node. '
+                     'Default is to not keep files between workflows.')
+    addOptionFn('--nodeCacheSize', dest='nodeCacheSize', default=None, metavar='INT',
+                help='The maximum amount of disk space used by the directory given by '
+                     '--nodeCache. The least recently used files are evicted first. Standard '
+                     'suffixes like K, Ki, M, Mi, G or Gi are supported. Default is %s' %
+                     bytes2human(config.nodeCacheSize, symbols='iec'))
+    addOptionFn('--sharedPicklesSize', dest='sharedPicklesSize', default=None, metavar='INT',
+                help='The maximum amount of disk space used on each worker node by the local '
+                     'copies of the large objects shared between pickled jobs. The least '
+                     'recently used copies are deleted first. This space is not part of the '
+                     'disk requirements of jobs. Standard suffixes like K, Ki, M, Mi, G or Gi are '
+                     'supported. Default is %s' % bytes2human(config.sharedPicklesSize,
+                                                              symbols='iec'))
+    addOptionFn('--cacheEvictionPolicy', dest='cacheEvictionPolicy', default=None,
+                choices=sorted(evictionPolicies),
+                help='The policy for choosing the files to evict from the caches on the worker '
+                     'nodes: lru evicts the least recently used files first, lfu the least '
+                     'frequently used ones, and gdsf weighs the number of uses of a file against '
+                     'its size (GreedyDual-Size-Frequency). Use "toil cachesim" to compare them '
+                     'on a trace of file reads. Default is %s' % config.cacheEvictionPolicy)
+    addOptionFn('--cacheTrace', dest='cacheTrace', default=None,
+                help='Path to a file on the worker nodes to which every lookup of a file in the '
+                     'cache, hit or miss, appends a line holding the ID and size of the file. '
+                     'The resulting trace can be replayed with "toil cachesim". Reads of byte '
+                     'ranges, and streams that bypass the cache, are not recorded. Default is to '
+                     'not record a trace.')
     addOptionFn('--maxCores', dest='maxCores', default=None, metavar='INT',
                 help='The maximum number of CPU cores to request from the batch system at any one '
                      'time. Standard suffixes like K, Ki, M, Mi, G or Gi are supported. Default '
@@ -426,6 +493,25 @@ def _addOptions(addGroupFn, config):
     addOptionFn("--servicePollingInterval", dest="servicePollingInterval", default=None,
                 help="Interval of time service jobs wait between polling for the existence"
                 " of the keep-alive flag (defailt=%s)" % config.servicePollingInterval)
+    addOptionFn("--uploadThreads", dest="uploadThreads", default=None, metavar='INT',
+                help="The maximum number of threads a job uses to upload the files it wrote to the "
+                     "job store in the background. Threads are started as files are written. "
+                     "Default is the number of concurrent requests the job store supports, but "
+                     "at least 2.")
+    addOptionFn("--downloadThreads", dest="downloadThreads", default=None, metavar='INT',
+                help="The maximum number of threads a job uses to download the files passed to "
+                     "prefetchGlobalFiles or readGlobalFiles. Default is the number of concurrent "
+                     "requests the job store supports, but at least 2.")
+    addOptionFn("--uploadQueueSize", dest="uploadQueueSize", default=None, metavar='INT',
+                help="The maximum number of files waiting to be uploaded by the upload threads of "
+                     "a job. Writing another file blocks the job until an upload completes, which "
+                     "keeps jobs that write many files from holding all of them open. 0 means no "
+                     "limit. Default is %s" % config.uploadQueueSize)
+    addOptionFn("--uploadBufferSize", dest="uploadBufferSize", default=None, metavar='INT',
+                help="The size of the buffer used to stream files to the job store when they "
+                     "can't be uploaded from their path. Standard suffixes like K, Ki, M, Mi, G "
+                     "or Gi are supported. Default is %s" %
+                     bytes2human(config.uploadBufferSize, symbols='iec'))
     #
     #Debug options
     #
@@ -533,7 +619,7 @@ class Toil(object):
             rootJobReturnValueID = self._jobStore.getEmptyFileStoreID()
 
             # Add the root job return value as a promise
-            rootJob._rvs[None].append(rootJobReturnValueID)
+            rootJob._addPromise(rootJobReturnValueID, None)
 
             # Write the name of the promise file in a shared file
             with self._jobStore.writeSharedFileStream("rootJobReturnValue") as fH:
@@ -842,3 +928,17 @@ def cacheDirName(workflowID):
     :return: Name of the cache directory.
     """
     return 'cache-' + workflowID
+
+
+def trashDirName(workflowID):
+    """
+    :return: Name of the directory that worker directories are moved to before being deleted.
+    """
+    return 'trash-' + workflowID
+
+
+def pickleDirName(workflowID):
+    """
+    :return: Name of the directory holding the local copies of the objects shared by pickled jobs.
+    """
+    return 'pickles-' + workflowID
@@ -19,6 +19,7 @@ from toil.job import Job
 from toil.common import Toil
 from toil.version import version
 from toil.lib.bioio import setLoggingFromOptions
+from toil.lib.fileCopy import copyFile
 
 from argparse import ArgumentParser
 import cwltool.main
@@ -35,7 +36,6 @@ import json
 import sys
 import logging
 import copy
-import shutil
 import functools
 import urlparse
 
@@ -142,7 +142,7 @@ def getFile(fileStore, dir, fileTuple, index=None, export=False, primary=None, r
         srcPath = fileStore.readGlobalFile(fileStoreID)
         if srcPath != dstPath:
             if copy:
-                shutil.copyfile(srcPath, dstPath)
+                copyFile(srcPath, dstPath)
             else:
                 if os.path.exists(dstPath):
                     if index.get(dstPath, None) != fileStoreID:
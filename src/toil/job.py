@@ -21,34 +21,40 @@ import copy_reg
 import errno
 import importlib
 import inspect
+import itertools
 import logging
+import mmap
 import os
 import shutil
+import sqlite3
 import stat
 import subprocess
 import sys
 import tempfile
 import time
 import uuid
+import zlib
 
 from abc import ABCMeta, abstractmethod
 from argparse import ArgumentParser
 from contextlib import contextmanager
-from fcntl import flock, LOCK_EX, LOCK_UN
-from functools import partial
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_SH, LOCK_UN
 from hashlib import sha1
 from io import BytesIO
-from Queue import Queue, Empty
-from threading import Thread, Semaphore, Event
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
+from threading import Thread, Semaphore, Event, local
 
 from bd2k.util.expando import Expando
-from bd2k.util.humanize import human2bytes
-from toil.common import Toil, addOptions, cacheDirName
+from bd2k.util.humanize import bytes2human, human2bytes
+from toil.cachePolicies import AccessRecord, getEvictionPolicy
+from toil.common import Toil, addOptions, cacheDirName, pickleDirName, trashDirName
 from toil.leader import mainLoop
 from toil.lib.bioio import (setLoggingFromOptions,
-                            getTotalCpuTimeAndMemoryUsage,
-                            getTotalCpuTime,
-                            makePublicDir)
+                            makePublicDir,
+                            getDirSize,
+                            ResourceMonitor)
+from toil.lib.fileCopy import copyFile, copyFileObj
 from toil.realtimeLogger import RealtimeLogger
 from toil.resource import ModuleDescriptor
 
@@ -59,6 +65,17 @@ class Job(object):
     """
     Class represents a unit of work in toil.
     """
+    # Large static job graphs are made of millions of jobs, so the attributes of this class are
+    # stored in slots rather than a dictionary. Attributes added by subclasses or at runtime are
+    # stored in the instance dictionary, which is only allocated when first needed.
+    __slots__ = ('cores', 'memory', 'disk', 'cache', 'checkpoint', 'preemptable', '_children',
+                 '_followOns', '_services', '_directPredecessors', 'userModule',
+                 '_promiseFiles', '_promiseJobStore', '_childIterables', '_component', '__dict__')
+
+    # The number of children produced by the iterables passed to Job.addChildrenFrom that are
+    # serialised at a time
+    childBatchSize = 1000
+
     def __init__(self, memory=None, cores=None, disk=None, preemptable=None, cache=None, checkpoint=False):
         """
         This method must be called by any overriding constructor.
@@ -90,24 +107,60 @@ class Job(object):
         self.preemptable = preemptable
         #Private class variables
 
+        #The containers of successors and predecessors below are the shared, immutable empty
+        #tuple until something is added to them, since most jobs in large graphs are leaves
+        #with a single predecessor.
+
         #See Job.addChild
-        self._children = []
+        self._children = ()
         #See Job.addFollowOn
-        self._followOns = []
+        self._followOns = ()
         #See Job.addService
-        self._services = []
+        self._services = ()
         #A follow-on, service or child of a job A, is a "direct successor" of A, if B
-        #is a direct successor of A, then A is a "direct predecessor" of B.
-        self._directPredecessors = set()
+        #is a direct successor of A, then A is a "direct predecessor" of B. A tuple while there
+        #are few direct predecessors, a set otherwise, see Job._addPredecessor.
+        self._directPredecessors = ()
         # Note that self.__module__ is not necessarily this module, i.e. job.py. It is the module
         # defining the class self is an instance of, which may be a subclass of Job that may be
         # defined in a different module.
         self.userModule = ModuleDescriptor.forModule(self.__module__)
-        # Maps indices into composite return values to lists of IDs of files containing promised
-        # values for those return value items. The special key None represents the entire return
-        # value.
-        self._rvs = collections.defaultdict(list)
+        # Maps the IDs of files that will contain promised values to lists of the indices into
+        # composite return values whose items are promised in those files. The special index None
+        # represents the entire return value. None until a promise is made, see _addPromise().
+        self._promiseFiles = None
         self._promiseJobStore = None
+        #See Job.addChildrenFrom
+        self._childIterables = ()
+        #The state of the incremental validation of the job graph, see Job._getComponent. None
+        #while the job isn't connected to any other job.
+        self._component = None
+
+    def __getstate__(self):
+        # Pickle protocols 0 and 1 can't pickle the slots on their own. The component is left out
+        # since it only describes the job graph this job is part of in the current process.
+        state = {name: getattr(self, name) for name in Job.__slots__
+                 if name not in ('__dict__', '_component') and hasattr(self, name)}
+        state.update(self.__dict__)
+        return state
+
+    def __setstate__(self, state):
+        # Jobs pickled before the attributes of this class were moved into slots have a plain
+        # dictionary as their state, others have a tuple of the instance dictionary and the slots
+        if isinstance(state, tuple):
+            instanceState, slotState = state
+            state = dict(instanceState or {}, **(slotState or {}))
+        self._component = None
+        for name, value in state.iteritems():
+            if name == '_rvs':
+                # Jobs pickled before all promises of a job to another were bundled in one file
+                # map indices into the return value to the files promised the item at each index.
+                # Their consumers expect each of those files to hold the bare item.
+                self._legacyPromiseFiles = value
+            else:
+                setattr(self, name, value)
+        if '_rvs' in state:
+            self._promiseFiles = None
 
 
     def run(self, fileStore):
@@ -131,10 +184,34 @@ class Job(object):
         :return: childJob
         :rtype: toil.job.Job
         """
+        if not self._children:
+            self._children = []
         self._children.append(childJob)
         childJob._addPredecessor(self)
         return childJob
 
+    def addChildrenFrom(self, childJobs):
+        """
+        Adds the jobs produced by the given iterable as children of this job. If this job is
+        running, the iterable is only consumed after its :func:`toil.job.Job.run` method has
+        completed and the children are serialised in batches of :attr:`childBatchSize` jobs, such
+        that the child jobs don't all have to be held in memory at the same time. Otherwise the
+        iterable is consumed when this job is serialised and the children are added with
+        :func:`toil.job.Job.addChild`.
+
+        Only the memory taken by the :class:`toil.job.Job` objects is bounded. This job's wrapper
+        still references every child, so its size, and that of the worker while serialising it,
+        grows with the number of children.
+
+        The child jobs must not have any predecessors or be connected to any other job than their
+        own successors. In particular, no other job may reference their return values.
+
+        :param childJobs: an iterable of jobs, typically a generator
+        """
+        if not self._childIterables:
+            self._childIterables = []
+        self._childIterables.append(childJobs)
+
     def hasChild(self, childJob):
         """
         Check if childJob is already a child of this job.
@@ -154,6 +231,8 @@ class Job(object):
         :return: followOnJob
         :rtype: toil.job.Job
         """
+        if not self._followOns:
+            self._followOns = []
         self._followOns.append(followOnJob)
         followOnJob._addPredecessor(self)
         return followOnJob
@@ -194,7 +273,10 @@ class Job(object):
                 raise JobException("The service already has a parent service")
             service._hasParent = True
             jobService = ServiceJob(service)
+            if not self._services:
+                self._services = []
             self._services.append(jobService)
+            self._checkNewCheckpoint()
             return jobService.rv()
 
     ##Convenience functions for creating jobs
@@ -236,6 +318,20 @@ class Job(object):
         """
         return self.addChild(JobFunctionWrappingJob(fn, *args, **kwargs))
 
+    def addChildArray(self, fn, items, *args, **kwargs):
+        """
+        Adds a child job that calls a function once for each of the given items, each call being
+        run as a separate job. See :class:`toil.job.JobArray`.
+
+        :param fn: Function to be run with each item, followed by ``*args``, as positional \
+        arguments and ``**kwargs`` as keyword arguments. See toil.job.JobArray for reserved \
+        keyword arguments used to specify resource requirements.
+        :param items: an iterable of the items to call the function with
+        :return: The new child job that wraps fn.
+        :rtype: toil.job.JobArray
+        """
+        return self.addChild(JobArray(fn, items, *args, **kwargs))
+
     def addFollowOnJobFn(self, fn, *args, **kwargs):
         """
         Add a follow-on job function. See :class:`toil.job.JobFunctionWrappingJob`
@@ -313,10 +409,27 @@ class Job(object):
         if self._promiseJobStore is None:
             raise RuntimeError('Trying to pass a promise from a promising job that is not a '
                                'predecessor of the job receiving the promise')
-        jobStoreFileID = self._promiseJobStore.getEmptyFileStoreID()
-        self._rvs[index].append(jobStoreFileID)
+        # All promises of this job that are pickled along with the same job share one file
+        files = Promise._filesBeingPickled
+        jobStoreFileID = None if files is None else files.get(self)
+        if jobStoreFileID is None:
+            jobStoreFileID = self._promiseJobStore.getEmptyFileStoreID()
+            if files is not None:
+                files[self] = jobStoreFileID
+        self._addPromise(jobStoreFileID, index)
         return self._promiseJobStore.config.jobStore, jobStoreFileID
 
+    def _addPromise(self, jobStoreFileID, index):
+        """
+        Records that the return value of this job, or the item of it at the given index, is to
+        be written to the file with the given ID.
+        """
+        if self._promiseFiles is None:
+            self._promiseFiles = collections.defaultdict(list)
+        indices = self._promiseFiles[jobStoreFileID]
+        if index not in indices:
+            indices.append(index)
+
     ####################################################
     #Cycle/connectivity checking
     ####################################################
@@ -330,11 +443,48 @@ class Job(object):
         See :func:`toil.job.Job.checkJobGraphConnected`, \
         :func:`toil.job.Job.checkJobGraphAcyclic` and \
         :func:`toil.job.Job.checkNewCheckpointsAreLeafVertices` for more info.
+
+        The checks are maintained incrementally as jobs are added to the graph, such that
+        checking a graph that only grew by attaching new jobs to it takes constant time, see
+        :class:`toil.job.JobGraphComponent`.
         """
         self.checkJobGraphConnected()
         self.checkJobGraphAcylic()
         self.checkNewCheckpointsAreLeafVertices()
 
+    def _checkJobGraph(self):
+        """
+        Performs the checks of :func:`toil.job.Job.checkJobGraphForDeadlocks` with a single
+        traversal of the job graph, in ``O(|V| + |E|)`` time.
+
+        :raises toil.job.JobGraphDeadlockException: if the job graph is invalid
+        :return: the jobs in the connected component of jobs that contains this job, ordered \
+        such that each job comes after all of its predecessors
+        :rtype: list
+        """
+        self.checkJobGraphConnected()
+        self.checkNewCheckpointsAreLeafVertices()
+        # The ordering is needed anyway and detects any cycle as a side effect
+        ordering = self._getAugmentedOrdering(self._getConnectedJobs())
+        self._getComponent().verified = True
+        return ordering
+
+    def _getConnectedJobs(self):
+        """
+        :return: the jobs in the connected component of jobs that contains this job, \
+        following both predecessor and successor edges
+        :rtype: list
+        """
+        # The list is extended while it is traversed
+        jobs = [self]
+        visited = {self}
+        for job in jobs:
+            for other in itertools.chain(job._directPredecessors, job._children, job._followOns):
+                if other not in visited:
+                    visited.add(other)
+                    jobs.append(other)
+        return jobs
+
     def getRootJobs(self):
         """
         :return: The roots of the connected component of jobs that contains this job. \
@@ -342,21 +492,7 @@ class Job(object):
 
         :rtype : set of toil.job.Job instances
         """
-        roots = set()
-        visited = set()
-        #Function to get the roots of a job
-        def getRoots(job):
-            if job not in visited:
-                visited.add(job)
-                if len(job._directPredecessors) > 0:
-                    map(lambda p : getRoots(p), job._directPredecessors)
-                else:
-                    roots.add(job)
-                #The following call ensures we explore all successor edges.
-                map(lambda c : getRoots(c), job._children +
-                    job._followOns)
-        getRoots(self)
-        return roots
+        return {job for job in self._getConnectedJobs() if not job._directPredecessors}
 
     def checkJobGraphConnected(self):
         """
@@ -366,10 +502,23 @@ class Job(object):
         As execution always starts from one root job, having multiple root jobs will \
         cause a deadlock to occur.
         """
-        rootJobs = self.getRootJobs()
+        if self._getComponent().roots != 1:
+            # Only traverse the graph to report the offending roots
+            self._checkRootJobs(self._getConnectedJobs())
+
+    @staticmethod
+    def _checkRootJobs(jobs):
+        """
+        :raises toil.job.JobGraphDeadlockException: if the given connected component of jobs \
+        does not contain exactly one root job
+        :return: the root jobs
+        :rtype: set
+        """
+        rootJobs = {job for job in jobs if not job._directPredecessors}
         if len(rootJobs) != 1:
             raise JobGraphDeadlockException("Graph does not contain exactly one"
                                             " root job: %s" % rootJobs)
+        return rootJobs
 
     def checkJobGraphAcylic(self):
         """
@@ -384,21 +533,18 @@ class Job(object):
         an edge an "implied" edge. The augmented job graph is a job graph including \
         all the implied edges.
 
-        For a job graph G = (V, E) the algorithm is ``O(|V|^2)``. It is ``O(|V| + |E|)`` for \
-        a graph with no follow-ons. The former follow-on case could be improved!
+        For a job graph G = (V, E) the algorithm is ``O(|V| + |E|)``, see \
+        :func:`toil.job.Job._getAugmentedOrdering`. The graph is only traversed if an edge \
+        was added between two jobs that were already connected since the last check, see \
+        :class:`toil.job.JobGraphComponent`.
         """
-        #Get the root jobs
-        roots = self.getRootJobs()
-        if len(roots) == 0:
-            raise JobGraphDeadlockException("Graph contains no root jobs due to cycles")
-
-        #Get implied edges
-        extraEdges = self._getImpliedEdges(roots)
-
-        #Check for directed cycles in the augmented graph
-        visited = set()
-        for root in roots:
-            root._checkJobGraphAcylicDFS([], visited, extraEdges)
+        component = self._getComponent()
+        if not component.verified:
+            jobs = self._getConnectedJobs()
+            if not any(not job._directPredecessors for job in jobs):
+                raise JobGraphDeadlockException("Graph contains no root jobs due to cycles")
+            self._getAugmentedOrdering(jobs)
+            component.verified = True
 
     def checkNewCheckpointsAreLeafVertices(self):
         """
@@ -414,18 +560,107 @@ class Job(object):
         :raises toil.job.JobGraphDeadlockException: if there exists a job being added to the graph for which \
         checkpoint=True and which is not a leaf.
         """
-        roots = self.getRootJobs() # Roots jobs of component, these are preexisting jobs in the graph
+        invalidCheckpoints = self._getComponent().invalidCheckpoints
+        if invalidCheckpoints:
+            raise JobGraphDeadlockException("New checkpoint job %s is not a leaf in the job graph"
+                                            % invalidCheckpoints[0])
 
-        # All jobs in the component of the job graph containing self
-        jobs = set()
-        map(lambda x : x._dfs(jobs), roots)
+    @staticmethod
+    def _checkNewCheckpointsAreLeafVertices(jobs, roots):
+        """
+        See :func:`toil.job.Job.checkNewCheckpointsAreLeafVertices`. Unlike the latter, this
+        function traverses the given jobs.
 
+        :param list jobs: a connected component of the job graph
+        :param set roots: the root jobs of that component
+        """
         # Check for each job for which checkpoint is true that it is a cut vertex or leaf
         for y in filter(lambda x : x.checkpoint, jobs):
             if y not in roots: # The roots are the prexisting jobs
-                if len(y._children) != 0 and len(y._followOns) != 0 and len(y._services) != 0:
+                if y._isInvalidNewCheckpoint():
                     raise JobGraphDeadlockException("New checkpoint job %s is not a leaf in the job graph" % y)
 
+    def _isInvalidNewCheckpoint(self):
+        """
+        :return: True if this job is a checkpoint job with predecessors that isn't a leaf, see \
+        :func:`toil.job.Job.checkNewCheckpointsAreLeafVertices`
+        :rtype: bool
+        """
+        return bool(self.checkpoint and len(self._directPredecessors) != 0 and
+                    len(self._children) != 0 and len(self._followOns) != 0 and
+                    len(self._services) != 0)
+
+    def _checkNewCheckpoint(self):
+        """
+        Records this job with its component if it became an invalid checkpoint job, see \
+        :func:`toil.job.Job._isInvalidNewCheckpoint`.
+        """
+        if self.checkpoint and self._component is not None and self._isInvalidNewCheckpoint():
+            component = self._getComponent()
+            if component.invalidCheckpoints is None:
+                component.invalidCheckpoints = []
+            if self not in component.invalidCheckpoints:
+                component.invalidCheckpoints.append(self)
+
+    def _getComponent(self):
+        """
+        Returns the representative of the connected component of the job graph that contains
+        this job, creating it if this job isn't connected to any other job. Components are kept
+        in a disjoint-set forest with path compression and union by size, see
+        :func:`toil.job.Job._joinComponents`.
+
+        :rtype: JobGraphComponent
+        """
+        component = self._component
+        if component is None:
+            component = self._component = JobGraphComponent()
+        root = component
+        while root.parent is not None:
+            root = root.parent
+        while component.parent is not None:
+            component.parent, component = root, component.parent
+        self._component = root
+        return root
+
+    def _joinComponents(self, predecessorJob):
+        """
+        Updates the state of the incremental validation of the job graph after the given job
+        became a direct predecessor of this job. This takes amortised constant time.
+
+        An edge into a job that wasn't connected to the predecessor's component before merges
+        two acyclic graphs and can't create a cycle in the augmented job graph: any new implied
+        edge leaving the successor's side leads to a follow-on that the predecessor already
+        precedes. Only an edge between two jobs of the same component requires the component
+        to be traversed again by the next :func:`toil.job.Job.checkJobGraphAcylic`.
+        """
+        component = predecessorJob._getComponent()
+        if self._component is None:
+            # A job that isn't connected to any other job is the single root of its component,
+            # which it just stopped being.
+            self._component = component
+            component.size += 1
+        else:
+            other = self._getComponent()
+            if other is component:
+                component.verified = False
+            else:
+                if component.size < other.size:
+                    component, other = other, component
+                other.parent = component
+                component.size += other.size
+                component.roots += other.roots
+                component.verified = component.verified and other.verified
+                if other.invalidCheckpoints:
+                    if component.invalidCheckpoints is None:
+                        component.invalidCheckpoints = []
+                    component.invalidCheckpoints.extend(other.invalidCheckpoints)
+                other.invalidCheckpoints = None
+            if len(self._directPredecessors) == 1:
+                # This job was a root job
+                component.roots -= 1
+        self._checkNewCheckpoint()
+        predecessorJob._checkNewCheckpoint()
+
     ####################################################
     #The following nested classes are used for
     #creating jobtrees (Job.Runner),
@@ -503,6 +738,10 @@ class Job(object):
         # For files in jobStore that are on the local disk,
         # map of jobStoreFileIDs to locations in localTempDir.
         _jobStoreFileIDToCacheLocation = {}
+        # Map of jobStoreFileIDs of cached files to the AccessRecords of the eviction policy
+        _cacheAccesses = {}
+        # The inflation value of the eviction policy, see toil.cachePolicies
+        _cacheInflation = 0.0
         _terminateEvent = Event() #Used to signify crashes in threads
 
         def __init__(self, jobStore, jobWrapper, localTempDir, inputBlockFn):
@@ -524,51 +763,36 @@ class Job(object):
             self.loggingMessages = []
             self.filesToDelete = set()
             self.jobsToDelete = set()
-            #Asynchronous writes stuff
-            self.workerNumber = 2
-            self.queue = Queue()
+            #Asynchronous writes stuff. The worker threads uploading the files are started on
+            #demand, and writeGlobalFile blocks while the queue is full.
+            config = self.jobStore.config
+            self.workerNumber = config.uploadThreads or max(2, self.jobStore.maxConcurrentRequests)
+            self.queue = Queue(config.uploadQueueSize)
+            self.bufferSize = config.uploadBufferSize
+            self.workers = []
+            self._uploadLock = Semaphore()
+            # The number of files uploaded by the worker threads, their total size in bytes, the
+            # time the threads spent uploading them and the time writeGlobalFile spent waiting
+            # for room in the queue, in seconds
+            self.uploadMetrics = Expando(files=0, bytes=0, time=0.0, wait=0.0)
+            # The reads served from the cache and the job store, the waits for other jobs
+            # downloading the same files, the files evicted from the cache, and the time the cache
+            # lock was held, in seconds. Reported in the stats of the job, see toil.utils.toilStats.
+            self.cacheMetrics = Expando(hits=0, misses=0, nodeCacheHits=0, harbingerWaits=0,
+                                        harbingerWaitTime=0.0, bytesDownloaded=0,
+                                        bytesFromCache=0, evictions=0, bytesEvicted=0,
+                                        lockTime=0.0)
+            self._cacheMetricsLock = Semaphore()
             self.updateSemaphore = Semaphore()
             self.mutable = self.jobStore.config.readGlobalFileMutableByDefault
-            #Function to write files asynchronously to job store
-            def asyncWrite():
-                try:
-                    while True:
-                        try:
-                            #Block for up to two seconds waiting for a file
-                            args = self.queue.get(timeout=2)
-                        except Empty:
-                            #Check if termination event is signaled
-                            #(set in the event of an exception in the worker)
-                            if self._terminateEvent.isSet():
-                                raise RuntimeError("The termination flag is set, exiting")
-                            continue
-                        #Normal termination condition is getting None from queue
-                        if args is None:
-                            break
-                        inputFileHandle, jobStoreFileID = args
-                        #We pass in a fileHandle, rather than the file-name, in case
-                        #the file itself is deleted. The fileHandle itself should persist
-                        #while we maintain the open file handle
-                        with jobStore.updateFileStream(jobStoreFileID) as outputFileHandle:
-                            bufferSize=1000000 #TODO: This buffer number probably needs to be modified/tuned
-                            while 1:
-                                copyBuffer = inputFileHandle.read(bufferSize)
-                                if not copyBuffer:
-                                    break
-                                outputFileHandle.write(copyBuffer)
-                        inputFileHandle.close()
-                        #Remove the file from the lock files
-                        with self._pendingFileWritesLock:
-                            self._pendingFileWrites.remove(jobStoreFileID)
-                except:
-                    self._terminateEvent.set()
-                    raise
-
-            self.workers = map(lambda i : Thread(target=asyncWrite),
-                               range(self.workerNumber))
-            for worker in self.workers:
-                worker.start()
+            self.evictionPolicy = getEvictionPolicy(self.jobStore.config.cacheEvictionPolicy)
+            # The threads downloading the files passed to prefetchGlobalFiles, created on demand
+            self._prefetchPool = None
             self.inputBlockFn = inputBlockFn
+            # The number of bytes of files the job may keep in the cache, which is known once the
+            # job is opened, and the number of bytes reserved for the copies of streamed files
+            self._cacheSize = 0
+            self._streamReserved = 0
 
         @contextmanager
         def open(self, job):
@@ -578,6 +802,9 @@ class Job(object):
             :param job:
             :return:
             '''
+            # Copies of streamed files are kept within the cache size that _cleanLocalTempDir
+            # enforces after the job
+            self._cacheSize = job.effectiveRequirements(self.jobStore.config).cache
             # Create a working directory for the job
             startingDir = os.getcwd()
             self.localTempDir = makePublicDir(os.path.join(self.localTempDir, str(uuid.uuid4())))
@@ -587,6 +814,7 @@ class Job(object):
                 os.chdir(self.localTempDir)
                 yield
             finally:
+                self._waitForPrefetches()
                 # chdir back to the starting point for sanity
                 os.chdir(startingDir)
 
@@ -659,13 +887,15 @@ class Job(object):
                     self._pendingFileWrites.add(jobStoreFileID)
                 # A file handle added to the queue allows the asyncWrite threads to remove their jobID from _pendingFileWrites.
                 # Therefore, a file should only be added after its fileID is added to _pendingFileWrites
-                self.queue.put((fileHandle, jobStoreFileID))
+                self._queueWrite(fileHandle, jobStoreFileID)
                 self._jobStoreFileIDToCacheLocation[jobStoreFileID] = absLocalFileName
+                self._recordCacheAccess(jobStoreFileID, absLocalFileName)
             else:
                 #Write the file directly to the file store
                 jobStoreFileID = self.jobStore.writeFile(localFileName, cleanupID)
             return jobStoreFileID
 
+        @contextmanager
         def writeGlobalFileStream(self, cleanup=False):
             """
             Similar to writeGlobalFile, but allows the writing of a stream to the job store.
@@ -676,8 +906,30 @@ class Job(object):
             can be written to and 2) the ID of the resulting file in the job store. \
             The yielded file handle does not need to and should not be closed explicitly.
             """
-            #TODO: Make this work with the caching??
-            return self.jobStore.writeFileStream(None if not cleanup else self.jobWrapper.jobStoreID)
+            cleanupID = None if not cleanup else self.jobWrapper.jobStoreID
+            # The written data is also copied to a local file that is added to the cache
+            localFilePath = self.getLocalTempFile()
+            tee = None
+            try:
+                with self.jobStore.writeFileStream(cleanupID) as (stream, fileStoreID):
+                    tee = self._TeeStream(stream, localFilePath, self._reserveCacheSpace)
+                    try:
+                        yield tee, fileStoreID
+                    finally:
+                        copied = tee.closeCopy()
+                if copied:
+                    os.chmod(localFilePath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    self._jobStoreFileIDToCacheLocation[fileStoreID] = localFilePath
+                    self._recordCacheAccess(fileStoreID, localFilePath)
+                else:
+                    os.remove(localFilePath)
+            except:
+                os.remove(localFilePath)
+                raise
+            finally:
+                # A cached copy is accounted for by its size instead
+                if tee is not None:
+                    self._releaseCacheSpace(tee.reserved)
 
         def readGlobalFile(self, fileStoreID, userPath=None, cache=True, mutable=None):
             """
@@ -727,6 +979,10 @@ class Job(object):
             #is a key in _jobStoreFileIDToCacheLocation.
             if fileStoreID in self._jobStoreFileIDToCacheLocation:
                 cachedAbsFilePath = self._jobStoreFileIDToCacheLocation[fileStoreID]
+                self._recordCacheAccess(fileStoreID, cachedAbsFilePath)
+                fileSize = os.stat(cachedAbsFilePath).st_size
+                self._countCacheMetrics(hits=1, bytesFromCache=fileSize)
+                self._traceCacheLookup(fileStoreID, fileSize)
                 if cache and not mutable:
                     #If the user specifies a location and it is not the current location
                     #return a hardlink to the location, else return the original location
@@ -741,20 +997,23 @@ class Job(object):
                 else:
                     #If caching is not true then make a copy of the file
                     localFilePath = userPath if userPath != None else self.getLocalTempFile()
-                    shutil.copyfile(cachedAbsFilePath, localFilePath)
+                    copyFile(cachedAbsFilePath, localFilePath)
                     return localFilePath
             else:
                 #If it is not in the cache read it from the jobStore to the
                 #desired location
                 localFilePath = userPath if userPath != None else self.getLocalTempFile()
                 self.jobStore.readFile(fileStoreID, localFilePath)
+                fileSize = os.stat(localFilePath).st_size
+                self._countCacheMetrics(misses=1, bytesDownloaded=fileSize)
+                self._traceCacheLookup(fileStoreID, fileSize)
                 if mutable:
                     # FIXME Can't do this at the top because of loopy (circular) import errors
                     from toil.jobStores.fileJobStore import FileJobStore
                     if isinstance(self.jobStore, FileJobStore):
                         # If readFile created a hard-link, we need to undo the link and copy. 
                         if os.stat(localFilePath).st_nlink==2:
-                            shutil.copyfile(localFilePath, localFilePath+'.tmp')
+                            copyFile(localFilePath, localFilePath+'.tmp')
                             os.rename(localFilePath+'.tmp', localFilePath)
                 else:
                     os.chmod(localFilePath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
@@ -763,9 +1022,126 @@ class Job(object):
                 if cache:
                     assert localFilePath.startswith(self.localTempDir)
                     self._jobStoreFileIDToCacheLocation[fileStoreID] = localFilePath
+                    self._recordCacheAccess(fileStoreID, localFilePath)
                     os.chmod(localFilePath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
                 return localFilePath
 
+        def prefetchGlobalFiles(self, fileStoreIDs, userPaths=None, cache=True, mutable=None):
+            """
+            Starts downloading the files with the given IDs in the background, up to
+            downloadThreads at a time (see the --downloadThreads option), so that the job can carry
+            on while they are being downloaded. The files are read as if by readGlobalFile, so they are
+            added to and read from the cache in the same way.
+
+            :param list[str] fileStoreIDs: job store IDs of the files to read
+
+            :param list[str] userPaths: the paths to read the files to, see readGlobalFile. \
+            Defaults to None for every file.
+
+            :param boolean cache: see readGlobalFile.
+
+            :param boolean mutable: see readGlobalFile.
+
+            :return: a future for each of the files, in the order of the given IDs. The get() \
+            method of a future blocks until the file is read and returns the path to its local \
+            copy, or raises the exception raised while reading it.
+
+            :rtype: list[multiprocessing.pool.AsyncResult]
+            """
+            if userPaths is None:
+                userPaths = [None] * len(fileStoreIDs)
+            assert len(userPaths) == len(fileStoreIDs)
+            if self._prefetchPool is None:
+                config = self.jobStore.config
+                self._prefetchPool = ThreadPool(config.downloadThreads or
+                                                max(2, self.jobStore.maxConcurrentRequests))
+            return [self._prefetchPool.apply_async(self.readGlobalFile, (fileStoreID, userPath),
+                                                   dict(cache=cache, mutable=mutable))
+                    for fileStoreID, userPath in zip(fileStoreIDs, userPaths)]
+
+        def readGlobalFiles(self, fileStoreIDs, userPaths=None, cache=True, mutable=None):
+            """
+            Reads the files with the given IDs concurrently, see prefetchGlobalFiles.
+
+            :return: the paths to the local copies of the files, in the order of the given IDs.
+            :rtype: list[str]
+            """
+            return [future.get() for future in self.prefetchGlobalFiles(fileStoreIDs, userPaths,
+                                                                        cache, mutable)]
+
+        def _waitForPrefetches(self):
+            """
+            Waits for the files passed to prefetchGlobalFiles to be read, so that the downloads
+            don't race with the cleanup after the job, even if the job didn't wait for them.
+            """
+            if self._prefetchPool is not None:
+                self._prefetchPool.close()
+                self._prefetchPool.join()
+                self._prefetchPool = None
+
+        def readGlobalFileRange(self, fileStoreID, offset, length):
+            """
+            Reads part of a file in the job store. If the file is cached on this node the bytes \
+            are read from the cached copy, otherwise only the requested bytes are fetched from \
+            the job store and the file is not added to the cache.
+
+            :param str fileStoreID: job store id for the file
+
+            :param int offset: the position in the file of the first byte to read
+
+            :param int length: the maximum number of bytes to read
+
+            :return: the bytes read, which are fewer than length if the range extends past the \
+            end of the file.
+            :rtype: str
+            """
+            if fileStoreID in self.filesToDelete:
+                raise RuntimeError("Trying to access a file in the jobStore you've deleted: %s" % fileStoreID)
+            if offset < 0 or length < 0:
+                raise ValueError("Invalid range of %i bytes at offset %i" % (length, offset))
+            cachedFilePath = self._cachedFilePath(fileStoreID)
+            if cachedFilePath is not None:
+                try:
+                    with open(cachedFilePath, 'r') as f:
+                        f.seek(offset)
+                        data = f.read(length)
+                    self._recordCacheAccess(fileStoreID, cachedFilePath)
+                except (IOError, OSError) as e:
+                    # The cached copy was evicted after it was looked up
+                    if e.errno != errno.ENOENT:
+                        raise
+                else:
+                    self._countCacheMetrics(hits=1, bytesFromCache=len(data))
+                    return data
+            data = self.jobStore.readFileRange(fileStoreID, offset, length)
+            self._countCacheMetrics(misses=1, bytesDownloaded=len(data))
+            return data
+
+        def mmapGlobalFile(self, fileStoreID):
+            """
+            Maps a file in the job store into memory. The file is read like an immutable file \
+            from readGlobalFile, so it is taken from or added to the cache, and the mapping is of \
+            the cached copy. Only the pages the job touches are read from the local disk.
+
+            Empty files can't be mapped, see :class:`mmap.mmap`.
+
+            :param str fileStoreID: job store id for the file
+
+            :return: a read-only memory map of the whole file
+            :rtype: mmap.mmap
+            """
+            localFilePath = self.readGlobalFile(fileStoreID, mutable=False)
+            with open(localFilePath, 'r') as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def _cachedFilePath(self, fileStoreID):
+            """
+            :return: the path to the cached copy of the file with the given ID, or None if the \
+            file is not cached
+            :rtype: str|None
+            """
+            return self._jobStoreFileIDToCacheLocation.get(fileStoreID)
+
         def readGlobalFileStream(self, fileStoreID):
             """
             Similar to readGlobalFile, but allows a stream to be read from the job \
@@ -779,15 +1155,178 @@ class Job(object):
 
             #If fileStoreID is in the cache provide a handle from the local cache
             if fileStoreID in self._jobStoreFileIDToCacheLocation:
+                self._recordCacheAccess(fileStoreID,
+                                        self._jobStoreFileIDToCacheLocation[fileStoreID])
+                fileSize = os.stat(self._jobStoreFileIDToCacheLocation[fileStoreID]).st_size
+                self._countCacheMetrics(hits=1, bytesFromCache=fileSize)
+                self._traceCacheLookup(fileStoreID, fileSize)
                 #This leaks file handles (but the commented out code does not work properly)
                 return open(self._jobStoreFileIDToCacheLocation[fileStoreID], 'r')
                 #with open(self._jobStoreFileIDToCacheLocation[fileStoreID], 'r') as fH:
                 #        yield fH
             else:
-                #TODO: Progressively add the file to the cache
-                return self.jobStore.readFileStream(fileStoreID)
-                #with self.jobStore.readFileStream(fileStoreID) as fH:
-                #    yield fH
+                return self._readGlobalFileStreamToCache(fileStoreID)
+
+        @contextmanager
+        def _readGlobalFileStreamToCache(self, fileStoreID):
+            """
+            Streams a file from the job store, copying it to a local temporary file that is added
+            to the cache if the stream is read to the end.
+            """
+            localFilePath = self.getLocalTempFile()
+            tee = None
+            try:
+                with self.jobStore.readFileStream(fileStoreID) as stream:
+                    tee = self._TeeStream(stream, localFilePath, self._reserveCacheSpace)
+                    try:
+                        yield tee
+                    finally:
+                        copied = tee.closeCopy()
+                    complete = copied and not stream.read(1)
+                self._countCacheMetrics(misses=1, bytesDownloaded=tee.size)
+                self._traceCacheLookup(fileStoreID, tee.size)
+                if complete:
+                    os.chmod(localFilePath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    self._jobStoreFileIDToCacheLocation[fileStoreID] = localFilePath
+                    self._recordCacheAccess(fileStoreID, localFilePath)
+                else:
+                    os.remove(localFilePath)
+            except:
+                os.remove(localFilePath)
+                raise
+            finally:
+                # A cached copy is accounted for by its size instead
+                if tee is not None:
+                    self._releaseCacheSpace(tee.reserved)
+
+        def _reserveCacheSpace(self, numBytes):
+            """
+            Reserves space for the copy of a streamed file that is made in the local temp dir, such
+            that the cached files and the copies don't exceed the cache size of the job.
+
+            :param int numBytes: the number of bytes to reserve
+            :return: True if the space was reserved, False if it would exceed the cache size
+            :rtype: bool
+            """
+            cachedSize = sum(os.stat(cachedFilePath).st_size
+                             for cachedFilePath in self._jobStoreFileIDToCacheLocation.values())
+            if cachedSize + self._streamReserved + numBytes > self._cacheSize:
+                return False
+            self._streamReserved += numBytes
+            return True
+
+        def _releaseCacheSpace(self, numBytes):
+            """
+            Releases space reserved with _reserveCacheSpace.
+
+            :param int numBytes: the number of bytes to release
+            """
+            self._streamReserved -= numBytes
+
+        class _TeeStream(object):
+            """
+            Wraps a stream that is read from or written to the job store, copying the data that
+            passes through it to a local file. The copy is only a by-product of the stream, so if
+            it can't be written, the copy is dropped and the stream carries on without it.
+            """
+            # The space reserved for the copy at a time, so that reserving it doesn't take the
+            # cache lock for every line of a file
+            reserveIncrement = 16 * 1024 * 1024
+
+            def __init__(self, stream, copyPath, reserve=None):
+                """
+                :param stream: the stream to wrap
+                :param str copyPath: the path of the file to copy the data to
+                :param reserve: a function taking a number of bytes that returns True if that much
+                       space could be reserved for the copy, or None if the space for the copy
+                       doesn't need to be reserved
+                """
+                self._stream = stream
+                self._copy = open(copyPath, 'w')
+                self._reserve = reserve
+                # The number of bytes that passed through the stream
+                self.size = 0
+                # The number of bytes reserved for the copy
+                self.reserved = 0
+
+            def _tee(self, data):
+                self.size += len(data)
+                if self._copy is None:
+                    return
+                if self.size > self.reserved and self._reserve is not None:
+                    needed = self.size - self.reserved
+                    for increment in sorted({needed, max(needed, self.reserveIncrement)},
+                                            reverse=True):
+                        if self._reserve(increment):
+                            self.reserved += increment
+                            break
+                    else:
+                        self._dropCopy('there is not enough space in the cache')
+                        return
+                try:
+                    self._copy.write(data)
+                except IOError as e:
+                    self._dropCopy(e)
+
+            def _dropCopy(self, reason):
+                logger.warn('Not keeping a local copy of the streamed file because %s.' % reason)
+                try:
+                    self._copy.close()
+                except IOError:
+                    pass  # The data buffered for the copy can't be written either
+                self._copy = None
+
+            def closeCopy(self):
+                """
+                Closes the copy, which the caller is responsible for removing.
+
+                :return: True if the copy contains all data that passed through the stream
+                :rtype: bool
+                """
+                if self._copy is not None:
+                    try:
+                        self._copy.close()
+                    except IOError as e:
+                        self._dropCopy(e)
+                    else:
+                        return True
+                return False
+
+            def read(self, *args):
+                data = self._stream.read(*args)
+                self._tee(data)
+                return data
+
+            def readline(self, *args):
+                line = self._stream.readline(*args)
+                self._tee(line)
+                return line
+
+            def readlines(self, *args):
+                lines = self._stream.readlines(*args)
+                for line in lines:
+                    self._tee(line)
+                return lines
+
+            def __iter__(self):
+                return self
+
+            def next(self):
+                line = self.readline()
+                if not line:
+                    raise StopIteration
+                return line
+
+            def write(self, data):
+                self._stream.write(data)
+                self._tee(data)
+
+            def writelines(self, lines):
+                for line in lines:
+                    self.write(line)
+
+            def __getattr__(self, name):
+                return getattr(self._stream, name)
 
         def deleteGlobalFile(self, fileStoreID):
             """
@@ -803,6 +1342,7 @@ class Job(object):
             if fileStoreID in self._jobStoreFileIDToCacheLocation:
                 #This will result in the files removal from the cache at the end of the current job
                 self._jobStoreFileIDToCacheLocation.pop(fileStoreID)
+                self._cacheAccesses.pop(fileStoreID, None)
 
         def importFile(self, srcUrl):
             return self.jobStore.importFile(srcUrl)
@@ -821,6 +1361,110 @@ class Job(object):
             logger.log(level=level, msg=("LOG-TO-MASTER: " + text))
             self.loggingMessages.append(dict(text=text, level=level))
 
+        def _queueWrite(self, fileHandle, jobStoreFileID):
+            """
+            Queues a file for upload by the worker threads, starting another thread if the ones
+            running are all busy. Blocks while the queue is full so that a job writing many files
+            does not hold an unbounded number of them open.
+
+            :param file fileHandle: a handle to the file, opened for reading
+            :param str jobStoreFileID: the ID of the file in the job store to upload it to
+            """
+            with self._uploadLock:
+                if len(self.workers) < self.workerNumber and (not self.workers or
+                                                              not self.queue.empty()):
+                    worker = Thread(target=self._asyncWrite)
+                    worker.start()
+                    self.workers.append(worker)
+            startTime = time.time()
+            while True:
+                try:
+                    self.queue.put((fileHandle, jobStoreFileID), timeout=2)
+                    break
+                except Full:
+                    # The workers only stop taking files off the queue if one of them failed
+                    if self._terminateEvent.isSet():
+                        fileHandle.close()
+                        raise RuntimeError("The termination flag is set, exiting")
+            with self._uploadLock:
+                self.uploadMetrics.wait += time.time() - startTime
+
+        def _asyncWrite(self):
+            """
+            Uploads the files queued by _queueWrite until it gets None from the queue. Runs in the
+            worker threads.
+            """
+            try:
+                while True:
+                    try:
+                        #Block for up to two seconds waiting for a file
+                        args = self.queue.get(timeout=2)
+                    except Empty:
+                        #Check if termination event is signaled
+                        #(set in the event of an exception in the worker)
+                        if self._terminateEvent.isSet():
+                            raise RuntimeError("The termination flag is set, exiting")
+                        continue
+                    #Normal termination condition is getting None from queue
+                    if args is None:
+                        break
+                    inputFileHandle, jobStoreFileID = args
+                    startTime = time.time()
+                    with inputFileHandle:
+                        fileSize = self._uploadFile(inputFileHandle, jobStoreFileID)
+                    with self._uploadLock:
+                        self.uploadMetrics.files += 1
+                        self.uploadMetrics.bytes += fileSize
+                        self.uploadMetrics.time += time.time() - startTime
+                    #Remove the file from the lock files
+                    with self._pendingFileWritesLock:
+                        self._pendingFileWrites.remove(jobStoreFileID)
+            except:
+                self._terminateEvent.set()
+                raise
+
+        def _uploadFile(self, inputFileHandle, jobStoreFileID):
+            """
+            Uploads a queued file. As long as the handle still refers to the file at the path it
+            was opened from, the path is handed to the job store, which can then upload the file
+            in parts or copy it without streaming it through a pipe. Otherwise, e.g. if the file
+            was deleted after it was queued, the file is streamed from the handle, which persists
+            while it is open.
+
+            :param file inputFileHandle: a handle to the file, opened for reading
+            :param str jobStoreFileID: the ID of the file in the job store to upload it to
+            :return: the size of the file in bytes
+            :rtype: int
+            """
+            fileSize = os.fstat(inputFileHandle.fileno()).st_size
+            try:
+                if os.path.samestat(os.fstat(inputFileHandle.fileno()),
+                                    os.stat(inputFileHandle.name)):
+                    self.jobStore.updateFile(jobStoreFileID, inputFileHandle.name)
+                    return fileSize
+            except (OSError, IOError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            with self.jobStore.updateFileStream(jobStoreFileID) as outputFileHandle:
+                copyFileObj(inputFileHandle, outputFileHandle, self.bufferSize)
+            return fileSize
+
+        def _stopWorkers(self):
+            """
+            Waits for the worker threads to upload the queued files and exit.
+            """
+            for _ in self.workers:
+                while True:
+                    try:
+                        self.queue.put(None, timeout=2)
+                        break
+                    except Full:
+                        # Don't wait for room in the queue if no thread is left to make it
+                        if not any(worker.isAlive() for worker in self.workers):
+                            break
+            for thread in self.workers:
+                thread.join()
+
         def _updateJobWhenDone(self):
             """
             Asynchronously update the status of the job on the disk, first waiting \
@@ -830,11 +1474,16 @@ class Job(object):
             def asyncUpdate():
                 try:
                     #Wait till all file writes have completed
-                    for i in xrange(len(self.workers)):
-                        self.queue.put(None)
-
-                    for thread in self.workers:
-                        thread.join()
+                    self._stopWorkers()
+                    if self.uploadMetrics.files:
+                        logger.debug("Uploaded %i files with %s in %.2f seconds (%s/s), waited "
+                                     "%.2f seconds for room in the upload queue.",
+                                     self.uploadMetrics.files,
+                                     bytes2human(self.uploadMetrics.bytes),
+                                     self.uploadMetrics.time,
+                                     bytes2human(self.uploadMetrics.bytes /
+                                                 max(self.uploadMetrics.time, 0.001)),
+                                     self.uploadMetrics.wait)
 
                     #Wait till input block-fn returns - in the event of an exception
                     #this will eventually terminate
@@ -846,24 +1495,11 @@ class Job(object):
                     if self._terminateEvent.isSet():
                         raise RuntimeError("The termination flag is set, exiting before update")
 
-                    #Indicate any files that should be deleted once the update of
-                    #the job wrapper is completed.
-                    self.jobWrapper.filesToDelete = list(self.filesToDelete)
-
-                    #Complete the job
-                    self.jobStore.update(self.jobWrapper)
-
-                    #Delete any remnant jobs
-                    map(self.jobStore.delete, self.jobsToDelete)
-
-                    #Delete any remnant files
-                    map(self.jobStore.deleteFile, self.filesToDelete)
-
-                    #Remove the files to delete list, having successfully removed the files
-                    if len(self.filesToDelete) > 0:
-                        self.jobWrapper.filesToDelete = []
-                        #Update, removing emptying files to delete
-                        self.jobStore.update(self.jobWrapper)
+                    #Complete the job, then delete any remnant jobs and files. The files to
+                    #delete are recorded in the job wrapper until they have been deleted.
+                    self.jobStore.commit(self.jobWrapper,
+                                         jobsToDelete=self.jobsToDelete,
+                                         filesToDelete=self.filesToDelete)
                 except:
                     self._terminateEvent.set()
                     raise
@@ -889,30 +1525,26 @@ class Job(object):
             """
             #Remove files so that the total cached files are smaller than a cacheSize
 
-            #List of pairs of (fileCreateTime, fileStoreID) for cached files
             with self._pendingFileWritesLock:
                 deletableCacheFiles = set(
                         self._jobStoreFileIDToCacheLocation.keys()) - self._pendingFileWrites
-            cachedFileCreateTimes = map(
-                    lambda x: (os.stat(self._jobStoreFileIDToCacheLocation[x]).st_ctime, x),
-                    deletableCacheFiles)
             # Total number of bytes stored in cached files
             totalCachedFileSizes = sum(
                     [os.stat(self._jobStoreFileIDToCacheLocation[x]).st_size for x in
                      self._jobStoreFileIDToCacheLocation.keys()])
-            # Remove earliest created files first - this is in place of 'Remove smallest files first'.  Again, might
-            # not be the best strategy.
-            cachedFileCreateTimes.sort()
-            cachedFileCreateTimes.reverse()
-            #Now do the actual file removal
-            while totalCachedFileSizes > cacheSize and len(cachedFileCreateTimes) > 0:
-                fileCreateTime, fileStoreID = cachedFileCreateTimes.pop()
-                fileSize = os.stat(self._jobStoreFileIDToCacheLocation[fileStoreID]).st_size
-                filePath = self._jobStoreFileIDToCacheLocation[fileStoreID]
-                self._jobStoreFileIDToCacheLocation.pop(fileStoreID)
+            accessRecords = {x: self._cacheAccesses[x] for x in deletableCacheFiles}
+            #Now do the actual file removal, in the order chosen by the eviction policy
+            for fileStoreID in self.evictionPolicy.evictionOrder(accessRecords):
+                if totalCachedFileSizes <= cacheSize:
+                    break
+                filePath = self._jobStoreFileIDToCacheLocation.pop(fileStoreID)
+                fileSize = os.stat(filePath).st_size
                 os.remove(filePath)
                 totalCachedFileSizes -= fileSize
+                self._countCacheMetrics(evictions=1, bytesEvicted=fileSize)
                 assert totalCachedFileSizes >= 0
+                Job.FileStore._cacheInflation = self.evictionPolicy.inflate(
+                    self._cacheInflation, self._cacheAccesses.pop(fileStoreID).priority)
 
             #Iterate from the base of localTempDir and remove all
             #files/empty directories, recursively
@@ -932,6 +1564,44 @@ class Job(object):
                 return True
             clean(self.localTempDir, False)
 
+        def _recordCacheAccess(self, fileStoreID, cachedFilePath):
+            """
+            Records an access to the cached copy of a file for the eviction policy.
+
+            :param str fileStoreID: the job store ID of the file
+            :param str cachedFilePath: the path of the cached copy
+            """
+            self._cacheAccesses[fileStoreID] = self.evictionPolicy.access(
+                self._cacheAccesses.get(fileStoreID), os.stat(cachedFilePath).st_size, time.time(),
+                self._cacheInflation)
+
+        def _traceCacheLookup(self, fileStoreID, size):
+            """
+            Appends a lookup of the given file in the cache to the trace given by the cacheTrace
+            option, if any, see toil.utils.toilCacheSim.readTrace.
+
+            :param str fileStoreID: the job store ID of the file
+            :param int size: the size of the file in bytes
+            """
+            tracePath = self.jobStore.config.cacheTrace
+            if tracePath is not None:
+                fd = os.open(tracePath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    # A single write to a file opened for appending isn't interleaved with the
+                    # writes of other workers on the node
+                    os.write(fd, '%s %i\n' % (fileStoreID, size))
+                finally:
+                    os.close(fd)
+
+        def _countCacheMetrics(self, **increments):
+            """
+            Adds the given increments to the counters in cacheMetrics. Files may be read by
+            several threads, see prefetchGlobalFiles.
+            """
+            with self._cacheMetricsLock:
+                for name, increment in increments.iteritems():
+                    self.cacheMetrics[name] += increment
+
         def _blockFn(self):
             """
             Blocks while _updateJobWhenDone is running.
@@ -947,12 +1617,88 @@ class Job(object):
             that ensures that all the file writing threads exit.
             """
             self.updateSemaphore.acquire()
-            for i in xrange(len(self.workers)):
-                self.queue.put(None)
-            for thread in self.workers:
-                thread.join()
+            self._stopWorkers()
             self.updateSemaphore.release()
 
+        @classmethod
+        def removeWorkerTempDir(cls, localWorkerTempDir, workflowID, sizeBound):
+            """
+            Removes a worker's temporary directory without waiting for its contents to be deleted.
+            The directory is renamed into the workflow's trash directory on the node, which is then
+            emptied by a detached reaper process. Entries left behind by a reaper that got killed
+            are deleted by the reaper of the next worker to finish on the node.
+
+            Measuring the directory would take about as long as deleting it, so until the reaper
+            has measured it, the directory is assumed to occupy the given number of bytes.
+
+            :param str localWorkerTempDir: the worker's temporary directory
+            :param str workflowID: the ID of the workflow the worker belongs to
+            :param int|None sizeBound: an upper bound on the size of the directory in bytes, like
+                   the disk reserved for the worker's jobs, or None if no bound is known, in which
+                   case the directory isn't accounted for until the reaper has measured it
+            """
+            workflowDir = os.path.dirname(localWorkerTempDir)
+            trashDir = os.path.join(workflowDir, trashDirName(workflowID))
+            try:
+                os.mkdir(trashDir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            trashedDir = os.path.join(trashDir, os.path.basename(localWorkerTempDir))
+            try:
+                os.rename(localWorkerTempDir, trashedDir)
+            except OSError:
+                shutil.rmtree(localWorkerTempDir)
+                return
+            if sizeBound is not None:
+                cls._accountForTrash(workflowDir, workflowID, trashedDir, sizeBound)
+            # Fork twice so the reaper is not a child of the worker, which the batch system may be
+            # waiting on. The reaper must not touch anything that threads of the worker may have
+            # locked, which rules out logging.
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.setsid()
+                    if os.fork() == 0:
+                        devNull = os.open(os.devnull, os.O_RDWR)
+                        for fd in (0, 1, 2):
+                            os.dup2(devNull, fd)
+                        cls._emptyTrash(workflowDir, workflowID)
+                finally:
+                    os._exit(0)
+            else:
+                os.waitpid(pid, 0)
+
+        @classmethod
+        def _emptyTrash(cls, workflowDir, workflowID):
+            """
+            Deletes all worker directories in the trash of the given workflow.
+            """
+            trashDir = os.path.join(workflowDir, trashDirName(workflowID))
+            try:
+                trashedDirs = os.listdir(trashDir)
+            except OSError:
+                return  # The workflow directory was removed already
+            for name in trashedDirs:
+                trashedDir = os.path.join(trashDir, name)
+                # Replace the estimate the directory was trashed with by its actual size, which
+                # matters for as long as it takes to delete a large directory
+                cls._accountForTrash(workflowDir, workflowID, trashedDir, getDirSize(trashedDir))
+                # Concurrent reapers may be deleting the same directory
+                shutil.rmtree(trashedDir, ignore_errors=True)
+                if not os.path.exists(trashedDir):
+                    cls._accountForTrash(workflowDir, workflowID, trashedDir, None)
+
+        @classmethod
+        def _accountForTrash(cls, workflowDir, workflowID, trashedDir, size):
+            """
+            Records that the given directory occupies the given number of bytes in the trash, or
+            that it has been deleted if size is None. A size is only recorded while the directory
+            exists, since another reaper may have deleted it after it was measured. The FileStore
+            does not manage the disk space on the node, so this does nothing.
+            """
+            pass
+
     class CachedFileStore(FileStore):
         '''
         A cache-enabled version of Filestore. Basically FileStore on Adderall(R)
@@ -967,15 +1713,21 @@ class Job(object):
             self.localCacheDir = os.path.join(os.path.dirname(localTempDir),
                                               cacheDirName(self.jobStore.config.workflowID))
             self.cacheLockFile = os.path.join(self.localCacheDir, '.cacheLock')
-            self.cacheStateFile = os.path.join(self.localCacheDir, '_cacheState')
+            self.cacheStateFile = os.path.join(self.localCacheDir, '_cacheState.db')
             # Since each worker has it's own unique FileStore instance, and only one Job can run at
             # a time on a worker, we can bookkeep the job's file store operated files here.
             self.jobSpecificFiles = {}
             self.nlinkThreshold = None
             self.workflowAttemptNumber = self.jobStore.config.workflowAttemptNumber
             self.hashedJobCommand = sha1(self.jobWrapper.command.split()[1]).hexdigest()
+            config = self.jobStore.config
+            # The cache of files kept on the node by earlier workflows, if any
+            self.nodeCache = (None if config.nodeCache is None
+                              else self._NodeCache(config.nodeCache, config.nodeCacheSize))
             # This is a flag to better resolve cache equation imbalances at cleanup time.
             self.cleanupInProgress = False
+            # When the current thread acquired the cache lock, see _lockCache()
+            self._cacheLockTimer = local()
 
             self._setupCache()
 
@@ -994,14 +1746,14 @@ class Job(object):
             # into the cache lock file.  If it has, restore the cache file to a state where the job
             # doesn't exist.
             with self._CacheState.open(self) as cacheInfo:
-                if cacheInfo.jobState[self.hashedJobCommand]:
+                jobState = cacheInfo.jobState(self.hashedJobCommand)
+                if jobState.exists():
                     # Delete the old work directory if it still exists, to remove unwanted nlinks.
-                    jobState = self._JobState(cacheInfo.jobState[self.hashedJobCommand])
                     assert jobState.jobDir != self.localTempDir
                     if os.path.exists(jobState.jobDir):
                         shutil.rmtree(jobState.jobDir)  # Ignore_errors?
                     cacheInfo.sigmaJob -= jobState.jobReqs
-                    cacheInfo.jobState.pop(self.hashedJobCommand)
+                    jobState.remove()
             # Get the requirements for the job and clean the cache if necessary. cleanCache will
             # ensure that the requirements for this job are stored in the state file.
             jobReqs = job.effectiveRequirements(self.jobStore.config).disk
@@ -1011,6 +1763,7 @@ class Job(object):
                 os.chdir(self.localTempDir)
                 yield
             finally:
+                self._waitForPrefetches()
                 os.chdir(startingDir)
                 self.cleanupInProgress = True
                 self.returnJobReqs(jobReqs)
@@ -1040,11 +1793,13 @@ class Job(object):
                 # from the file store. In that case, you want to copy to the file store so that
                 # the two have distinct nlink counts.
                 # Can read without a lock because we're only reading job-specific info.
-                jobSpecificFiles = self._CacheState._load(self.cacheStateFile).jobState[
-                    self.hashedJobCommand]['filesToFSIDs'].keys()
+                with self._CacheState.transaction(self.cacheStateFile,
+                                                  readOnly=True) as cacheInfo:
+                    fileIsJobSpecific = cacheInfo.jobState(
+                        self.hashedJobCommand).hasFilePath(absLocalFileName)
                 # Saying nlink is 2 implicitly means we are using the job file store, and it is on
                 # the same device as the work dir.
-                if self.nlinkThreshold == 2 and absLocalFileName not in jobSpecificFiles:
+                if self.nlinkThreshold == 2 and not fileIsJobSpecific:
                     jobStoreFileID = self.jobStore.getEmptyFileStoreID(cleanupID)
                     # getEmptyFileStoreID creates the file in the scope of the job store hence we
                     # need to delete it before linking.
@@ -1061,13 +1816,13 @@ class Job(object):
                     # A file handle added to the queue allows the asyncWrite threads to remove their
                     # jobID from _pendingFileWrites. Therefore, a file should only be added after
                     # its fileID is added to _pendingFileWrites
-                    self.queue.put((fileHandle, jobStoreFileID))
+                    self._queueWrite(fileHandle, jobStoreFileID)
                 # Else write directly to the job store.
                 else:
                     jobStoreFileID = self.jobStore.writeFile(absLocalFileName, cleanupID)
                 # Local files are cached by default, unless they were written from previously read
                 # files.
-                if absLocalFileName not in jobSpecificFiles:
+                if not fileIsJobSpecific:
                     self.addToCache(absLocalFileName, jobStoreFileID, 'write')
                 else:
                     self._JobState.updateJobSpecificFiles(self, jobStoreFileID, absLocalFileName,
@@ -1123,7 +1878,7 @@ class Job(object):
             # currently being downloaded by another job and will be in the cache shortly. It is used
             # to prevent multiple jobs from simultaneously downloading the same file from the file
             # store.
-            harbingerFileName = ''.join(['/.'.join(os.path.split(cachedFileName)), '.harbinger'])
+            harbingerFileName = self._harbingerFileName(cachedFileName)
             # setup the output filename.  If a name is provided, use it - This makes it a Named
             # Local File. If a name isn't provided, use the base64 encoded name such that we can
             # easily identify the files later on.
@@ -1139,53 +1894,60 @@ class Job(object):
             # First check whether the file is in cache.  If it is, then hardlink the file to
             # userPath. Cache operations can only occur on local files.
             with self.cacheLock() as lockFileHandle:
+                # A job streaming the file into the cache holds on to the harbinger for as long as
+                # it reads the stream. That job could be this one, so don't wait for it and
+                # download the file without caching it instead.
+                streaming = fileIsLocal and self._isStreamHarbinger(harbingerFileName)
+                if streaming:
+                    logger.info('CACHE: File with ID %s is being streamed into the cache, '
+                                'downloading it without caching.' % fileStoreID)
                 if fileIsLocal and self._fileIsCached(fileStoreID):
                     logger.info('CACHE: Cache hit on file with ID \'%s\'.' % fileStoreID)
+                    fileSize = os.stat(cachedFileName).st_size
+                    self._countCacheMetrics(hits=1, bytesFromCache=fileSize)
+                    self._traceCacheLookup(fileStoreID, fileSize)
                     assert not os.path.exists(localFilePath)
                     if mutable:
-                        shutil.copyfile(cachedFileName, localFilePath)
-                        cacheInfo = self._CacheState._load(self.cacheStateFile)
-                        jobState = self._JobState(cacheInfo.jobState[self.hashedJobCommand])
-                        jobState.addToJobSpecFiles(fileStoreID, localFilePath, -1, None)
-                        cacheInfo.jobState[self.hashedJobCommand] = jobState.__dict__
-                        cacheInfo.write(self.cacheStateFile)
+                        copyFile(cachedFileName, localFilePath)
+                        self._JobState.updateJobSpecificFiles(self, fileStoreID, localFilePath,
+                                                              -1, None)
+                        self._recordCacheAccess(fileStoreID, cachedFileName)
                     else:
                         os.link(cachedFileName, localFilePath)
                         self.returnFileSize(fileStoreID, localFilePath, lockFileHandle,
                                             fileAlreadyCached=True)
                 # If the file is not in cache, check whether the .harbinger file for the given
-                # FileStoreID exists. If it does, the wait and periodically check for the removal of
-                # the file and the addition of the completed download into cache of the file by the
-                # other job. Then we link to it.
-                elif fileIsLocal and os.path.exists(harbingerFileName):
+                # FileStoreID exists. If it does, wait for the other job to finish or abandon the
+                # download. Then we link to it.
+                elif fileIsLocal and os.path.exists(harbingerFileName) and not streaming:
                     logger.info('CACHE: Waiting for another worker to download file with ID %s.'
                                 % fileStoreID)
-                    while os.path.exists(harbingerFileName):
-                        # Release the file lock and then periodically check for completed download
-                        flock(lockFileHandle, LOCK_UN)
-                        time.sleep(20)  # What should this value be?
-                        flock(lockFileHandle, LOCK_EX)
-                    # If the code reaches here, the partial lock file has been removed. This means
+                    self._waitForHarbinger(harbingerFileName, lockFileHandle)
+                    # If the code reaches here, the harbinger file has been removed. This means
                     # either the file was successfully downloaded and added to cache, or something
                     # failed. To prevent code duplication, we recursively call readGlobalFile.
-                    flock(lockFileHandle, LOCK_UN)
-                    return self.readGlobalFile(fileStoreID, userPath, cache)
+                    self._unlockCache(lockFileHandle)
+                    return self.readGlobalFile(fileStoreID, userPath, cache, mutable)
                 # If the file is not in cache, then download it to the userPath and then add to
                 # cache if specified.
                 else:
                     logger.debug('CACHE: Cache miss on file with ID \'%s\'.' % fileStoreID)
-                    if fileIsLocal and cache:
-                        # If caching of the downloaded file is desired, First create the .partial
-                        # file so other jobs know not to redundantly download the same file.
-                        open(harbingerFileName, 'w').close()  # This emulates the system 'touch'
+                    self._countCacheMetrics(misses=1)
+                    if fileIsLocal and cache and not streaming:
+                        # If caching of the downloaded file is desired, First create the
+                        # .harbinger file so other jobs know not to redundantly download the same
+                        # file. It is locked for the duration of the download, see
+                        # _waitForHarbinger().
+                        harbinger = open(harbingerFileName, 'w')
+                        flock(harbinger, LOCK_EX)
                         # Now release the file lock while the file is downloaded as download could
                         # take a while.
-                        flock(lockFileHandle, LOCK_UN)
+                        self._unlockCache(lockFileHandle)
                         # Use try:finally: so that the .harbinger file is removed whether the
                         # download succeeds or not.
                         try:
-                            self.jobStore.readFile(fileStoreID,
-                                                   '/.'.join(os.path.split(cachedFileName)))
+                            self._downloadToCache(fileStoreID,
+                                                  '/.'.join(os.path.split(cachedFileName)))
                         except: #TODO
                             if os.path.exists('/.'.join(os.path.split(cachedFileName))):
                                 os.remove('/.'.join(os.path.split(cachedFileName)))
@@ -1199,13 +1961,18 @@ class Job(object):
                                 # We don't need to return the file size here because addToCache
                                 # already does it for us
                         finally:
-                            # Reacquire the file lock and delete the partial file.
-                            flock(lockFileHandle, LOCK_EX)
+                            # Reacquire the file lock and delete the harbinger file. Closing it
+                            # wakes up the jobs waiting for the download.
+                            self._lockCache(lockFileHandle)
                             os.remove(harbingerFileName)
+                            harbinger.close()
                     else:
                         # Release the cache lock since the remaining stuff is not cache related.
-                        flock(lockFileHandle, LOCK_UN)
+                        self._unlockCache(lockFileHandle)
                         self.jobStore.readFile(fileStoreID, localFilePath)
+                        fileSize = os.stat(localFilePath).st_size
+                        self._countCacheMetrics(bytesDownloaded=fileSize)
+                        self._traceCacheLookup(fileStoreID, fileSize)
                         os.chmod(localFilePath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
                         # Now that we have the file, we have 2 options. It's modifiable or not.
                         # Either way, we need to account for FileJobStore making links instead of
@@ -1216,7 +1983,7 @@ class Job(object):
                                 # job store is FilejobStore, and the job store and local temp dir
                                 # are on the same device. An atomic rename removes the nlink on the
                                 # file handle linked from the job store.
-                                shutil.copyfile(localFilePath, localFilePath+'.tmp')
+                                copyFile(localFilePath, localFilePath+'.tmp')
                                 os.rename(localFilePath+'.tmp', localFilePath)
                             self._JobState.updateJobSpecificFiles(self, fileStoreID, localFilePath,
                                                                   -1, False)
@@ -1228,31 +1995,285 @@ class Job(object):
                                                                   0.0, False)
             return localFilePath
 
-        def readGlobalFileStream(self, fileStoreID):
+        @staticmethod
+        def _harbingerFileName(cachedFileName):
             """
-            Similar to readGlobalFile, but allows a stream to be read from the job \
-            store.
+            :return: the path of the harbinger file marking that the file cached at the given path
+                     is being downloaded
+            :rtype: str
+            """
+            return ''.join(['/.'.join(os.path.split(cachedFileName)), '.harbinger'])
 
-            :returns: a context manager yielding a file handle which can be read from. \
-            The yielded file handle does not need to and should not be closed explicitly.
+        # The contents of the harbinger of a file that is being streamed into the cache
+        _streamHarbingerMarker = 'stream'
+
+        @classmethod
+        def _isStreamHarbinger(cls, harbingerFileName):
             """
-            if fileStoreID in self.filesToDelete:
-                raise RuntimeError(
-                        "Trying to access a file in the jobStore you've deleted: %s" % fileStoreID)
+            Must be called with the cache lock held.
 
-            # If fileStoreID is in the cache provide a handle from the local cache
-            if self._fileIsCached(fileStoreID):
-                logger.info('CACHE: Cache hit on file with ID \'%s\'.' % fileStoreID)
-                return open(self.encodedFileID(fileStoreID), 'r')
-            else:
-                logger.info('CACHE: Cache miss on file with ID \'%s\'.' % fileStoreID)
-                return self.jobStore.readFileStream(fileStoreID)
+            :param str harbingerFileName: path to the harbinger file
+            :return: True if the harbinger exists and is held by a job streaming the file into the
+                     cache, see _readGlobalFileStreamToCache
+            :rtype: bool
+            """
+            try:
+                harbinger = open(harbingerFileName, 'r')
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    return False
+                raise
+            with harbinger:
+                if harbinger.read() != cls._streamHarbingerMarker:
+                    return False
+                # The harbinger of a dead job isn't locked. _waitForHarbinger removes it.
+                try:
+                    flock(harbinger, LOCK_SH | LOCK_NB)
+                except IOError as e:
+                    if e.errno in (errno.EAGAIN, errno.EACCES):
+                        return True
+                    raise
+                else:
+                    return False
 
-        def deleteLocalFile(self, fileStoreID):
-            '''
-            Deletes a local file with the given job store ID.
-            :param str fileStoreID: File Store ID of the file to be deleted.
-            :return: None
+        def _waitForHarbinger(self, harbingerFileName, lockFileHandle):
+            """
+            Blocks until the job downloading a file releases the lock on the file's harbinger,
+            which it holds for the duration of the download. The lock is also released by the
+            kernel if that job dies, in which case the harbinger it left behind is removed.
+
+            Must be called with the cache lock held, which is released while waiting and
+            reacquired before returning.
+
+            :param str harbingerFileName: path to the harbinger file
+            :param file lockFileHandle: the open cache lock file
+            """
+            try:
+                harbinger = open(harbingerFileName, 'r')
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    return
+                raise
+            with harbinger:
+                self._unlockCache(lockFileHandle)
+                startTime = time.time()
+                try:
+                    flock(harbinger, LOCK_SH)
+                finally:
+                    self._countCacheMetrics(harbingerWaits=1,
+                                            harbingerWaitTime=time.time() - startTime)
+                    self._lockCache(lockFileHandle)
+                # A job that completes its download removes the harbinger before unlocking it.
+                # Opening the harbinger pins its inode, so a new harbinger created by another
+                # download would be a different file.
+                try:
+                    stale = os.stat(harbingerFileName).st_ino == os.fstat(harbinger.fileno()).st_ino
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                else:
+                    if stale:
+                        logger.warn('CACHE: Removing harbinger %s left behind by a dead worker.'
+                                    % harbingerFileName)
+                        os.remove(harbingerFileName)
+
+        def _downloadToCache(self, fileStoreID, localFilePath):
+            """
+            Downloads the file with the given ID to the given path in the cache directory. The file
+            is taken from the node cache instead if an earlier workflow on this node downloaded a
+            file with the same contents.
+
+            :param str fileStoreID: job store id for the file
+            :param str localFilePath: path in the cache directory to download the file to
+            """
+            # If the cached copies are links to the files in the job store, the files can't be
+            # shared any cheaper than that.
+            if self.nodeCache is not None and self.nlinkThreshold != 2:
+                digest = self.jobStore.getFileDigest(fileStoreID)
+                if digest is not None:
+                    # Remember the digest so that the file can be moved to the node cache when the
+                    # workflow finishes, see moveToNodeCache().
+                    with self._CacheState.transaction(self.cacheStateFile) as cacheInfo:
+                        cacheInfo.setDigest(fileStoreID, digest)
+                    if self.nodeCache.take(digest, localFilePath):
+                        logger.info('CACHE: Node cache hit on file with ID \'%s\'.' % fileStoreID)
+                        fileSize = os.stat(localFilePath).st_size
+                        self._countCacheMetrics(nodeCacheHits=1, bytesFromCache=fileSize)
+                        self._traceCacheLookup(fileStoreID, fileSize)
+                        return
+            self.jobStore.readFile(fileStoreID, localFilePath)
+            fileSize = os.stat(localFilePath).st_size
+            self._countCacheMetrics(bytesDownloaded=fileSize)
+            self._traceCacheLookup(fileStoreID, fileSize)
+
+        def readGlobalFileStream(self, fileStoreID):
+            """
+            Similar to readGlobalFile, but allows a stream to be read from the job \
+            store.
+
+            :returns: a context manager yielding a file handle which can be read from. \
+            The yielded file handle does not need to and should not be closed explicitly.
+            """
+            if fileStoreID in self.filesToDelete:
+                raise RuntimeError(
+                        "Trying to access a file in the jobStore you've deleted: %s" % fileStoreID)
+
+            # If fileStoreID is in the cache provide a handle from the local cache
+            if self._fileIsCached(fileStoreID):
+                logger.info('CACHE: Cache hit on file with ID \'%s\'.' % fileStoreID)
+                self._recordCacheAccess(fileStoreID, self.encodedFileID(fileStoreID))
+                fileSize = os.stat(self.encodedFileID(fileStoreID)).st_size
+                self._countCacheMetrics(hits=1, bytesFromCache=fileSize)
+                self._traceCacheLookup(fileStoreID, fileSize)
+                return open(self.encodedFileID(fileStoreID), 'r')
+            else:
+                logger.info('CACHE: Cache miss on file with ID \'%s\'.' % fileStoreID)
+                self._countCacheMetrics(misses=1)
+                return self._readGlobalFileStreamToCache(fileStoreID)
+
+        @contextmanager
+        def _readGlobalFileStreamToCache(self, fileStoreID):
+            """
+            Streams a file from the job store, copying it into the cache if the stream is read to
+            the end. Like readGlobalFile, the download is announced with a harbinger. If another
+            job is downloading the file already, the file is streamed without being cached. The
+            harbinger is marked as belonging to a stream, which may be read for arbitrarily long,
+            so readGlobalFile downloads the file meanwhile instead of waiting for the stream.
+            """
+            cachedFileName = self.encodedFileID(fileStoreID)
+            partialFileName = '/.'.join(os.path.split(cachedFileName))
+            harbingerFileName = self._harbingerFileName(cachedFileName)
+            harbinger = None
+            with self.cacheLock():
+                # If the cached copies are links to the files in the job store, readGlobalFile
+                # caches the file without copying it.
+                if not (self.nlinkThreshold == 2 or os.path.exists(harbingerFileName) or
+                            self._fileIsCached(fileStoreID)):
+                    harbinger = open(harbingerFileName, 'w')
+                    flock(harbinger, LOCK_EX)
+                    harbinger.write(self._streamHarbingerMarker)
+                    harbinger.flush()
+            if harbinger is None:
+                with self.jobStore.readFileStream(fileStoreID) as stream:
+                    yield stream
+                return
+            tee = None
+            try:
+                with self.jobStore.readFileStream(fileStoreID) as stream:
+                    tee = self._TeeStream(stream, partialFileName, self._reserveCacheSpace)
+                    try:
+                        yield tee
+                    finally:
+                        copied = tee.closeCopy()
+                    complete = copied and not stream.read(1)
+                self._countCacheMetrics(bytesDownloaded=tee.size)
+                self._traceCacheLookup(fileStoreID, tee.size)
+                if complete:
+                    self._addStreamToCache(fileStoreID, partialFileName, tee.reserved)
+                    tee = None
+            finally:
+                if tee is not None:
+                    self._releaseCacheSpace(tee.reserved)
+                if os.path.exists(partialFileName):
+                    os.remove(partialFileName)
+                with self.cacheLock():
+                    os.remove(harbingerFileName)
+                    harbinger.close()
+
+        @contextmanager
+        def writeGlobalFileStream(self, cleanup=False):
+            """
+            Similar to writeGlobalFile, but allows the writing of a stream to the job store. The
+            written data is also copied into the cache.
+
+            :param Boolean cleanup: is as in :func:`toil.job.Job.FileStore.writeGlobalFile`.
+
+            :returns: a context manager yielding a tuple of 1) a file handle which \
+            can be written to and 2) the ID of the resulting file in the job store. \
+            The yielded file handle does not need to and should not be closed explicitly.
+            """
+            cleanupID = None if not cleanup else self.jobWrapper.jobStoreID
+            tee = None
+            try:
+                with self.jobStore.writeFileStream(cleanupID) as (stream, fileStoreID):
+                    if self.nlinkThreshold == 2:
+                        # The file will be linked from the job store when it is read
+                        yield stream, fileStoreID
+                        return
+                    partialFileName = '/.'.join(os.path.split(self.encodedFileID(fileStoreID)))
+                    tee = self._TeeStream(stream, partialFileName, self._reserveCacheSpace)
+                    try:
+                        yield tee, fileStoreID
+                    finally:
+                        copied = tee.closeCopy()
+                if copied:
+                    self._addStreamToCache(fileStoreID, partialFileName, tee.reserved)
+                    tee = None
+            finally:
+                if tee is not None:
+                    self._releaseCacheSpace(tee.reserved)
+                    if os.path.exists(partialFileName):
+                        os.remove(partialFileName)
+
+        def _reserveCacheSpace(self, numBytes):
+            """
+            Reserves space in the caching equation for the copy of a streamed file that is made in
+            the cache directory. The space is charged to the job, so that it is returned along with
+            the job's requirements if the job dies.
+
+            :param int numBytes: the number of bytes to reserve
+            :return: True if the space was reserved, False if that would unbalance the equation
+            :rtype: bool
+            """
+            with self.cacheLock():
+                with self._CacheState.transaction(self.cacheStateFile) as cacheInfo:
+                    cacheInfo.sigmaJob += numBytes
+                    if not cacheInfo.isBalanced():
+                        cacheInfo.sigmaJob -= numBytes
+                        return False
+                    cacheInfo.jobState(self.hashedJobCommand).updateJobReqs(numBytes, 'remove')
+            return True
+
+        def _releaseCacheSpace(self, numBytes):
+            """
+            Releases space reserved with _reserveCacheSpace.
+
+            :param int numBytes: the number of bytes to release
+            """
+            if numBytes:
+                with self.cacheLock():
+                    with self._CacheState.transaction(self.cacheStateFile) as cacheInfo:
+                        cacheInfo.sigmaJob -= numBytes
+                        cacheInfo.jobState(self.hashedJobCommand).updateJobReqs(numBytes, 'add')
+
+        def _addStreamToCache(self, fileStoreID, partialFileName, reserved):
+            """
+            Adds the complete copy of a streamed file to the cache, trading the space reserved for
+            the copy for the space taken by the cached file. Since no job has a local copy of the
+            file, it can be evicted right away.
+
+            :param str fileStoreID: job store id for the file
+            :param str partialFileName: path to the copy of the file in the cache directory
+            :param int reserved: the number of bytes reserved for the copy with _reserveCacheSpace
+            """
+            cachedFileName = self.encodedFileID(fileStoreID)
+            fileSize = os.stat(partialFileName).st_size
+            assert fileSize <= reserved
+            with self.cacheLock():
+                with self._CacheState.transaction(self.cacheStateFile) as cacheInfo:
+                    cacheInfo.sigmaJob -= reserved
+                    cacheInfo.jobState(self.hashedJobCommand).updateJobReqs(reserved, 'add')
+                    cacheInfo.cached += fileSize
+                    os.chmod(partialFileName, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    os.rename(partialFileName, cachedFileName)
+                    cacheInfo.recordAccess(fileStoreID, fileSize, self.evictionPolicy)
+            logger.info('CACHE: Added file with ID \'%s\' to the cache.' % fileStoreID)
+
+        def deleteLocalFile(self, fileStoreID):
+            '''
+            Deletes a local file with the given job store ID.
+            :param str fileStoreID: File Store ID of the file to be deleted.
+            :return: None
             '''
             # The local file may or may not have been cached. If it was, we need to do some
             # bookkeeping. If it wasn't, we just delete the file and continue with no might need
@@ -1261,26 +2282,21 @@ class Job(object):
             # dict item having key = fileStoreID. If it was cached, it holds the value True else
             # False.
             with self._CacheState.open(self) as cacheInfo:
-                jobState = self._JobState(cacheInfo.jobState[self.hashedJobCommand])
-                assert fileStoreID in jobState.jobSpecificFiles.keys(), 'Attempting to delete ' + \
-                    'a non-local file'
-                # filesToDelete is a dictionary of file: fileSize
-                filesToDelete = jobState.jobSpecificFiles[fileStoreID]
-                allOwnedFiles = jobState.filesToFSIDs
-                for (fileToDelete, fileSize) in filesToDelete.items():
+                jobState = cacheInfo.jobState(self.hashedJobCommand)
+                # filesToDelete is a list of (file, fileSize) tuples
+                filesToDelete = jobState.getFiles(fileStoreID)
+                assert filesToDelete, 'Attempting to delete a non-local file'
+                for (fileToDelete, fileSize) in filesToDelete:
                     # Handle the case where a file not in the local temp dir was written to
                     # filestore
                     if fileToDelete is None:
-                        filesToDelete.pop(fileToDelete)
-                        allOwnedFiles[fileToDelete].remove(fileStoreID)
-                        cacheInfo.jobState[self.hashedJobCommand] = jobState.__dict__
-                        cacheInfo.write(self.cacheStateFile)
+                        jobState.removeFile(fileStoreID, fileToDelete)
                         continue
                     # If the file size is zero (copied into the local temp dir) or -1 (mutable), we
                     # can safely delete without any bookkeeping
                     if fileSize in (0, -1):
                         # Only remove the file if there is only one FSID associated with it.
-                        if len(allOwnedFiles[fileToDelete]) == 1:
+                        if jobState.countFileStoreIDs(fileToDelete) == 1:
                             try:
                                 os.remove(fileToDelete)
                             except OSError as err:
@@ -1291,10 +2307,7 @@ class Job(object):
                                     raise CacheError('Illegal operation detected. Cache tracked'
                                                      'file deleted explicitly by user. Use'
                                                      'deleteLocalFile to delete such files.')
-                        allOwnedFiles[fileToDelete].remove(fileStoreID)
-                        filesToDelete.pop(fileToDelete)
-                        cacheInfo.jobState[self.hashedJobCommand] = jobState.__dict__
-                        cacheInfo.write(self.cacheStateFile)
+                        jobState.removeFile(fileStoreID, fileToDelete)
                         continue
                     # If not, we need to do bookkeeping
                     # Get the size of the file to be deleted, and the number of jobs using the file
@@ -1308,13 +2321,11 @@ class Job(object):
                         logger.warn("the size on record differed from the real size by " +
                                     "%s bytes" % str(fileSize-fileStats.st_size))
                     # Remove the file and return file size to the job
-                    if len(allOwnedFiles[fileToDelete]) == 1:
+                    if jobState.countFileStoreIDs(fileToDelete) == 1:
                         os.remove(fileToDelete)
                     cacheInfo.sigmaJob += fileSize
-                    filesToDelete.pop(fileToDelete)
-                    allOwnedFiles[fileToDelete].remove(fileStoreID)
+                    jobState.removeFile(fileStoreID, fileToDelete)
                     jobState.updateJobReqs(fileSize, 'remove')
-                    cacheInfo.jobState[self.hashedJobCommand] = jobState.__dict__
                 # If the job is not in the process of cleaning up, then we may need to remove the
                 # cached copy of the file as well.
                 if not self.cleanupInProgress:
@@ -1327,6 +2338,7 @@ class Job(object):
                         if not cacheInfo.isBalanced() and jobsUsingFile == self.nlinkThreshold:
                             os.remove(cachedFile)
                             cacheInfo.cached -= fileSize
+                            cacheInfo.removeAccesses(fileStoreID)
                     self.logToMaster('Successfully deleted cached copy of file with ID '
                                      '\'%s\'.' % fileStoreID)
                 self.logToMaster('Successfully deleted local copies of file with ID '
@@ -1341,9 +2353,9 @@ class Job(object):
 
             :param fileStoreID: the job store ID of the file to be deleted.
             """
-            with self._CacheState.open(self) as cacheInfo:
-                jobState = self._JobState(cacheInfo.jobState[self.hashedJobCommand])
-            if fileStoreID in jobState.jobSpecificFiles.keys():
+            with self._CacheState.transaction(self.cacheStateFile, readOnly=True) as cacheInfo:
+                fileIsLocal = cacheInfo.jobState(self.hashedJobCommand).hasFileStoreID(fileStoreID)
+            if fileIsLocal:
                 # Use deleteLocalFile in the backend to delete the local copy of the file.
                 self.deleteLocalFile(fileStoreID)
                 # At this point, the local file has been deleted, and possibly the cached copy. If
@@ -1371,16 +2383,42 @@ class Job(object):
             '''
             cacheLockFile = open(self.cacheLockFile, 'w')
             try:
-                flock(cacheLockFile, LOCK_EX)
+                self._lockCache(cacheLockFile)
                 logger.debug("CACHE: Obtained lock on file %s" % self.cacheLockFile)
                 yield cacheLockFile
             except IOError:
                 logger.critical('CACHE: Unable to acquire lock on %s' % self.cacheLockFile)
                 raise
             finally:
+                self._stopCacheLockTimer()
                 cacheLockFile.close()
                 logger.debug("CACHE: Released lock")
 
+        def _lockCache(self, lockFileHandle):
+            """
+            Acquires the cache lock on the given handle to the cache lock file, which cacheLock()
+            yields, after it was released with _unlockCache().
+            """
+            flock(lockFileHandle, LOCK_EX)
+            self._cacheLockTimer.lockedAt = time.time()
+
+        def _unlockCache(self, lockFileHandle):
+            """
+            Releases the cache lock on the given handle to the cache lock file, see _lockCache().
+            """
+            self._stopCacheLockTimer()
+            flock(lockFileHandle, LOCK_UN)
+
+        def _stopCacheLockTimer(self):
+            """
+            Adds the time since the current thread acquired the cache lock to the lock time in
+            cacheMetrics, if it holds the lock.
+            """
+            lockedAt = getattr(self._cacheLockTimer, 'lockedAt', None)
+            if lockedAt is not None:
+                self._cacheLockTimer.lockedAt = None
+                self._countCacheMetrics(lockTime=time.time() - lockedAt)
+
         def _setupCache(self):
             '''
             Setup the cache based on the provided values for localCacheDir.
@@ -1443,15 +2481,15 @@ class Job(object):
             personalCacheStateFile = os.path.join(tempCacheDir,
                                                   os.path.basename(self.cacheStateFile))
             # Setup the initial values for the cache state file in a dict
-            cacheInfo = self._CacheState({
+            self._CacheState.create(personalCacheStateFile, {
                 'nlink': self.nlinkThreshold,
                 'attemptNumber': self.workflowAttemptNumber,
                 'total': freeSpace,
                 'cached': 0,
                 'sigmaJob': 0,
+                'trashed': 0,
                 'cacheDir': self.localCacheDir,
-                'jobState': collections.defaultdict(int)})
-            cacheInfo.write(personalCacheStateFile)
+                'inflation': 0.0})
 
         def encodedFileID(self, JobStoreFileID):
             '''
@@ -1472,6 +2510,12 @@ class Job(object):
             '''
             return os.path.exists(self.encodedFileID(jobStoreFileID))
 
+        def _cachedFilePath(self, fileStoreID):
+            """
+            See Job.FileStore._cachedFilePath.
+            """
+            return self.encodedFileID(fileStoreID) if self._fileIsCached(fileStoreID) else None
+
         def decodedFileID(self, cachedFilePath):
             '''
             Decode a cached fileName back to a job store file ID.
@@ -1518,23 +2562,23 @@ class Job(object):
                     raise CacheInvalidSrcError('Attempting a cache operation on a non-local file '
                                                '%s.' % localFilePath)
                 if callingFunc == 'read' and mutable:
-                    shutil.copyfile(cachedFile, localFilePath)
+                    copyFile(cachedFile, localFilePath)
                     fileSize = os.stat(cachedFile).st_size
-                    cacheInfo = self._CacheState._load(self.cacheStateFile)
-                    cacheInfo.cached += fileSize if cacheInfo.nlink != 2 else 0
-                    if not cacheInfo.isBalanced():
-                        os.remove(cachedFile)
-                        cacheInfo.cached -= fileSize if cacheInfo.nlink != 2 else 0
-                        logger.debug('Could not download both download ' +
-                                     '%s as mutable and add to ' % os.path.basename(localFilePath) +
-                                     'cache. Hence only mutable copy retained.')
-                    else:
-                        logger.info('CACHE: Added file with ID \'%s\' to the cache.' %
-                                     jobStoreFileID)
-                    jobState = self._JobState(cacheInfo.jobState[self.hashedJobCommand])
-                    jobState.addToJobSpecFiles(jobStoreFileID, localFilePath, -1, False)
-                    cacheInfo.jobState[self.hashedJobCommand] = jobState.__dict__
-                    cacheInfo.write(self.cacheStateFile)
+                    with self._CacheState.transaction(self.cacheStateFile) as cacheInfo:
+                        cacheInfo.cached += fileSize if cacheInfo.nlink != 2 else 0
+                        if not cacheInfo.isBalanced():
+                            os.remove(cachedFile)
+                            cacheInfo.cached -= fileSize if cacheInfo.nlink != 2 else 0
+                            logger.debug('Could not download both download ' +
+                                         '%s as mutable and add to ' %
+                                         os.path.basename(localFilePath) +
+                                         'cache. Hence only mutable copy retained.')
+                        else:
+                            logger.info('CACHE: Added file with ID \'%s\' to the cache.' %
+                                        jobStoreFileID)
+                            cacheInfo.recordAccess(jobStoreFileID, fileSize, self.evictionPolicy)
+                        jobState = cacheInfo.jobState(self.hashedJobCommand)
+                        jobState.addToJobSpecFiles(jobStoreFileID, localFilePath, -1, False)
                 else:
                     # There are two possibilities, read and immutable, and write. both cases do
                     # almost the same thing except for the direction of the os.link hence we're
@@ -1588,21 +2632,29 @@ class Job(object):
             :return: None
             '''
             fileSize = os.stat(cachedFileSource).st_size
-            cacheInfo = self._CacheState._load(self.cacheStateFile)
-            # If the file isn't cached, add the size of the file to the cache pool. However, if the
-            # nlink threshold is not 1 -  i.e. it is 2 (it can only be 1 or 2), then don't do this
-            # since the size of the file is accounted for by the file store copy.
-            if not fileAlreadyCached and self.nlinkThreshold == 1:
-                cacheInfo.cached += fileSize
-            cacheInfo.sigmaJob -= fileSize
-            if not cacheInfo.isBalanced():
-                self.logToMaster('CACHE: The cache was not balanced on returning file size',
-                                 logging.WARN)
-            # Add the info to the job specific cache info
-            jobState = self._JobState(cacheInfo.jobState[self.hashedJobCommand])
-            jobState.addToJobSpecFiles(fileStoreID, cachedFileSource, fileSize, True)
-            cacheInfo.jobState[self.hashedJobCommand] = jobState.__dict__
-            cacheInfo.write(self.cacheStateFile)
+            with self._CacheState.transaction(self.cacheStateFile) as cacheInfo:
+                # If the file isn't cached, add the size of the file to the cache pool. However, if
+                # the nlink threshold is not 1 -  i.e. it is 2 (it can only be 1 or 2), then don't
+                # do this since the size of the file is accounted for by the file store copy.
+                if not fileAlreadyCached and self.nlinkThreshold == 1:
+                    cacheInfo.cached += fileSize
+                cacheInfo.sigmaJob -= fileSize
+                if not cacheInfo.isBalanced():
+                    self.logToMaster('CACHE: The cache was not balanced on returning file size',
+                                     logging.WARN)
+                cacheInfo.recordAccess(fileStoreID, fileSize, self.evictionPolicy)
+                # Add the info to the job specific cache info
+                jobState = cacheInfo.jobState(self.hashedJobCommand)
+                jobState.addToJobSpecFiles(fileStoreID, cachedFileSource, fileSize, True)
+
+        def _recordCacheAccess(self, fileStoreID, cachedFilePath):
+            """
+            Records an access to the cached copy of a file for the eviction policy. See
+            Job.FileStore._recordCacheAccess.
+            """
+            with self._CacheState.transaction(self.cacheStateFile) as cacheInfo:
+                cacheInfo.recordAccess(fileStoreID, os.stat(cachedFilePath).st_size,
+                                       self.evictionPolicy)
 
         @staticmethod
         def _isHidden(filePath):
@@ -1631,16 +2683,10 @@ class Job(object):
             with self._CacheState.open(self) as cacheInfo:
                 # Add the new job's disk requirements to the sigmaJobDisk variable
                 cacheInfo.sigmaJob += newJobReqs
-                # Initialize the job state here. we use a partial in the jobSpecificFiles call so
-                # that this entire thing is pickleable. Based on answer by user Nathaniel Gentile at
-                # http://stackoverflow.com/questions/2600790
-                assert not cacheInfo.jobState[self.hashedJobCommand]
-                cacheInfo.jobState[self.hashedJobCommand] = {
-                    'jobReqs': newJobReqs,
-                    'jobDir': self.localTempDir,
-                    'jobSpecificFiles': collections.defaultdict(partial(collections.defaultdict,
-                                                                        int)),
-                    'filesToFSIDs': collections.defaultdict(set)}
+                # Initialize the job state here.
+                jobState = cacheInfo.jobState(self.hashedJobCommand)
+                assert not jobState.exists()
+                jobState.create(newJobReqs, self.localTempDir)
                 # If the caching equation is balanced, do nothing.
                 if cacheInfo.isBalanced():
                     return None
@@ -1652,28 +2698,37 @@ class Job(object):
                                  for x in os.listdir(self.localCacheDir)
                                  if not self._isHidden(x)]
                 allCacheFiles = [(path, os.stat(path)) for path in allCacheFiles]
-                #TODO mtime vs ctime
-                deletableCacheFiles = {(path, inode.st_mtime, inode.st_size)
+                deletableCacheFiles = {self.decodedFileID(path): inode
                                        for path, inode in allCacheFiles
                                        if inode.st_nlink == self.nlinkThreshold}
-
-                # Sort in descending order of mtime so the first items to be popped from the list
-                # are the least recently created.
-                deletableCacheFiles = sorted(deletableCacheFiles, key=lambda x: (-x[1], -x[2]))
+                accessRecords = cacheInfo.accessRecords()
+                # Files cached by an older version of Toil weren't tracked
+                accessRecords = {
+                    fileStoreID: accessRecords.get(fileStoreID) or
+                                 self.evictionPolicy.access(None, inode.st_size, inode.st_mtime,
+                                                            cacheInfo.inflation)
+                    for fileStoreID, inode in deletableCacheFiles.iteritems()}
                 logger.debug('CACHE: Need %s bytes for new job. Have %s' %
                              (newJobReqs, cacheInfo.cached + cacheInfo.sigmaJob - newJobReqs))
                 logger.debug('CACHE: Evicting files to make room for the new job.')
 
-                # Now do the actual file removal
-                while not cacheInfo.isBalanced() and len(deletableCacheFiles) > 0:
-                    cachedFile, fileCreateTime, cachedFileSize = deletableCacheFiles.pop()
+                # Now do the actual file removal, in the order chosen by the eviction policy
+                for fileStoreID in self.evictionPolicy.evictionOrder(accessRecords):
+                    if cacheInfo.isBalanced():
+                        break
+                    cachedFile = self.encodedFileID(fileStoreID)
+                    cachedFileSize = deletableCacheFiles[fileStoreID].st_size
                     os.remove(cachedFile)
                     cacheInfo.cached -= cachedFileSize if self.nlinkThreshold != 2 else 0
                     assert cacheInfo.cached >= 0
+                    cacheInfo.removeAccesses(fileStoreID)
+                    cacheInfo.inflation = self.evictionPolicy.inflate(
+                        cacheInfo.inflation, accessRecords[fileStoreID].priority)
+                    self._countCacheMetrics(evictions=1, bytesEvicted=cachedFileSize)
                     # self.logToMaster('CACHE: Evicted  file with ID \'%s\' (%s bytes)' %
                     #                  (self.decodedFileID(cachedFile), cachedFileSize))
                     logger.debug('CACHE: Evicted  file with ID \'%s\' (%s bytes)' %
-                                 (self.decodedFileID(cachedFile), cachedFileSize))
+                                 (fileStoreID, cachedFileSize))
                 assert cacheInfo.isBalanced(), 'Unable to free up enough space for caching.'
                 logger.debug('CACHE: After Evictions, ended up with %s.' %
                              (cacheInfo.cached + cacheInfo.sigmaJob))
@@ -1696,6 +2751,7 @@ class Job(object):
                 os.remove(cachedFile)
                 if self.nlinkThreshold != 2:
                     cacheInfo.cached -= cachedFileStats.st_size
+                cacheInfo.removeAccesses(fileStoreID)
                 if not cacheInfo.isBalanced():
                     self.logToMaster('CACHE: The cache was not balanced on removing single file',
                                      logging.WARN)
@@ -1722,15 +2778,58 @@ class Job(object):
             '''
             # Since we are only reading this job's specific values from the state file, we don't
             # need a lock
-            jobState = self._JobState(self._CacheState._load(self.cacheStateFile
-                                                             ).jobState[self.hashedJobCommand])
-            for x in jobState.jobSpecificFiles.keys():
+            with self._CacheState.transaction(self.cacheStateFile, readOnly=True) as cacheInfo:
+                fileStoreIDs = cacheInfo.jobState(self.hashedJobCommand).fileStoreIDs()
+            for x in fileStoreIDs:
                 self.deleteLocalFile(x)
-            with self._CacheState.open(self) as cacheInfo:
+            # Nor to update the bookkeeping
+            with self._CacheState.transaction(self.cacheStateFile) as cacheInfo:
                 cacheInfo.sigmaJob -= jobReqs
-                cacheInfo.jobState.pop(self.hashedJobCommand)
+                cacheInfo.jobState(self.hashedJobCommand).remove()
                 #assert cacheInfo.isBalanced() # commenting this out for now. God speed
 
+        @classmethod
+        def _accountForTrash(cls, workflowDir, workflowID, trashedDir, size):
+            """
+            Worker directories awaiting deletion in the trash still occupy disk space, so their
+            sizes are counted against the space available for caching until they are deleted.
+            See Job.FileStore._accountForTrash.
+            """
+            cacheDir = os.path.join(workflowDir, cacheDirName(workflowID))
+            cacheStateFile = os.path.join(cacheDir, '_cacheState.db')
+            if not os.path.exists(cacheStateFile):
+                return  # No cache was set up on this node
+            with cls._CacheState.transaction(cacheStateFile) as cacheInfo:
+                # A reaper deleting the directory records that after the directory is gone, so
+                # checking for the directory within the transaction orders the two updates.
+                if size is None or os.path.exists(trashedDir):
+                    cacheInfo.setTrash(trashedDir, size)
+
+        @classmethod
+        def moveToNodeCache(cls, workflowDir, workflowID, nodeCacheDir, nodeCacheSize):
+            """
+            Moves the files in the cache of the given workflow on this node whose digests are known
+            to the node cache, where they can be found by later workflows. Must only be called
+            after the last job of the workflow on this node has finished, and before the workflow
+            directory is deleted.
+
+            :param str workflowDir: the workflow directory on this node
+            :param str workflowID: the ID of the workflow
+            :param str nodeCacheDir: the directory of the node cache
+            :param int nodeCacheSize: the maximum size of the node cache in bytes
+            """
+            cacheDir = os.path.join(workflowDir, cacheDirName(workflowID))
+            cacheStateFile = os.path.join(cacheDir, '_cacheState.db')
+            if not os.path.exists(cacheStateFile):
+                return  # No cache was set up on this node
+            with cls._CacheState.transaction(cacheStateFile, readOnly=True) as cacheInfo:
+                digests = cacheInfo.digests()
+            nodeCache = cls._NodeCache(nodeCacheDir, nodeCacheSize)
+            for fileStoreID, digest in digests:
+                # Files that were deleted or evicted from the cache are skipped by put()
+                nodeCache.put(digest, os.path.join(cacheDir, base64.urlsafe_b64encode(fileStoreID)))
+            nodeCache.evict()
+
         def _abspath(self, key):
             """
             Return the absolute path to key.  This is a wrapepr for os.path.abspath because mac OS
@@ -1747,63 +2846,252 @@ class Job(object):
 
         class _CacheState(object):
             '''
-            Utility class to read and write the cache lock file. Also for checking whether the
-            caching equation is balanced or not.
+            Utility class to read and write the cache state database. Also for checking whether
+            the caching equation is balanced or not.
+
+            The state of the cache is kept in a SQLite database in WAL mode. The values of the
+            caching equation are rows of the state table, the worker directories in the trash are
+            rows of the trash table and the state of each job is kept in the jobs and jobFiles
+            tables, see _JobState. The digests table holds the digests of the downloaded files
+            that are to be moved to the node cache, see moveToNodeCache, and the accesses table
+            tracks the accesses to the cached files for the eviction policy, see
+            toil.cachePolicies. Every operation only reads and writes the rows it needs in a
+            short transaction, and readers never wait for writers.
             '''
-            def __init__(self, stateDict):
-                # Should i assert the dictionary contains the required elements? This class is
-                # instantiated often {nlink, attemptNumber, total, cached, sigmaJob}
+            # The names of the rows in the state table, which become attributes of instances
+            _stateNames = ('nlink', 'attemptNumber', 'total', 'cached', 'sigmaJob', 'trashed',
+                           'cacheDir', 'inflation')
+
+            _schema = ('CREATE TABLE state (name TEXT PRIMARY KEY, value)',
+                       'CREATE TABLE trash (dir TEXT PRIMARY KEY, size)',
+                       'CREATE TABLE jobs (job TEXT PRIMARY KEY, jobReqs, jobDir TEXT)',
+                       'CREATE TABLE jobFiles (job TEXT, fileStoreID TEXT, filePath TEXT, '
+                       'fileSize)',
+                       'CREATE INDEX jobFilesByID ON jobFiles (job, fileStoreID)',
+                       'CREATE INDEX jobFilesByPath ON jobFiles (job, filePath)',
+                       'CREATE TABLE digests (fileStoreID TEXT PRIMARY KEY, digest TEXT)',
+                       'CREATE TABLE accesses (fileStoreID TEXT PRIMARY KEY, size, lastAccess, '
+                       'accessCount, priority)')
+
+            def __init__(self, stateDict, connection=None):
                 assert isinstance(stateDict, dict)
                 self.__dict__.update(stateDict)
+                # The values as they were read, so that only the changed values are written
+                self._readState = dict(stateDict)
+                # The connection of the transaction this instance was read in, if any
+                self._connection = connection
+
+            @staticmethod
+            def _connect(fileName):
+                '''
+                Opens a connection to the cache state database in the given file.
+                :param str fileName: Path to the cache state file
+                :rtype: sqlite3.Connection
+                '''
+                # Transactions are started explicitly, see _transaction. Workers wait for each
+                # other's transactions rather than fail, like they used to wait for the lock.
+                connection = sqlite3.connect(fileName, timeout=3600, isolation_level=None)
+                connection.text_factory = str
+                # In WAL mode this only loses transactions if the node itself crashes, in which
+                # case the cache is lost anyway.
+                connection.execute('PRAGMA synchronous=NORMAL')
+                return connection
+
+            @staticmethod
+            @contextmanager
+            def _transaction(connection, readOnly=False):
+                '''
+                Runs the body of the context in a transaction on the given connection.
+                :param bool readOnly: If False, the write lock on the database is taken up front,
+                       so that concurrent transactions never need to upgrade their locks.
+                '''
+                connection.execute('BEGIN' if readOnly else 'BEGIN IMMEDIATE')
+                try:
+                    yield
+                except:
+                    connection.execute('ROLLBACK')
+                    raise
+                else:
+                    connection.execute('COMMIT')
+
+            @classmethod
+            def create(cls, fileName, stateDict):
+                '''
+                Create the cache state database in the given file with the given initial values.
+                :param str fileName: Path to the cache state file
+                :param dict stateDict: The initial values, keyed by the names in _stateNames
+                '''
+                connection = cls._connect(fileName)
+                try:
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    with cls._transaction(connection):
+                        for statement in cls._schema:
+                            connection.execute(statement)
+                        connection.executemany('INSERT INTO state VALUES (?, ?)',
+                                               [(name, stateDict[name])
+                                                for name in cls._stateNames])
+                finally:
+                    connection.close()
+
+            @classmethod
+            @contextmanager
+            def transaction(cls, fileName, readOnly=False):
+                '''
+                This is a context manager that reads the state of the cache in a transaction and
+                yields it to the user. The values of the caching equation that were changed are
+                written when the context is left. Unlike open, this does not acquire the cache
+                lock, so it must only be used for bookkeeping, or by a caller that holds the lock.
+                :param str fileName: Path to the cache state file
+                :param bool readOnly: Is the state only read(T) or also modified(F)?
+                '''
+                connection = cls._connect(fileName)
+                try:
+                    with cls._transaction(connection, readOnly):
+                        cacheInfo = cls._read(connection)
+                        yield cacheInfo
+                        if not readOnly:
+                            cacheInfo._write(connection)
+                finally:
+                    connection.close()
 
             @classmethod
             @contextmanager
             def open(cls, outer):
                 '''
-                This is a context manager that basically opens the cache state file and reads it
-                into an object that is returned to the user in the yield
+                This is a context manager that acquires the cache lock and reads the state of the
+                cache into an object that is returned to the user in the yield. The lock must be
+                held by operations that modify the cache directory.
                 :param outer: instance of the CachedFileStore class (to use the cachelock method)
                 '''
                 with outer.cacheLock():
-                    cacheInfo = cls._load(outer.cacheStateFile)
-                    yield cacheInfo
-                    cacheInfo.write(outer.cacheStateFile)
+                    with cls.transaction(outer.cacheStateFile) as cacheInfo:
+                        yield cacheInfo
+
+            @classmethod
+            def _read(cls, connection):
+                return cls(dict(connection.execute('SELECT name, value FROM state')), connection)
+
+            def _write(self, connection):
+                connection.executemany('UPDATE state SET value = ? WHERE name = ?',
+                                       [(getattr(self, name), name) for name in self._stateNames
+                                        if getattr(self, name) != self._readState[name]])
+                self._readState.update((name, getattr(self, name)) for name in self._stateNames)
 
             @classmethod
             def _load(cls, fileName):
                 '''
-                Load the state of the cache from the cache state file (via the file handle provided)
+                Load the values of the caching equation from the cache state file.
                 :param str fileName: Path to the cache state file
                 '''
-                # Read the value from the cache state file then initialize and instance of
-                # _CacheState with it.
-                with open(fileName, 'r') as fH:
-                    cacheInfoDict = cPickle.load(fH)
-                return cls(cacheInfoDict)
+                connection = cls._connect(fileName)
+                try:
+                    return cls(dict(connection.execute('SELECT name, value FROM state')))
+                finally:
+                    connection.close()
 
             def write(self, fileName):
                 '''
-                Write the current state of the cache into a temporary file then atomically rename it
-                to the main cache state file.
+                Write the values of the caching equation that were changed since they were loaded
+                to the cache state file.
                 :param str fileName: Path to the cache state file
                 :return:
                 '''
-                with open(fileName + '.tmp', 'w') as fH:
-                    # Based on answer by user "Mark" at:
-                    # http://stackoverflow.com/questions/2709800/how-to-pickle-yourself
-                    # We can't pickle nested classes. So we have to pickle the variables of the class
-                    cPickle.dump(self.__dict__, fH, cPickle.HIGHEST_PROTOCOL)
-                os.rename(fileName + '.tmp', fileName)
+                connection = self._connect(fileName)
+                try:
+                    with self._transaction(connection):
+                        self._write(connection)
+                finally:
+                    connection.close()
+
+            def jobState(self, jobID):
+                '''
+                :param str jobID: The hashed command of a job
+                :return: The state of the job in the transaction this instance was read in.
+                :rtype: Job.CachedFileStore._JobState
+                '''
+                assert self._connection is not None
+                return Job.CachedFileStore._JobState(self._connection, jobID)
+
+            def setTrash(self, trashedDir, size):
+                '''
+                Record the size of a worker directory in the trash.
+                :param str trashedDir: Path to the directory
+                :param int size: The size of the directory in bytes, or None if it was deleted
+                '''
+                assert self._connection is not None
+                row = self._connection.execute('SELECT size FROM trash WHERE dir = ?',
+                                               (trashedDir,)).fetchone()
+                if row is not None:
+                    self.trashed -= row[0]
+                if size is None:
+                    self._connection.execute('DELETE FROM trash WHERE dir = ?', (trashedDir,))
+                else:
+                    self._connection.execute('INSERT OR REPLACE INTO trash VALUES (?, ?)',
+                                             (trashedDir, size))
+                    self.trashed += size
+
+            def setDigest(self, fileStoreID, digest):
+                '''
+                Record the digest of the contents of a file, see AbstractJobStore.getFileDigest.
+                :param str fileStoreID: job store id for the file
+                :param str digest: The digest of the file
+                '''
+                assert self._connection is not None
+                self._connection.execute('INSERT OR REPLACE INTO digests VALUES (?, ?)',
+                                         (fileStoreID, digest))
+
+            def digests(self):
+                '''
+                :return: The job store ids and digests of the files recorded with setDigest
+                :rtype: list[(str, str)]
+                '''
+                assert self._connection is not None
+                return self._connection.execute('SELECT fileStoreID, digest FROM digests').fetchall()
+
+            def recordAccess(self, fileStoreID, fileSize, policy):
+                '''
+                Record an access to a cached file.
+                :param str fileStoreID: job store id for the file
+                :param int fileSize: The size of the file
+                :param toil.cachePolicies.EvictionPolicy policy: The eviction policy of the cache
+                '''
+                assert self._connection is not None
+                row = self._connection.execute('SELECT size, lastAccess, accessCount, priority '
+                                               'FROM accesses WHERE fileStoreID = ?',
+                                               (fileStoreID,)).fetchone()
+                record = policy.access(None if row is None else AccessRecord(*row), fileSize,
+                                       time.time(), self.inflation)
+                self._connection.execute('INSERT OR REPLACE INTO accesses VALUES (?, ?, ?, ?, ?)',
+                                         (fileStoreID,) + record)
+
+            def removeAccesses(self, fileStoreID):
+                '''
+                Forget the accesses to a file that was removed from the cache.
+                :param str fileStoreID: job store id for the file
+                '''
+                assert self._connection is not None
+                self._connection.execute('DELETE FROM accesses WHERE fileStoreID = ?',
+                                         (fileStoreID,))
+
+            def accessRecords(self):
+                '''
+                :return: The accesses to the cached files, keyed by their job store ids
+                :rtype: dict[str, toil.cachePolicies.AccessRecord]
+                '''
+                assert self._connection is not None
+                return {row[0]: AccessRecord(*row[1:]) for row in self._connection.execute(
+                    'SELECT fileStoreID, size, lastAccess, accessCount, priority FROM accesses')}
 
             def isBalanced(self):
                 '''
                 Checks for the inequality of the caching equation, i.e.
-                                cachedSpace + sigmaJobDisk <= totalFreeSpace
-                Essentially, the sum of all cached file + disk requirements of all running jobs
-                should always be less than the available space on the system
+                                cachedSpace + sigmaJobDisk + trashedSpace <= totalFreeSpace
+                Essentially, the sum of all cached file + disk requirements of all running jobs +
+                worker directories awaiting deletion should always be less than the available
+                space on the system
                 :return: Boolean for equation is balanced (T) or not (F)
                 '''
-                return self.cached + self.sigmaJob <= self.total
+                return self.cached + self.sigmaJob + self.trashed <= self.total
 
             def purgeRequired(self, jobReqs):
                 '''
@@ -1826,25 +3114,97 @@ class Job(object):
             '''
             fileStats = os.stat(localFilePath)
             assert fileStats.st_nlink >= self.nlinkThreshold
-            with self._CacheState.open(self) as cacheInfo:
+            with self._CacheState.transaction(self.cacheStateFile) as cacheInfo:
                 cacheInfo.sigmaJob -= fileStats.st_size
-                jobState = self._JobState(cacheInfo.jobState[self.hashedJobCommand])
-                jobState.updateJobReqs(fileStats.st_size, 'remove')
 
         class _JobState(object):
             '''
             This is a utility class to handle the state of a job in terms of it's current disk
             requirements, working directory, and job specific files.
+
+            The state is kept in the cache state database, see _CacheState. The job is a row of the
+            jobs table and each local copy of a file the job read or wrote is a row of the jobFiles
+            table, holding the job store ID, the path of the copy (None for files written from
+            outside the local temp dir) and its size (0 for copies, -1 for mutable copies). An
+            instance reads and modifies these rows in the transaction it was obtained in, see
+            _CacheState.jobState.
             '''
-            def __init__(self, dictObj):
-                assert isinstance(dictObj, dict)
-                self.__dict__.update(dictObj)
+            def __init__(self, connection, jobID):
+                self.connection = connection
+                self.jobID = jobID
+
+            def _query(self, sql, *args):
+                # The ID of the job is always the first parameter of the statement
+                return self.connection.execute(sql, (self.jobID,) + args)
+
+            def exists(self):
+                return self._query('SELECT 1 FROM jobs WHERE job = ?').fetchone() is not None
+
+            def create(self, jobReqs, jobDir):
+                '''
+                Add the job to the state of the cache.
+                :param float jobReqs: The disk requirements of the job
+                :param str jobDir: The working directory of the job
+                '''
+                self._query('INSERT INTO jobs VALUES (?, ?, ?)', jobReqs, jobDir)
+
+            def remove(self):
+                '''
+                Remove the job and the files it owns from the state of the cache.
+                '''
+                self._query('DELETE FROM jobFiles WHERE job = ?')
+                self._query('DELETE FROM jobs WHERE job = ?')
+
+            @property
+            def jobReqs(self):
+                return self._query('SELECT jobReqs FROM jobs WHERE job = ?').fetchone()[0]
+
+            @property
+            def jobDir(self):
+                return self._query('SELECT jobDir FROM jobs WHERE job = ?').fetchone()[0]
+
+            def fileStoreIDs(self):
+                '''
+                :return: The job store IDs of the files the job has local copies of.
+                :rtype: list
+                '''
+                return [fileStoreID for fileStoreID, in self._query(
+                    'SELECT DISTINCT fileStoreID FROM jobFiles WHERE job = ?')]
+
+            def hasFileStoreID(self, jobStoreFileID):
+                return self._query('SELECT 1 FROM jobFiles WHERE job = ? AND fileStoreID = ?',
+                                   jobStoreFileID).fetchone() is not None
+
+            def hasFilePath(self, filePath):
+                return self._query('SELECT 1 FROM jobFiles WHERE job = ? AND filePath IS ?',
+                                   filePath).fetchone() is not None
+
+            def getFiles(self, jobStoreFileID):
+                '''
+                :return: The paths and sizes of the local copies of the file with the given ID.
+                :rtype: list of tuples
+                '''
+                return self._query('SELECT filePath, fileSize FROM jobFiles '
+                                   'WHERE job = ? AND fileStoreID = ?', jobStoreFileID).fetchall()
+
+            def countFileStoreIDs(self, filePath):
+                '''
+                :return: The number of job store IDs associated with the given local file.
+                :rtype: int
+                '''
+                return self._query('SELECT COUNT(*) FROM jobFiles WHERE job = ? AND filePath IS ?',
+                                   filePath).fetchone()[0]
+
+            def removeFile(self, jobStoreFileID, filePath):
+                self._query('DELETE FROM jobFiles WHERE job = ? AND fileStoreID = ? '
+                            'AND filePath IS ?', jobStoreFileID, filePath)
 
             @classmethod
             def updateJobSpecificFiles(cls, outer, jobStoreFileID, filePath, fileSize, cached):
                 '''
                 This method will update the job specifc files in the job state object. It deals with
-                opening a cache lock file, etc.
+                opening a transaction on the cache state file. It must not be called by a caller
+                that is in a transaction already.
                 :param outer: An instance of job.CachedFileStore
                 :param jobStoreFileID: job store Identifier for the file
                 :param filePath: The path to the file
@@ -1852,10 +3212,9 @@ class Job(object):
                 :param cached: T : F : None :: cached : not cached : mutably read
                 :return: None
                 '''
-                with outer._CacheState.open(outer) as cacheInfo:
-                    jobState = cls(cacheInfo.jobState[outer.hashedJobCommand])
+                with outer._CacheState.transaction(outer.cacheStateFile) as cacheInfo:
+                    jobState = cacheInfo.jobState(outer.hashedJobCommand)
                     jobState.addToJobSpecFiles(jobStoreFileID, filePath, fileSize, cached)
-                    cacheInfo.jobState[outer.hashedJobCommand] = jobState.__dict__
 
             def addToJobSpecFiles(self, jobStoreFileID, filePath, fileSize, cached):
                 '''
@@ -1866,21 +3225,19 @@ class Job(object):
                 :param cached: T : F : None :: cached : not cached : mutably read
                 :return: None
                 '''
-                # If there is no entry for the jsfID, make one. self.jobSpecificFiles is a default
-                # dict of default dicts and the absence of a key will return an empty dict
-                # (equivalent to a None for the if)
-                if not self.jobSpecificFiles[jobStoreFileID]:
-                    self.jobSpecificFiles[jobStoreFileID][filePath] = fileSize
+                row = self._query('SELECT fileSize FROM jobFiles WHERE job = ? AND fileStoreID = ? '
+                                  'AND filePath IS ?', jobStoreFileID, filePath).fetchone()
+                # If there's no entry for the filepath, create one
+                if row is None:
+                    self._query('INSERT INTO jobFiles VALUES (?, ?, ?, ?)',
+                                jobStoreFileID, filePath, fileSize)
+                elif not row[0]:
+                    self.connection.execute('UPDATE jobFiles SET fileSize = ? WHERE job = ? '
+                                            'AND fileStoreID = ? AND filePath IS ?',
+                                            (fileSize, self.jobID, jobStoreFileID, filePath))
+                # This should never happen
                 else:
-                    # If there's no entry for the filepath, create one
-                    if not self.jobSpecificFiles[jobStoreFileID][filePath]:
-                        self.jobSpecificFiles[jobStoreFileID][filePath] = fileSize
-                    # This should never happen
-                    else:
-                        raise RuntimeError()
-                # Now add the file to the reverse mapper. This will speed up cleanup and local file
-                # deletion.
-                self.filesToFSIDs[filePath].add(jobStoreFileID)
+                    raise RuntimeError()
                 if cached:
                     self.updateJobReqs(fileSize, 'add')
 
@@ -1896,7 +3253,123 @@ class Job(object):
                 multiplier = 1 if actions == 'add' else -1
                 # If the file was added to the cache, the value is subtracted from the requirements,
                 # and it is added if the file was removed form the cache.
-                self.jobReqs -= (fileSize * multiplier)
+                self.connection.execute('UPDATE jobs SET jobReqs = jobReqs - ? WHERE job = ?',
+                                        (fileSize * multiplier, self.jobID))
+
+        class _NodeCache(object):
+            '''
+            A directory on a node that keeps the files downloaded by finished workflows for the
+            workflows to come. The files are named by the digests of their contents, see
+            AbstractJobStore.getFileDigest, so they are found even if a later workflow refers to
+            the same contents by a different job store id.
+
+            The cache of a running workflow takes a file out of the node cache by renaming it into
+            its own cache directory, and the file is renamed back when the workflow finishes. Thus
+            a file is only ever linked from one cache, which keeps the link counts the cache of a
+            workflow relies on intact, and no data is copied if both caches are on the same file
+            system. The size of the node cache is limited by evicting the least recently used files,
+            the time of the last use of a file being its modification time.
+            '''
+            def __init__(self, nodeCacheDir, maxSize):
+                self.nodeCacheDir = nodeCacheDir
+                self.maxSize = maxSize
+
+            @contextmanager
+            def _lock(self):
+                '''
+                This is a context manager that acquires the lock on the node cache, which is shared
+                by the workflows on the node.
+                '''
+                try:
+                    os.makedirs(self.nodeCacheDir)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                with open(os.path.join(self.nodeCacheDir, '.nodeCacheLock'), 'w') as lockFile:
+                    flock(lockFile, LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        flock(lockFile, LOCK_UN)
+
+            def take(self, digest, localFilePath):
+                '''
+                Moves the file with the given digest out of the node cache to the given path, or
+                copies it if the path is on a different file system.
+                :param str digest: The digest of the file
+                :param str localFilePath: The path to move the file to
+                :return: True if the file was in the node cache and False otherwise
+                :rtype: bool
+                '''
+                cachedFile = os.path.join(self.nodeCacheDir, digest)
+                with self._lock():
+                    try:
+                        os.rename(cachedFile, localFilePath)
+                    except OSError as e:
+                        if e.errno == errno.ENOENT:
+                            return False
+                        elif e.errno == errno.EXDEV:
+                            copyFile(cachedFile, localFilePath)
+                            os.utime(cachedFile, None)
+                        else:
+                            raise
+                return True
+
+            def put(self, digest, localFilePath):
+                '''
+                Moves the file at the given path to the node cache, or copies it if the node cache
+                is on a different file system. Files that are already in the node cache, or that
+                don't exist, are ignored.
+                :param str digest: The digest of the file
+                :param str localFilePath: The path of the file
+                '''
+                cachedFile = os.path.join(self.nodeCacheDir, digest)
+                with self._lock():
+                    if os.path.exists(cachedFile):
+                        os.utime(cachedFile, None)
+                        return
+                    try:
+                        os.rename(localFilePath, cachedFile)
+                    except OSError as e:
+                        if e.errno == errno.ENOENT:
+                            return
+                        elif e.errno == errno.EXDEV:
+                            # Copy to a hidden name first so that a partial copy is never taken
+                            tempFile = os.path.join(self.nodeCacheDir, '.' + digest)
+                            try:
+                                copyFile(localFilePath, tempFile)
+                                os.rename(tempFile, cachedFile)
+                            except:
+                                # evict() ignores hidden files, so a partial copy would never
+                                # be reclaimed
+                                if os.path.exists(tempFile):
+                                    os.remove(tempFile)
+                                raise
+                        else:
+                            raise
+                    # A rename keeps the modification time, which must reflect the last use
+                    os.utime(cachedFile, None)
+
+            def evict(self):
+                '''
+                Deletes the least recently used files from the node cache until its size is within
+                the limit.
+                '''
+                with self._lock():
+                    cachedFiles = []
+                    for fileName in os.listdir(self.nodeCacheDir):
+                        if fileName.startswith('.'):
+                            continue
+                        cachedFile = os.path.join(self.nodeCacheDir, fileName)
+                        fileStats = os.stat(cachedFile)
+                        cachedFiles.append((fileStats.st_mtime, fileStats.st_size, cachedFile))
+                    cachedFiles.sort()
+                    size = sum(fileSize for _, fileSize, _ in cachedFiles)
+                    for _, fileSize, cachedFile in cachedFiles:
+                        if size <= self.maxSize:
+                            break
+                        os.remove(cachedFile)
+                        size -= fileSize
 
     class Service:
         """
@@ -1977,7 +3450,16 @@ class Job(object):
         """
         if predecessorJob in self._directPredecessors:
             raise RuntimeError("The given job is already a predecessor of this job")
-        self._directPredecessors.add(predecessorJob)
+        if len(self._directPredecessors) < self._maxPredecessorTupleLength:
+            self._directPredecessors += (predecessorJob,)
+        else:
+            if isinstance(self._directPredecessors, tuple):
+                self._directPredecessors = set(self._directPredecessors)
+            self._directPredecessors.add(predecessorJob)
+        self._joinComponents(predecessorJob)
+
+    # A tuple of a few elements is much smaller than a set, and just as fast to search
+    _maxPredecessorTupleLength = 8
 
     @classmethod
     def _loadUserModule(cls, userModule):
@@ -2023,28 +3505,65 @@ class Job(object):
         else:
             openFileStream = jobStore.readFileStream(pickleFile)
         with openFileStream as fileHandle:
-            return cls._unpickle(userModule, fileHandle)
+            data = decompressPickle(fileHandle.read())
+        return cls._unpickle(userModule, BytesIO(data), jobStore)
 
     @classmethod
-    def _unpickle(cls, userModule, fileHandle):
+    def _unpickle(cls, userModule, fileHandle, jobStore=None):
         """
         Unpickles an object graph from the given file handle while loading symbols \
         referencing the __main__ module from the given userModule instead.
 
         :param userModule:
         :param fileHandle:
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore: the job store \
+        containing the objects shared by pickled jobs (see :class:`toil.job.SharedPickles`). \
+        If None, it is loaded from the locator recorded in the pickle.
         :returns:
         """
-        unpickler = cPickle.Unpickler(fileHandle)
-
         def filter_main(module_name, class_name):
             if module_name == '__main__':
                 return getattr(userModule, class_name)
             else:
                 return getattr(importlib.import_module(module_name), class_name)
 
-        unpickler.find_global = filter_main
-        return unpickler.load()
+        # Maps persistent IDs to the shared objects loaded so far, such that an object shared
+        # by several references in the pickle is only loaded once
+        sharedObjects = {}
+        # Maps digests to the pickles of the shared objects read so far. Equal objects have the
+        # same pickle but, unless they were the same object when pickled, distinct persistent IDs.
+        sharedPickles = {}
+
+        def persistent_load(persistentID):
+            # Shared objects pickled by older versions of Toil lack the number of the object
+            tag, jobStoreString, digest, fileStoreID = persistentID[:4]
+            assert tag == SharedPickles.tag
+            try:
+                return sharedObjects[persistentID]
+            except KeyError:
+                try:
+                    data = sharedPickles[digest]
+                except KeyError:
+                    data = sharedPickles[digest] = SharedPickles.load(
+                        jobStore or Promise._loadJobStore(jobStoreString), digest, fileStoreID)
+                obj = sharedObjects[persistentID] = makeUnpickler(BytesIO(data)).load()
+                return obj
+
+        def makeUnpickler(fileHandle):
+            unpickler = cPickle.Unpickler(fileHandle)
+            unpickler.find_global = filter_main
+            unpickler.persistent_load = persistent_load
+            return unpickler
+
+        unpickler = makeUnpickler(fileHandle)
+        obj = unpickler.load()
+        if isinstance(obj, tuple) and obj[:1] == (Promise.filesHeader,):
+            # The pickle is preceded by the IDs of the files containing the values promised to
+            # it, so read them all before the promises are resolved one by one
+            _, jobStoreString, jobStoreFileIDs = obj
+            Promise.prefetch(jobStoreString, jobStoreFileIDs)
+            obj = unpickler.load()
+        return obj
 
     def getUserScript(self):
         return self.userModule
@@ -2058,14 +3577,23 @@ class Job(object):
         """
         Sets the values for promises using the return values from the job's run function.
         """
-        for index, promiseFileStoreIDs in self._rvs.iteritems():
+        for promiseFileStoreID, indices in (self._promiseFiles or {}).iteritems():
+            promisedValues = {index: returnValues if index is None else returnValues[index]
+                              for index in indices}
+            # File may be gone if the job is a service being re-run and the accessing job is
+            # already complete
+            if jobStore.fileExists(promiseFileStoreID):
+                with jobStore.updateFileStream(promiseFileStoreID) as fileHandle:
+                    fileHandle.write(compressPickle(
+                        cPickle.dumps(promisedValues, cPickle.HIGHEST_PROTOCOL)))
+        legacyPromiseFiles = getattr(self, '_legacyPromiseFiles', None) or {}
+        for index, promiseFileStoreIDs in legacyPromiseFiles.iteritems():
             promisedValue = returnValues if index is None else returnValues[index]
             for promiseFileStoreID in promiseFileStoreIDs:
-                # File may be gone if the job is a service being re-run and the accessing job is
-                # already complete
                 if jobStore.fileExists(promiseFileStoreID):
                     with jobStore.updateFileStream(promiseFileStoreID) as fileHandle:
-                        cPickle.dump(promisedValue, fileHandle, cPickle.HIGHEST_PROTOCOL)
+                        fileHandle.write(compressPickle(
+                            cPickle.dumps(promisedValue, cPickle.HIGHEST_PROTOCOL)))
 
     ####################################################
     #Functions associated with Job.checkJobGraphAcyclic to establish
@@ -2076,50 +3604,110 @@ class Job(object):
         """Adds the job and all jobs reachable on a directed path from current \
         node to the set 'visited'.
         """
-        if self not in visited:
-            visited.add(self)
-            for successor in self._children + self._followOns:
-                successor._dfs(visited)
+        stack = [self]
+        while stack:
+            job = stack.pop()
+            if job not in visited:
+                visited.add(job)
+                stack.extend(job._children)
+                stack.extend(job._followOns)
 
-    def _checkJobGraphAcylicDFS(self, stack, visited, extraEdges):
+    @staticmethod
+    def _getAugmentedOrdering(jobs):
         """
-        DFS traversal to detect cycles in augmented job graph.
+        Topologically sorts the augmented job graph (see :func:`toil.job.Job.checkJobGraphAcylic`)
+        without materialising the implied edges, whose number can be quadratic in the number of
+        jobs.
+
+        Instead, each job J is represented by three vertices: the start of J, the completion of J
+        and everything reachable from its children, and the completion of J and everything
+        reachable from it. The first vertex of each child of J precedes the second vertex of J,
+        the second vertex of J precedes the first vertex of each follow-on of J, which in turn
+        precedes the third vertex of J. A path between the first vertices of two jobs exists if
+        and only if a path between them exists in the augmented job graph, so the augmented job
+        graph is acyclic if and only if this graph of ``3|V|`` vertices and ``O(|V| + |E|)``
+        edges is. The latter is sorted iteratively with Kahn's algorithm.
+
+        :param list jobs: a connected component of the job graph
+        :raises toil.job.JobGraphDeadlockException: if the augmented job graph contains a cycle
+        :return: the given jobs, ordered such that each job comes after all of its predecessors
+        :rtype: list
         """
-        if self not in visited:
-            visited.add(self)
-            stack.append(self)
-            for successor in self._children + self._followOns + extraEdges[self]:
-                successor._checkJobGraphAcylicDFS(stack, visited, extraEdges)
-            assert stack.pop() == self
-        if self in stack:
-            stack.append(self)
-            raise JobGraphDeadlockException("A cycle of job dependencies has been detected '%s'" % stack)
+        # Vertex 3 * i + k is vertex k of jobs[i]
+        index = {job: i for i, job in enumerate(jobs)}
+        inDegrees = [0] * (3 * len(jobs))
+        # The vertices succeeding the third vertex of each job
+        completionEdges = [[] for _ in jobs]
+        for i, job in enumerate(jobs):
+            inDegrees[3 * i + 1] = 1 + len(job._children)
+            inDegrees[3 * i + 2] = 1 + len(job._followOns)
+            for child in job._children:
+                inDegrees[3 * index[child]] += 1
+                completionEdges[index[child]].append(3 * i + 1)
+            for followOn in job._followOns:
+                inDegrees[3 * index[followOn]] += 1
+                completionEdges[index[followOn]].append(3 * i + 2)
+
+        def successors(vertex):
+            i, k = divmod(vertex, 3)
+            if k == 0:
+                return [vertex + 1] + [3 * index[child] for child in jobs[i]._children]
+            elif k == 1:
+                return [vertex + 1] + [3 * index[followOn] for followOn in jobs[i]._followOns]
+            else:
+                return completionEdges[i]
+
+        ordering = []
+        sortedVertices = 0
+        ready = [3 * i for i in xrange(len(jobs)) if inDegrees[3 * i] == 0]
+        while ready:
+            vertex = ready.pop()
+            sortedVertices += 1
+            if vertex % 3 == 0:
+                ordering.append(jobs[vertex // 3])
+            for successor in successors(vertex):
+                inDegrees[successor] -= 1
+                if inDegrees[successor] == 0:
+                    ready.append(successor)
+        if sortedVertices < len(inDegrees):
+            # The vertices that were not sorted contain a cycle, find one for the error message
+            raise JobGraphDeadlockException("A cycle of job dependencies has been detected '%s'" %
+                                            [jobs[vertex // 3] for vertex in
+                                             Job._findCycle(inDegrees, successors)])
+        return ordering
 
     @staticmethod
-    def _getImpliedEdges(roots):
-        """
-        Gets the set of implied edges. See Job.checkJobGraphAcylic
-        """
-        #Get nodes in job graph
-        nodes = set()
-        for root in roots:
-            root._dfs(nodes)
-
-        ##For each follow-on edge calculate the extra implied edges
-        #Adjacency list of implied edges, i.e. map of jobs to lists of jobs
-        #connected by an implied edge
-        extraEdges = dict(map(lambda n : (n, []), nodes))
-        for job in nodes:
-            if len(job._followOns) > 0:
-                #Get set of jobs connected by a directed path to job, starting
-                #with a child edge
-                reacheable = set()
-                for child in job._children:
-                    child._dfs(reacheable)
-                #Now add extra edges
-                for descendant in reacheable:
-                    extraEdges[descendant] += job._followOns[:]
-        return extraEdges
+    def _findCycle(inDegrees, successors):
+        """
+        Iteratively searches for a cycle among the vertices left over by Kahn's algorithm, i.e.
+        those with a non-zero in-degree.
+
+        :return: the vertices along the cycle, the first vertex being repeated at the end
+        :rtype: list
+        """
+        onPath = {}
+        for start in xrange(len(inDegrees)):
+            if inDegrees[start] == 0 or start in onPath:
+                continue
+            path, iterators = [start], [iter(successors(start))]
+            onPath[start] = True
+            while path:
+                for successor in iterators[-1]:
+                    if inDegrees[successor] != 0:
+                        if onPath.get(successor):
+                            cycle = path[path.index(successor):] + [successor]
+                            # Collapse the consecutive vertices of each job
+                            return [v for j, v in enumerate(cycle)
+                                    if j == 0 or v // 3 != cycle[j - 1] // 3]
+                        elif successor not in onPath:
+                            onPath[successor] = True
+                            path.append(successor)
+                            iterators.append(iter(successors(successor)))
+                            break
+                else:
+                    onPath[path.pop()] = False
+                    iterators.pop()
+        assert False
 
     ####################################################
     #The following functions are used to serialise
@@ -2130,10 +3718,18 @@ class Job(object):
         """
         Create an empty job for the job.
         """
+        return jobStore.create(**self._emptyJobWrapperArgs(jobStore, command, predecessorNumber))
+
+    def _emptyJobWrapperArgs(self, jobStore, command=None, predecessorNumber=0):
+        """
+        Returns the arguments to jobStore.create() for creating an empty job for the job.
+
+        :rtype: dict
+        """
         requirements = self.effectiveRequirements(jobStore.config)
         if jobStore.config.disableSharedCache:
             del requirements.cache
-        return jobStore.create(command=command, predecessorNumber=predecessorNumber, **requirements)
+        return dict(requirements, command=command, predecessorNumber=predecessorNumber)
 
     def effectiveRequirements(self, config):
         """
@@ -2160,35 +3756,53 @@ class Job(object):
 
     def _makeJobWrappers(self, jobWrapper, jobStore):
         """
-        Creates a jobWrapper for each job in the job graph, recursively.
+        Creates a jobWrapper for each job in the job graph. The jobWrappers are created in bulk,
+        then the stack of each jobWrapper is filled in.
         """
-        jobsToJobWrappers = { self:jobWrapper }
-        for successors in (self._followOns, self._children):
-            jobs = map(lambda successor:
-                successor._makeJobWrappers2(jobStore, jobsToJobWrappers), successors)
-            jobWrapper.stack.append(jobs)
+        # Find the jobs that need a jobWrapper, the list is extended while it is traversed
+        jobs = [self]
+        visited = {self}
+        for job in jobs:
+            for successor in itertools.chain(job._followOns, job._children):
+                if successor not in visited:
+                    visited.add(successor)
+                    jobs.append(successor)
+        jobsToJobWrappers = {self: jobWrapper}
+        self._createJobWrappers(jobs, jobStore, jobsToJobWrappers)
         return jobsToJobWrappers
 
-    def _makeJobWrappers2(self, jobStore, jobsToJobWrappers):
-        #Make the jobWrapper for the job, if necessary
-        if self not in jobsToJobWrappers:
-            jobWrapper = self._createEmptyJobWrapperForJob(jobStore, predecessorNumber=len(self._directPredecessors))
-            jobsToJobWrappers[self] = jobWrapper
-            #Add followOns/children to be run after the current job.
-            for successors in (self._followOns, self._children):
-                jobs = map(lambda successor:
-                    successor._makeJobWrappers2(jobStore, jobsToJobWrappers), successors)
-                jobWrapper.stack.append(jobs)
-        else:
-            jobWrapper = jobsToJobWrappers[self]
-        #The return is a tuple stored within a job.stack
-        #The tuple is jobStoreID, memory, cores, disk, predecessorID
+    @staticmethod
+    def _createJobWrappers(jobs, jobStore, jobsToJobWrappers, minPredecessorNumber=0):
+        """
+        Creates a jobWrapper in bulk for each of the given jobs not in jobsToJobWrappers, then
+        fills in the stack of the jobWrapper of each of the given jobs.
+
+        :param list jobs: the jobs, including all of their successors
+        :param dict jobsToJobWrappers: maps jobs to their jobWrappers, the new jobWrappers are \
+        added to it
+        :param int minPredecessorNumber: the minimum number of predecessors of each job
+        """
+        newJobs = [job for job in jobs if job not in jobsToJobWrappers]
+        jobWrappers = jobStore.createMany([job._emptyJobWrapperArgs(
+            jobStore, predecessorNumber=max(minPredecessorNumber, len(job._directPredecessors)))
+            for job in newJobs])
+        jobsToJobWrappers.update(zip(newJobs, jobWrappers))
+        #Add followOns/children to be run after each job.
+        for job in jobs:
+            for successors in (job._followOns, job._children):
+                jobsToJobWrappers[job].stack.append(
+                    [Job._successorTuple(jobsToJobWrappers[successor]) for successor in successors])
+
+    @staticmethod
+    def _successorTuple(successorWrapper):
+        #The tuple is stored within a job.stack
+        #The tuple is jobStoreID, memory, cores, disk, preemptable, predecessorID
         #The predecessorID is used to establish which predecessors have been
         #completed before running the given Job - it is just a unique ID
         #per predecessor
-        return (jobWrapper.jobStoreID, jobWrapper.memory, jobWrapper.cores,
-                jobWrapper.disk, jobWrapper.preemptable,
-                None if jobWrapper.predecessorNumber <= 1 else str(uuid.uuid4()))
+        return (successorWrapper.jobStoreID, successorWrapper.memory,
+                successorWrapper.cores, successorWrapper.disk, successorWrapper.preemptable,
+                None if successorWrapper.predecessorNumber <= 1 else str(uuid.uuid4()))
 
     def getTopologicalOrderingOfJobs(self):
         """
@@ -2196,36 +3810,85 @@ class Job(object):
         the job at index i can be run before the job at index j.
         :rtype: list
         """
-        ordering = []
-        visited = set()
-        def getRunOrder(job):
-            #Do not add the job to the ordering until all its predecessors have been
-            #added to the ordering
-            for p in job._directPredecessors:
-                if p not in visited:
-                    return
-            if job not in visited:
-                visited.add(job)
-                ordering.append(job)
-                map(getRunOrder, job._children + job._followOns)
-        getRunOrder(self)
+        # The list is extended while it is traversed
+        ordering = [self]
+        # Maps jobs to the number of their predecessors not yet added to the ordering
+        remaining = {}
+        for job in ordering:
+            for successor in itertools.chain(job._children, job._followOns):
+                count = remaining.get(successor, len(successor._directPredecessors)) - 1
+                remaining[successor] = count
+                #Do not add the job to the ordering until all its predecessors have been
+                #added to the ordering
+                if count == 0:
+                    ordering.append(successor)
         return ordering
 
     def _serialiseJob(self, jobStore, jobsToJobWrappers, rootJobWrapper):
         """
         Pickle a job and its jobWrapper to disk.
         """
-        # Pickle the job so that its run method can be run at a later time.
+        with jobStore.writeFileStream(rootJobWrapper.jobStoreID) as (fileHandle, fileStoreID):
+            fileHandle.write(self._pickleJob(SharedPickles(jobStore, rootJobWrapper.jobStoreID)))
+        self._setJobWrapperCommand(jobsToJobWrappers[self], fileStoreID)
+        #Update the status of the jobWrapper on disk
+        jobStore.update(jobsToJobWrappers[self])
+
+    def _serialiseJobs(self, jobs, jobStore, jobsToJobWrappers, rootJobWrapper):
+        """
+        Pickle the given jobs and their services in the given order, then write the pickled jobs
+        to the jobStore concurrently and update their jobWrappers in bulk.
+        """
+        pickledJobs = []
+        # Large objects shared by the jobs are only pickled and stored once
+        sharedPickles = SharedPickles(jobStore, rootJobWrapper.jobStoreID)
+        for job in jobs:
+            # Pickle the services for the job
+            job._serialiseServices(jobStore, jobsToJobWrappers[job], rootJobWrapper)
+            # Pickling a job allocates the files for the promises it references, so the jobs
+            # must be pickled one after the other
+            pickledJobs.append(job._pickleJob(sharedPickles))
+        fileStoreIDs = jobStore.writeFilesFromStrings(pickledJobs, rootJobWrapper.jobStoreID)
+        for job, fileStoreID in zip(jobs, fileStoreIDs):
+            job._setJobWrapperCommand(jobsToJobWrappers[job], fileStoreID)
+        jobStore.updateMany([jobsToJobWrappers[job] for job in jobs])
+
+    def _pickleJob(self, sharedPickles=None):
+        """
+        Pickle the job so that its run method can be run at a later time.
+
+        :param SharedPickles sharedPickles: if specified, large objects referenced by the job \
+        are stored separately, see :class:`toil.job.SharedPickles`
+        :rtype: str
+        """
         # Drop out the children/followOns/predecessors/services - which are
         # all recorded within the jobStore and do not need to be stored within
         # the job
-        self._children, self._followOns, self._services = [], [], []
-        self._directPredecessors, self._promiseJobStore = set(), None
+        self._children, self._followOns, self._services = (), (), ()
+        self._directPredecessors, self._promiseJobStore, self._component = (), None, None
+        self._childIterables = ()
+        Promise._filesBeingPickled = files = {}
+        try:
+            if sharedPickles is None:
+                pickledJob = cPickle.dumps(self, cPickle.HIGHEST_PROTOCOL)
+            else:
+                pickledJob = sharedPickles.dumps(self)
+        finally:
+            Promise._filesBeingPickled = None
+        if files:
+            # Let _unpickle() fetch the promised values in bulk
+            header = (Promise.filesHeader, files.keys()[0]._promiseJobStore.config.jobStore,
+                      files.values())
+            pickledJob = cPickle.dumps(header, cPickle.HIGHEST_PROTOCOL) + pickledJob
+        return compressPickle(pickledJob)
+
+    def _setJobWrapperCommand(self, jobWrapper, fileStoreID):
+        """
+        Set the command of the jobWrapper to run the job pickled in the file with the given ID.
+        """
         # The pickled job is "run" as the command of the job, see worker
         # for the mechanism which unpickles the job and executes the Job.run
         # method.
-        with jobStore.writeFileStream(rootJobWrapper.jobStoreID) as (fileHandle, fileStoreID):
-            cPickle.dump(self, fileHandle, cPickle.HIGHEST_PROTOCOL)
         # Note that getUserScript() may have beeen overridden. This is intended. If we used
         # self.userModule directly, we'd be getting a reference to job.py if the job was
         # specified as a function (as opposed to a class) since that is where FunctionWrappingJob
@@ -2233,9 +3896,7 @@ class Job(object):
         # and FunctionWrappingJob overrides getUserScript() to give us just that. Only then can
         # filter_main() in _unpickle( ) do its job of resolveing any user-defined type or function.
         userScript = self.getUserScript().globalize()
-        jobsToJobWrappers[self].command = ' '.join( ('_toil', fileStoreID) + userScript)
-        #Update the status of the jobWrapper on disk
-        jobStore.update(jobsToJobWrappers[self])
+        jobWrapper.command = ' '.join( ('_toil', fileStoreID) + userScript)
 
     def _serialiseServices(self, jobStore, jobWrapper, rootJobWrapper):
         """
@@ -2273,7 +3934,7 @@ class Job(object):
             # Break the links between the services to stop them being serialised together
             #childServices = serviceJob.service._childServices
             serviceJob.service._childServices = None
-            assert serviceJob._services == []
+            assert not serviceJob._services
             #service = serviceJob.service
             
             # Pickle the job
@@ -2290,7 +3951,7 @@ class Job(object):
         for serviceJob in self._services:
             processService(serviceJob, 0)
 
-        self._services = []
+        self._services = ()
 
     def _serialiseJobGraph(self, jobWrapper, jobStore, returnValues, firstJob):
         """
@@ -2298,15 +3959,19 @@ class Job(object):
         until the jobWrapper itself is written to disk, this is not performed by this \
         function because of the need to coordinate this operation with other updates. \
         """
+        #Add the children produced by the iterables passed to addChildrenFrom() of any job
+        #but this one, whose children are serialised in batches at the end
+        childJobIterables, self._childIterables = self._childIterables, ()
+        self._addChildrenFromIterables(self._getConnectedJobs())
+
         #Check if the job graph has created
-        #any cycles of dependencies or has multiple roots
-        self.checkJobGraphForDeadlocks()
+        #any cycles of dependencies or has multiple roots. This also gets an
+        #ordering on the jobs which we use for pickling the jobs in the
+        #correct order to ensure the promises are properly established
+        ordering = self._checkJobGraph()
 
         #Create the jobWrappers for followOns/children
         jobsToJobWrappers = self._makeJobWrappers(jobWrapper, jobStore)
-        #Get an ordering on the jobs which we use for pickling the jobs in the
-        #correct order to ensure the promises are properly established
-        ordering = self.getTopologicalOrderingOfJobs()
         assert len(ordering) == len(jobsToJobWrappers)
 
         # Temporarily set the jobStore strings for the promise call back functions
@@ -2323,24 +3988,69 @@ class Job(object):
         assert self == ordering[-1]
         if firstJob:
             #If the first job we serialise all the jobs, including the root job
-            for job in ordering:
-                # Pickle the services for the job
-                job._serialiseServices(jobStore, jobsToJobWrappers[job], jobWrapper)
-                # Now pickle the job
-                job._serialiseJob(jobStore, jobsToJobWrappers, jobWrapper)
+            self._serialiseJobs(ordering, jobStore, jobsToJobWrappers, jobWrapper)
         else:
             #We store the return values at this point, because if a return value
             #is a promise from another job, we need to register the promise
             #before we serialise the other jobs
             self._setReturnValuesForPromises(returnValues, jobStore)
             #Pickle the non-root jobs
-            for job in ordering[:-1]:
-                # Pickle the services for the job
-                job._serialiseServices(jobStore, jobsToJobWrappers[job], jobWrapper)
-                # Pickle the job itself
-                job._serialiseJob(jobStore, jobsToJobWrappers, jobWrapper)
+            self._serialiseJobs(ordering[:-1], jobStore, jobsToJobWrappers, jobWrapper)
             # Pickle any services for the job
             self._serialiseServices(jobStore, jobWrapper, jobWrapper)
+        self._serialiseChildBatches(childJobIterables, jobWrapper, jobStore)
+
+    @staticmethod
+    def _addChildrenFromIterables(jobs):
+        """
+        Adds the children produced by the iterables passed to addChildrenFrom() of the given jobs
+        and of their successors. The jobs produced by an iterable may have iterables of their
+        own, so those are consumed as well until no job reachable from the given ones has any.
+
+        :param list jobs: the jobs to start from, the list is consumed
+        """
+        visited = set(jobs)
+        while jobs:
+            job = jobs.pop()
+            childJobIterables, job._childIterables = job._childIterables, ()
+            for childJobs in childJobIterables:
+                for childJob in childJobs:
+                    job.addChild(childJob)
+            for successor in itertools.chain(job._children, job._followOns):
+                if successor not in visited:
+                    visited.add(successor)
+                    jobs.append(successor)
+
+    def _serialiseChildBatches(self, childJobIterables, jobWrapper, jobStore):
+        """
+        Serialises the children produced by the given iterables in batches of childBatchSize jobs
+        and adds them to the children of the given jobWrapper, which must be the last entry of
+        its stack.
+        """
+        childTuples = []
+        for childJobs in childJobIterables:
+            childJobs = iter(childJobs)
+            while True:
+                batch = list(itertools.islice(childJobs, self.childBatchSize))
+                if not batch:
+                    break
+                # Each child is the root of its own job graph, the batch isn't connected to this
+                # job so that only the jobs of the batch are traversed
+                self._addChildrenFromIterables(list(batch))
+                ordering = []
+                for childJob in batch:
+                    ordering.extend(childJob._checkJobGraph())
+                jobsToJobWrappers = {}
+                self._createJobWrappers(ordering, jobStore, jobsToJobWrappers,
+                                        minPredecessorNumber=1)
+                for job in ordering:
+                    job._promiseJobStore = jobStore
+                ordering.reverse()
+                self._serialiseJobs(ordering, jobStore, jobsToJobWrappers, jobWrapper)
+                childTuples.extend(
+                    self._successorTuple(jobsToJobWrappers[childJob]) for childJob in batch)
+        # Segments of the stack are never modified in place, see JobWrapper.copy()
+        jobWrapper.stack[-1] = jobWrapper.stack[-1] + childTuples
 
     def _serialiseFirstJob(self, jobStore):
         """
@@ -2391,35 +4101,51 @@ class Job(object):
         """
         if stats != None:
             startTime = time.time()
-            startClock = getTotalCpuTime()
-        baseDir = os.getcwd()
-        #Run the job
-        returnValues = self._run(jobWrapper, fileStore)
-        #Serialize the new jobs defined by the run method to the jobStore
-        self._serialiseExistingJob(jobWrapper, jobStore, returnValues)
-        # If the job is not a checkpoint job, add the promise files to delete
-        # to the list of jobStoreFileIDs to delete
-        if not self.checkpoint:
-            for jobStoreFileID in Promise.filesToDelete:
-                fileStore.deleteGlobalFile(jobStoreFileID)
-        else:
-            # Else copy them to the job wrapper to delete later
-            jobWrapper.checkpointFilesToDelete = list(Promise.filesToDelete)
-        Promise.filesToDelete.clear()
-        #Now indicate the asynchronous update of the job can happen
-        fileStore._updateJobWhenDone()
-        #Change dir back to cwd dir, if changed by job (this is a safety issue)
-        if os.getcwd() != baseDir:
-            os.chdir(baseDir)
+            monitor = ResourceMonitor(dirName=localTempDir,
+                                      interval=jobStore.config.statsInterval,
+                                      maxDiskInterval=jobStore.config.statsDiskInterval)
+            monitor.start()
+        try:
+            baseDir = os.getcwd()
+            #Run the job
+            returnValues = self._run(jobWrapper, fileStore)
+            #Serialize the new jobs defined by the run method to the jobStore
+            self._serialiseExistingJob(jobWrapper, jobStore, returnValues)
+            # If the job is not a checkpoint job, add the promise files to delete
+            # to the list of jobStoreFileIDs to delete
+            if not self.checkpoint:
+                for jobStoreFileID in Promise.filesToDelete:
+                    fileStore.deleteGlobalFile(jobStoreFileID)
+            else:
+                # Else copy them to the job wrapper to delete later
+                jobWrapper.checkpointFilesToDelete = list(Promise.filesToDelete)
+            Promise.filesToDelete.clear()
+            Promise.clearCache()
+            #Now indicate the asynchronous update of the job can happen
+            fileStore._updateJobWhenDone()
+            #Change dir back to cwd dir, if changed by job (this is a safety issue)
+            if os.getcwd() != baseDir:
+                os.chdir(baseDir)
+        finally:
+            # Stop sampling even if the job failed, the worker is about to clean up the
+            # directory being measured
+            if stats != None:
+                usage = monitor.stop()
         #Finish up the stats
         if stats != None:
-            totalCpuTime, totalMemoryUsage = getTotalCpuTimeAndMemoryUsage()
             stats.jobs.append(
                 Expando(
                     time=str(time.time() - startTime),
-                    clock=str(totalCpuTime - startClock),
+                    clock=str(usage['clock']),
                     class_name=self._jobName(),
-                    memory=str(totalMemoryUsage)
+                    memory=str(usage['memory']),
+                    readBytes=str(usage['readBytes']),
+                    writeBytes=str(usage['writeBytes']),
+                    disk=str(usage['disk']),
+                    # The files written by the job are still being uploaded, so this is
+                    # complete by the time the worker reports the stats
+                    upload=fileStore.uploadMetrics,
+                    cache=fileStore.cacheMetrics
                 )
             )
 
@@ -2429,6 +4155,48 @@ class Job(object):
         """
         return self.__class__.__name__
 
+compressedPickleMagic = '\x00TP'
+"""
+Prefixes pickles compressed by :func:`compressPickle`. No pickle starts with a null byte. The magic
+is followed by a byte identifying the compression codec, currently only 'z' for zlib.
+"""
+
+minCompressedPickleSize = 64 * 1024
+"""
+The size in bytes above which :func:`compressPickle` compresses pickles
+"""
+
+def compressPickle(data):
+    """
+    Compresses the given pickle if it is larger than :data:`minCompressedPickleSize`. Small pickles
+    are returned as is.
+
+    :param str data: the pickle
+    :rtype: str
+    """
+    if len(data) > minCompressedPickleSize:
+        # The fastest level since the pickles are compressed on the critical path of a job
+        return compressedPickleMagic + 'z' + zlib.compress(data, 1)
+    else:
+        return data
+
+def decompressPickle(data):
+    """
+    Returns the pickle in the given string, which was either produced by :func:`compressPickle`
+    or is a plain pickle.
+
+    :param str data: a pickle, possibly compressed
+    :rtype: str
+    """
+    if data.startswith(compressedPickleMagic):
+        codec = data[len(compressedPickleMagic)]
+        if codec == 'z':
+            return zlib.decompress(data[len(compressedPickleMagic) + 1:])
+        else:
+            raise ValueError("Unknown compression codec '%s'" % codec)
+    else:
+        return data
+
 class JobException( Exception ):
     """
     General job exception.
@@ -2445,6 +4213,29 @@ class JobGraphDeadlockException( JobException ):
         super( JobGraphDeadlockException, self ).__init__( string )
 
 
+class JobGraphComponent(object):
+    """
+    The state of the incremental validation of a connected component of the job graph, i.e. a
+    set of jobs connected by child and follow-on edges in either direction. Each job refers to
+    a component, the components of jobs that were connected later refer to the component they
+    were merged into, see :func:`toil.job.Job._joinComponents`. Only the attributes of the
+    component at the root of such a chain are up to date.
+    """
+    __slots__ = ('parent', 'size', 'roots', 'verified', 'invalidCheckpoints')
+
+    def __init__(self):
+        # The component this one was merged into, if any
+        self.parent = None
+        # The number of jobs in the component
+        self.size = 1
+        # The number of jobs in the component without predecessors
+        self.roots = 1
+        # False if the augmented job graph of the component may contain a cycle
+        self.verified = True
+        # The checkpoint jobs of the component that aren't leaves, or None
+        self.invalidCheckpoints = None
+
+
 class CacheError(Exception):
     '''
     Error Raised if the user attempts to add a non-local file to cache
@@ -2528,6 +4319,71 @@ class JobFunctionWrappingJob(FunctionWrappingJob):
         rValue = userFunction(*((self,) + tuple(self._args)), **self._kwargs)
         return rValue
 
+class JobArray(FunctionWrappingJob):
+    """
+    Job used to call a function once for each item of a sequence, each call being run as a
+    separate job. This is equivalent to adding a :class:`toil.job.FunctionWrappingJob` or
+    :class:`toil.job.JobFunctionWrappingJob` for each item but the function, its arguments and
+    its resource requirements are only stored once, along with the list of items.
+
+    The jobs for the individual calls are only created when the job array is run. Job arrays with
+    more than :attr:`maxSuccessors` items are split into nested job arrays, such that no job
+    creates more than :attr:`maxSuccessors` jobs at a time.
+
+    The return value of a job array (as accessed by the :func:`toil.job.Job.rv` function) is the
+    list of the return values of the calls, in the order of the items.
+    """
+    maxSuccessors = 1000
+
+    def __init__(self, userFunction, items, *args, **kwargs):
+        """
+        :param userFunction: The function to wrap. The userFunction will be called once for \
+        each item, with the item followed by ``*args`` as positional arguments and ``**kwargs`` \
+        as keyword arguments.
+        :param items: an iterable of the items to call the function with
+
+        The keyword "jobFn" is reserved, if True the userFunction is a job function (see \
+        :class:`toil.job.JobFunctionWrappingJob`), which will be passed the job running the \
+        call as its first argument. The resource keywords reserved by \
+        :class:`toil.job.FunctionWrappingJob` apply to each call.
+        """
+        self._jobFn = kwargs.pop("jobFn", False)
+        super(JobArray, self).__init__(userFunction, *args, **kwargs)
+        self._items = list(items)
+
+    def _requirements(self):
+        return dict(memory=self.memory, cores=self.cores, disk=self.disk, cache=self.cache,
+                    preemptable=self.preemptable)
+
+    def run(self, fileStore):
+        userFunction = self._getUserFunction()
+        numItems = len(self._items)
+        if numItems > self.maxSuccessors:
+            batchSize = -(-numItems // self.maxSuccessors)
+            successors = [type(self)(userFunction, self._items[i:i + batchSize], *self._args,
+                                     jobFn=self._jobFn, **dict(self._kwargs, **self._requirements()))
+                          for i in xrange(0, numItems, batchSize)]
+        else:
+            elementClass = JobFunctionWrappingJob if self._jobFn else FunctionWrappingJob
+            successors = [elementClass(userFunction, *((item,) + tuple(self._args)),
+                                       **dict(self._kwargs, **self._requirements()))
+                          for item in self._items]
+        for successor in successors:
+            self.addChild(successor)
+        # Only collect the return values if they were promised to another job
+        if self._promiseFiles:
+            return self.addFollowOnFn(_collectJobArrayValues, numItems > self.maxSuccessors,
+                                      *[successor.rv() for successor in successors]).rv()
+
+
+def _collectJobArrayValues(nested, *values):
+    """
+    Returns the return values of the calls of a job array, given the return values of its
+    successors, which are lists if the job array is nested.
+    """
+    return list(itertools.chain.from_iterable(values)) if nested else list(values)
+
+
 class EncapsulatedJob(Job):
     """
     A convenience Job class used to make a job subgraph appear to be a single job.
@@ -2558,6 +4414,9 @@ class EncapsulatedJob(Job):
     def addChild(self, childJob):
         return Job.addChild(self.encapsulatedFollowOn, childJob)
 
+    def addChildrenFrom(self, childJobs):
+        return Job.addChildrenFrom(self.encapsulatedFollowOn, childJobs)
+
     def addService(self, service):
         return Job.addService(self.encapsulatedFollowOn, service)
 
@@ -2602,8 +4461,9 @@ class ServiceJob(Job):
             #the service, to do this while the run method is running we
             #cheat and set the return value promise within the run method
             self._setReturnValuesForPromises(startCredentials, fileStore.jobStore)
-            self._rvs = {}  # Set this to avoid the return values being updated after the
+            # Set these to avoid the return values being updated after the
             #run method has completed!
+            self._promiseFiles, self._legacyPromiseFiles = {}, {}
 
             #Now flag that the service is running jobs can connect to it
             logger.debug("Removing the start jobStoreID to indicate that establishment of the service")
@@ -2686,6 +4546,32 @@ class Promise(object):
     """
     A set of IDs of files containing promised values when we know we won't need them anymore
     """
+
+    filesHeader = 'toil.job.Promise.files'
+    """
+    Tags the list of IDs of files containing promised values that precedes a pickled job
+    """
+
+    _filesBeingPickled = None
+    """
+    While a job is being pickled, maps each job promising values to it to the file that will
+    hold those values, such that all promises made by one job to another share a single file
+
+    :type: dict[Job,str]|None
+    """
+
+    _values = {}
+    """
+    Caches the promised values loaded from each file, keyed on the ID of that file
+
+    :type: dict[str,dict]
+    """
+
+    pickledCount = 0
+    """
+    The number of promises pickled by the current process
+    """
+
     def __init__(self, job, index):
         """
         :param Job job: the job whose return value this promise references
@@ -2704,13 +4590,14 @@ class Promise(object):
         # empty file in the job store if the promise is actually being pickled. This is done so
         # that we do not allocate files for promises that are never used.
         jobStoreString, jobStoreFileID = self.job.allocatePromiseFile(self.index)
+        Promise.pickledCount += 1
         # Returning a class object here causes the pickling machinery to attempt to instantiate
         # the class. We will catch that with __new__ and return an the actual return value instead.
-        return self.__class__, (jobStoreString, jobStoreFileID)
+        return self.__class__, (jobStoreString, jobStoreFileID, self.index)
 
     @staticmethod
     def __new__(cls, *args):
-        assert len(args) == 2
+        assert 2 <= len(args) <= 3
         if isinstance(args[0], Job):
             # Regular instantiation when promise is created, before it is being pickled
             return super(Promise, cls).__new__(cls, *args)
@@ -2719,14 +4606,238 @@ class Promise(object):
             return cls._resolve(*args)
 
     @classmethod
-    def _resolve(cls, jobStoreString, jobStoreFileID):
+    def _loadJobStore(cls, jobStoreString):
         # Initialize the cached job store if it was never initialized in the current process or
         # if it belongs to a different workflow that was run earlier in the current process.
         if cls._jobstore is None or cls._jobstore.config.jobStore != jobStoreString:
             cls._jobstore = Toil.loadOrCreateJobStore(jobStoreString)
+        return cls._jobstore
+
+    @classmethod
+    def prefetch(cls, jobStoreString, jobStoreFileIDs):
+        """
+        Concurrently reads the given files containing promised values such that the promises
+        referencing them can be resolved without further requests to the job store.
+
+        :param str jobStoreString: the locator of the job store containing the files
+        :param list[str] jobStoreFileIDs: the IDs of the files
+        """
+        jobStoreFileIDs = [jobStoreFileID for jobStoreFileID in jobStoreFileIDs
+                           if jobStoreFileID not in cls._values]
+        if jobStoreFileIDs:
+            jobStore = cls._loadJobStore(jobStoreString)
+            # If this doesn't work then the files containing the promises may not exist
+            for jobStoreFileID, data in zip(jobStoreFileIDs,
+                                            jobStore.readFilesToStrings(jobStoreFileIDs)):
+                cls._values[jobStoreFileID] = cPickle.loads(decompressPickle(data))
+
+    @classmethod
+    def clearCache(cls):
+        """
+        Forgets the promised values loaded by the current process.
+        """
+        cls._values.clear()
+
+    @classmethod
+    def _resolve(cls, jobStoreString, jobStoreFileID, *index):
         cls.filesToDelete.add(jobStoreFileID)
-        with cls._jobstore.readFileStream(jobStoreFileID) as fileHandle:
-            # If this doesn't work then the file containing the promise may not exist or be
-            # corrupted
-            value = cPickle.load(fileHandle)
-            return value
+        try:
+            values = cls._values[jobStoreFileID]
+        except KeyError:
+            with cls._loadJobStore(jobStoreString).readFileStream(jobStoreFileID) as fileHandle:
+                # If this doesn't work then the file containing the promise may not exist or be
+                # corrupted
+                values = cPickle.loads(decompressPickle(fileHandle.read()))
+            cls._values[jobStoreFileID] = values
+        if index:
+            return values[index[0]]
+        else:
+            # Promises pickled by older versions of Toil reference files holding a single value
+            return values
+
+
+class SharedPickles(object):
+    """
+    Content-addressed storage of the large objects referenced by pickled jobs.
+
+    When thousands of jobs are passed the same large argument, pickling each job separately would
+    store the argument thousands of times. Instead, strings and containers whose pickle exceeds
+    :attr:`minSize` are pickled on their own and stored once per batch of jobs pickled together,
+    in a file of the job store. Objects that are equal but distinct share the file but are still
+    unpickled as distinct objects. The file belongs to the job whose successors are being pickled,
+    just like the pickled jobs, so it is deleted along with that job. The pickled jobs merely
+    reference the file and the digest of its contents. Workers keep the pickles they read in a
+    directory of the workflow directory on their node, such that each shared object is usually
+    only downloaded once per node. The size of that directory is limited by the sharedPicklesSize
+    option, beyond which the least recently used pickles are deleted.
+
+    Objects that contain promises are never shared since each job a promise is passed to needs
+    its own reference to the promised value.
+    """
+    tag = 'toil.job.SharedPickles'
+
+    minSize = 64 * 1024
+    """
+    The minimum size in bytes of the pickle of a shared object
+    """
+
+    minLength = 64
+    """
+    The minimum number of items in a shared container. Smaller containers are not considered
+    for sharing as their pickle is unlikely to exceed minSize.
+    """
+
+    def __init__(self, jobStore, jobStoreID=None):
+        """
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore: the job store to \
+        store the shared objects in
+        :param str jobStoreID: the ID of the job the files holding the shared objects belong to. \
+        The files are deleted with that job.
+        """
+        self.jobStore = jobStore
+        self.jobStoreID = jobStoreID
+        # Maps the IDs of the objects considered for sharing so far to a tuple of the object,
+        # such that its ID can't be reused, and its persistent ID or None if it isn't shared
+        self.objects = {}
+        # Maps the digests of the objects stored so far to the IDs of the files holding them,
+        # such that equal objects are only stored once
+        self._stored = {}
+        # Numbers the shared objects, such that each has its own persistent ID
+        self._objectNumbers = itertools.count()
+
+    def dumps(self, obj):
+        """
+        Pickles the given object, storing the large objects it references in the job store.
+
+        :rtype: str
+        """
+        # The persistent ID hook is called for every object in the pickle. Nothing in a pickle
+        # smaller than minSize can be shared though, and most jobs pickle to much less than that,
+        # so they are pickled without the hook first.
+        data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+        if len(data) < self.minSize:
+            return data
+        return self._dumps(obj, self._persistentID)
+
+    def _dumps(self, obj, persistentID):
+        fileHandle = BytesIO()
+        pickler = cPickle.Pickler(fileHandle, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistentID
+        pickler.dump(obj)
+        return fileHandle.getvalue()
+
+    def _persistentID(self, obj):
+        objType = type(obj)
+        if objType is str or objType is unicode:
+            if len(obj) < self.minSize:
+                return None
+        elif objType in (dict, list, tuple, set, frozenset):
+            if len(obj) < self.minLength:
+                return None
+        else:
+            return None
+        try:
+            return self.objects[id(obj)][1]
+        except KeyError:
+            pass
+        pickledCount = Promise.pickledCount
+        # Pickle the object on its own, sharing the large objects nested in it
+        data = self._dumps(obj, lambda nested: None if nested is obj else self._persistentID(nested))
+        if len(data) < self.minSize or Promise.pickledCount != pickledCount:
+            persistentID = None
+        else:
+            digest = sha1(data).hexdigest()
+            try:
+                fileStoreID = self._stored[digest]
+            except KeyError:
+                with self.jobStore.writeFileStream(self.jobStoreID) as (fileHandle, fileStoreID):
+                    fileHandle.write(compressPickle(data))
+                self._stored[digest] = fileStoreID
+            # Equal objects that are distinct must remain so when unpickled, so each gets its
+            # own persistent ID even if they are stored in the same file
+            persistentID = (self.tag, self.jobStore.config.jobStore, digest, fileStoreID,
+                            next(self._objectNumbers))
+        self.objects[id(obj)] = obj, persistentID
+        return persistentID
+
+    @classmethod
+    def load(cls, jobStore, digest, fileStoreID):
+        """
+        Returns the pickle of the shared object with the given digest, reading it from the local
+        copy on this node if there is one.
+
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore: the job store \
+        containing the shared object
+        :param str digest: the digest of the pickle
+        :param str fileStoreID: the ID of the file in the job store holding the pickle
+        :rtype: str
+        """
+        config = jobStore.config
+        localDir = os.path.join(Toil.getWorkflowDir(config.workflowID, config.workDir),
+                                pickleDirName(config.workflowID))
+        localPath = os.path.join(localDir, digest)
+        try:
+            with open(localPath, 'rb') as f:
+                data = decompressPickle(f.read())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            # The modification time of a local copy is the time of its last use, see _evict
+            try:
+                os.utime(localPath, None)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            return data
+        with jobStore.readFileStream(fileStoreID) as fileHandle:
+            compressedData = fileHandle.read()
+        data = decompressPickle(compressedData)
+        if sha1(data).hexdigest() != digest:
+            raise RuntimeError('The shared object %s is corrupted' % digest)
+        try:
+            os.mkdir(localDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file first so concurrent workers never read a partial copy
+        fd, tmpPath = tempfile.mkstemp(dir=localDir, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(compressedData)
+        os.rename(tmpPath, localPath)
+        cls._evict(localDir, config.sharedPicklesSize)
+        return data
+
+    @staticmethod
+    def _evict(localDir, maxSize):
+        """
+        Deletes the least recently used local copies of shared objects until the size of the
+        given directory is within the given limit. The workers on a node share the directory, so
+        this is done while holding a lock on it.
+        """
+        with open(os.path.join(localDir, '.lock'), 'w') as lockFile:
+            flock(lockFile, LOCK_EX)
+            try:
+                localFiles = []
+                for fileName in os.listdir(localDir):
+                    # Skip the lock and the copies still being written
+                    if fileName.startswith('.'):
+                        continue
+                    localPath = os.path.join(localDir, fileName)
+                    try:
+                        fileStats = os.stat(localPath)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                    else:
+                        localFiles.append((fileStats.st_mtime, fileStats.st_size, localPath))
+                localFiles.sort()
+                size = sum(fileSize for _, fileSize, _ in localFiles)
+                for _, fileSize, localPath in localFiles:
+                    if size <= maxSize:
+                        break
+                    # A worker that already opened the file can still read it
+                    os.remove(localPath)
+                    size -= fileSize
+            finally:
+                flock(lockFile, LOCK_UN)
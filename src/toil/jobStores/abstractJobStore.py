@@ -20,6 +20,7 @@ import re
 from abc import ABCMeta, abstractmethod
 from contextlib import contextmanager
 from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 from uuid import uuid4
 from toil.job import JobException
 from bd2k.util import memoize
@@ -560,6 +561,19 @@ class AbstractJobStore(object):
         """
         raise NotImplementedError()
 
+    def createMany(self, jobArgs):
+        """
+        Creates a jobWrapper for each of the given sets of arguments to :meth:`create` and returns
+        the jobWrappers in the same order. Job stores that support batched requests should
+        override this method.
+
+        :param list[dict] jobArgs: a dictionary of keyword arguments to :meth:`create` for each
+               job to be created
+
+        :rtype: list[toil.jobWrapper.JobWrapper]
+        """
+        return self._mapConcurrently(lambda kwargs: self.create(**kwargs), jobArgs)
+
     @abstractmethod
     def exists(self, jobStoreID):
         """
@@ -618,6 +632,24 @@ class AbstractJobStore(object):
         """
         raise NotImplementedError()
 
+    def loadMany(self, jobStoreIDs):
+        """
+        Loads the jobs referenced by the given IDs. Unlike :meth:`load`, this method silently
+        skips jobs that do not exist, such that the returned list may be shorter than the given
+        one. Job stores that support batched requests should override this method.
+
+        :param list[str] jobStoreIDs: the IDs of the jobs to load
+
+        :rtype: list[toil.jobWrapper.JobWrapper]
+        """
+        def load(jobStoreID):
+            try:
+                return self.load(jobStoreID)
+            except NoSuchJobException:
+                return None
+
+        return [job for job in self._mapConcurrently(load, jobStoreIDs) if job is not None]
+
     @abstractmethod
     def update(self, job):
         """
@@ -627,6 +659,16 @@ class AbstractJobStore(object):
         """
         raise NotImplementedError()
 
+    def updateMany(self, jobs):
+        """
+        Persists the given jobs in this store. Each job is updated atomically but the jobs may be
+        updated in any order. Job stores that support batched requests should override this
+        method.
+
+        :param list[toil.jobWrapper.JobWrapper] jobs: the jobs to write to this job store
+        """
+        self._mapConcurrently(self.update, jobs)
+
     @abstractmethod
     def delete(self, jobStoreID):
         """
@@ -640,6 +682,45 @@ class AbstractJobStore(object):
         """
         raise NotImplementedError()
 
+    def deleteMany(self, jobStoreIDs):
+        """
+        Deletes the given jobs from this job store. The jobs may be deleted in any order, so
+        callers that need some jobs to be deleted before others must delete them in separate
+        calls. Like :meth:`delete`, this operation is idempotent. Job stores that support batched
+        requests should override this method.
+
+        :param list[str] jobStoreIDs: the IDs of the jobs to delete from this job store
+        """
+        self._mapConcurrently(self.delete, jobStoreIDs)
+
+    def commit(self, job, jobsToDelete=(), filesToDelete=()):
+        """
+        Persists the given job and then removes the given jobs and files from this job store.
+        This is how a worker finishes a job.
+
+        The job is first updated with its filesToDelete attribute set to the given files, so that
+        if the deletions are interrupted, :meth:`clean` can complete them later. Once the
+        deletions are done, the job is updated again with an empty filesToDelete attribute.
+        Subclasses may override this method to batch these requests, but must preserve the order
+        in which their effects become visible.
+
+        :param toil.jobWrapper.JobWrapper job: the job to write to this job store
+
+        :param collections.Iterable[str] jobsToDelete: the IDs of jobs to delete after the job
+               has been updated
+
+        :param collections.Iterable[str] filesToDelete: the IDs of files to delete after the job
+               has been updated
+        """
+        filesToDelete = list(filesToDelete)
+        job.filesToDelete = filesToDelete
+        self.update(job)
+        self.deleteMany(list(jobsToDelete))
+        self.deleteFiles(filesToDelete)
+        if filesToDelete:
+            job.filesToDelete = []
+            self.update(job)
+
     def jobs(self):
         """
         Best effort attempt to return iterator on all jobs in the store. The iterator may not
@@ -709,6 +790,26 @@ class AbstractJobStore(object):
         """
         raise NotImplementedError()
 
+    def writeFilesFromStrings(self, strings, jobStoreID=None):
+        """
+        Writes each of the given strings to a new file in this job store, using up to
+        maxConcurrentRequests concurrent uploads.
+
+        :param list[str] strings: the contents of the files to write
+
+        :param str jobStoreID: the id of a job, or None. If specified, the files will be
+               associated with that job, see :meth:`writeFileStream`.
+
+        :return: the IDs of the newly created files, in the order of the given strings
+        :rtype: list[str]
+        """
+        def write(string):
+            with self.writeFileStream(jobStoreID) as (fileHandle, jobStoreFileID):
+                fileHandle.write(string)
+            return jobStoreFileID
+
+        return self._mapConcurrently(write, strings)
+
     @abstractmethod
     def getEmptyFileStoreID(self, jobStoreID=None):
         """
@@ -751,6 +852,63 @@ class AbstractJobStore(object):
         """
         raise NotImplementedError()
 
+    def readFileRange(self, jobStoreFileID, offset, length):
+        """
+        Reads part of the file referenced by jobStoreFileID. Job stores that can fetch a range of
+        bytes without reading the file from its start should override this method, which skips
+        over the data before the range in a stream of the file.
+
+        :param str jobStoreFileID: ID of the file to read from
+
+        :param int offset: the position in the file of the first byte to read
+
+        :param int length: the maximum number of bytes to read
+
+        :return: the bytes read, which are fewer than length if the range extends past the end of
+                 the file
+        :rtype: str
+        """
+        assert offset >= 0 and length >= 0
+        with self.readFileStream(jobStoreFileID) as readable:
+            while offset > 0:
+                buf = readable.read(min(offset, 1024 * 1024))
+                if not buf:
+                    return ''
+                offset -= len(buf)
+            return readable.read(length)
+
+    def readFilesToStrings(self, jobStoreFileIDs):
+        """
+        Reads the files with the given IDs, using up to maxConcurrentRequests concurrent
+        downloads.
+
+        :param list[str] jobStoreFileIDs: IDs of the files to read
+
+        :return: the contents of the files, in the order of the given IDs
+        :rtype: list[str]
+        """
+        def read(jobStoreFileID):
+            with self.readFileStream(jobStoreFileID) as fileHandle:
+                return fileHandle.read()
+
+        return self._mapConcurrently(read, jobStoreFileIDs)
+
+    def getFileDigest(self, jobStoreFileID):
+        """
+        Returns a digest of the contents of the file with the given ID, if this job store can
+        determine it without downloading the file. Files with equal digests have equal contents,
+        which allows caches on worker nodes to share files between workflows, see
+        :class:`toil.job.Job.CachedFileStore`. Job stores that record checksums of the files
+        they hold should override this method.
+
+        :param str jobStoreFileID: ID of the file
+
+        :return: a string naming the digest algorithm and the digest in a form that is safe to
+                 use as a file name, or None if the digest is not known
+        :rtype: str|None
+        """
+        return None
+
     @abstractmethod
     def deleteFile(self, jobStoreFileID):
         """
@@ -761,6 +919,17 @@ class AbstractJobStore(object):
         """
         raise NotImplementedError()
 
+    def deleteFiles(self, jobStoreFileIDs):
+        """
+        Deletes the files with the given IDs from this job store. Like :meth:`deleteFile`, this
+        operation is idempotent. Job stores that support batched requests should override this
+        method.
+
+        :param list[str] jobStoreFileIDs: IDs of the files to delete
+        """
+        for jobStoreFileID in jobStoreFileIDs:
+            self.deleteFile(jobStoreFileID)
+
     @abstractmethod
     def fileExists(self, jobStoreFileID):
         """
@@ -883,6 +1052,28 @@ class AbstractJobStore(object):
 
     ## Helper methods for subclasses
 
+    # The number of requests that batch methods like loadMany() may have in flight at the same
+    # time. Job stores backed by a remote service should raise this to hide request latency.
+    maxConcurrentRequests = 1
+
+    def _mapConcurrently(self, function, items):
+        """
+        Applies the given function to each of the given items using up to maxConcurrentRequests
+        threads and returns the results in the order of the items.
+
+        :rtype: list
+        """
+        items = list(items)
+        numThreads = min(self.maxConcurrentRequests, len(items))
+        if numThreads <= 1:
+            return map(function, items)
+        pool = ThreadPool(numThreads)
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
     def _defaultTryCount(self):
         return int(self.config.retryCount + 1)
 
@@ -41,8 +41,9 @@ from boto.exception import SDBResponseError, S3ResponseError
 from toil.jobStores.abstractJobStore import (AbstractJobStore, NoSuchJobException,
                                              ConcurrentFileModificationException,
                                              NoSuchFileException)
-from toil.jobStores.aws.sdbUtils import (SDBHelper, retry_sdb, no_such_domain, sdb_unavailable,
-                                         monkeyPatchSdbConnection)
+from toil.jobStores.aws.sdbUtils import (SDBHelper, retry_sdb, retry_s3, no_such_domain,
+                                         sdb_unavailable, monkeyPatchSdbConnection,
+                                         MultiDeleteError)
 from toil.jobWrapper import JobWrapper
 import toil.lib.encryption as encryption
 
@@ -184,18 +185,26 @@ class AWSJobStore(AbstractJobStore):
         self.sseKeyPath = self.config.sseKey
 
     def create(self, command, memory, cores, disk, preemptable, predecessorNumber=0):
-        jobStoreID = self._newJobID()
+        job = self._newJob(command, memory, cores, disk, preemptable, predecessorNumber)
         log.debug("Creating job %s for '%s'",
-                  jobStoreID, '<no command>' if command is None else command)
-        job = AWSJob(jobStoreID=jobStoreID, command=command,
-                     memory=memory, cores=cores, disk=disk, preemptable=preemptable,
-                     remainingRetryCount=self._defaultTryCount(), logJobStoreFileID=None,
-                     predecessorNumber=predecessorNumber)
+                  job.jobStoreID, '<no command>' if command is None else command)
         for attempt in retry_sdb():
             with attempt:
                 assert self.jobsDomain.put_attributes(*job.toItem())
         return job
 
+    def _newJob(self, command, memory, cores, disk, preemptable, predecessorNumber=0):
+        return AWSJob(jobStoreID=self._newJobID(), command=command,
+                      memory=memory, cores=cores, disk=disk, preemptable=preemptable,
+                      remainingRetryCount=self._defaultTryCount(), logJobStoreFileID=None,
+                      predecessorNumber=predecessorNumber)
+
+    def createMany(self, jobArgs):
+        jobs = [self._newJob(**kwargs) for kwargs in jobArgs]
+        log.debug("Creating %d job(s)", len(jobs))
+        self._putJobs(jobs)
+        return jobs
+
     def exists(self, jobStoreID):
         for attempt in retry_sdb():
             with attempt:
@@ -227,44 +236,180 @@ class AWSJobStore(AbstractJobStore):
         log.debug("Loaded job %s", jobStoreID)
         return job
 
+    def loadMany(self, jobStoreIDs):
+        n = self.itemsPerSelect
+
+        def select(batch):
+            query = "select * from `%s` where itemName() in (%s)" % (
+                self.jobsDomain.name, ', '.join("'%s'" % jobStoreID for jobStoreID in batch))
+            for attempt in retry_sdb():
+                with attempt:
+                    return list(self.jobsDomain.select(consistent_read=True, query=query))
+
+        batches = [jobStoreIDs[i:i + n] for i in range(0, len(jobStoreIDs), n)]
+        jobs = [AWSJob.fromItem(item)
+                for items in self._mapConcurrently(select, batches)
+                for item in items]
+        log.debug("Loaded %d of %d job(s)", len(jobs), len(jobStoreIDs))
+        return jobs
+
     def update(self, job):
         log.debug("Updating job %s", job.jobStoreID)
         for attempt in retry_sdb():
             with attempt:
                 assert self.jobsDomain.put_attributes(*job.toItem())
 
+    def updateMany(self, jobs):
+        log.debug("Updating %d job(s)", len(jobs))
+        self._putJobs(jobs)
+
+    # SimpleDB allows at most 25 items and 1 MB of attributes in a BatchPutAttributes request
+    itemsPerBatchPut = 25
+    maxBatchPutSize = 1024 * 1024
+
+    def _putJobs(self, jobs):
+        """
+        Writes the given jobs to the jobs domain using concurrent batch requests.
+        """
+        batches = []
+        batch, batchSize = {}, 0
+        for job in jobs:
+            itemName, attributes = job.toItem()
+            itemSize = len(itemName) + sum(len(name) + len(value)
+                                           for name, value in attributes.iteritems())
+            if batch and (len(batch) == self.itemsPerBatchPut
+                          or batchSize + itemSize > self.maxBatchPutSize):
+                batches.append(batch)
+                batch, batchSize = {}, 0
+            batch[itemName] = attributes
+            batchSize += itemSize
+        if batch:
+            batches.append(batch)
+
+        def put(batch):
+            for attempt in retry_sdb():
+                with attempt:
+                    assert self.jobsDomain.batch_put_attributes(batch)
+
+        self._mapConcurrently(put, batches)
+
     itemsPerBatchDelete = 25
 
+    maxConcurrentRequests = 16
+
+    # SimpleDB allows at most 20 values in an IN comparison
+    itemsPerSelect = 20
+
     def delete(self, jobStoreID):
-        # remove job and replace with jobStoreId.
-        log.debug("Deleting job %s", jobStoreID)
-        for attempt in retry_sdb():
-            with attempt:
-                self.jobsDomain.delete_attributes(item_name=jobStoreID)
-        items = None
-        for attempt in retry_sdb():
-            with attempt:
-                items = list(self.filesDomain.select(
-                    consistent_read=True,
-                    query="select version from `%s` where ownerID='%s'" % (
-                        self.filesDomain.name, jobStoreID)))
-        assert items is not None
+        self.deleteMany([jobStoreID])
+
+    def deleteMany(self, jobStoreIDs):
+        # remove jobs and the files associated with them, using batch requests
+        n = self.itemsPerBatchDelete
+        for i in range(0, len(jobStoreIDs), n):
+            batch = jobStoreIDs[i:i + n]
+            log.debug("Deleting job(s) %s", ', '.join(batch))
+            for attempt in retry_sdb():
+                with attempt:
+                    self.jobsDomain.batch_delete_attributes({jobStoreID: None
+                                                             for jobStoreID in batch})
+        items = self._selectFileItems('ownerID', jobStoreIDs)
         if items:
-            log.debug("Deleting %d file(s) associated with job %s", len(items), jobStoreID)
-            n = self.itemsPerBatchDelete
-            batches = [items[i:i + n] for i in range(0, len(items), n)]
-            for batch in batches:
-                itemsDict = {item.name: None for item in batch}
+            log.debug("Deleting %d file(s) associated with job(s)", len(items))
+            self._deleteFileItems(items)
+
+    def _selectFileItems(self, attribute, values, condition=None):
+        """
+        Returns the version attribute of every item in the files domain whose given attribute
+        has one of the given values.
+
+        :param str attribute: the attribute to match, e.g. 'ownerID' or 'itemName()'
+        :param list[str] values: the values to match
+        :param str|None condition: an additional condition the items must satisfy
+        :rtype: list[Item]
+        """
+        items = []
+        n = self.itemsPerSelect
+        for i in range(0, len(values), n):
+            query = "select version from `%s` where %s in (%s)" % (
+                self.filesDomain.name, attribute,
+                ', '.join("'%s'" % value for value in values[i:i + n]))
+            if condition is not None:
+                query += " and " + condition
+            batchItems = None
+            for attempt in retry_sdb():
+                with attempt:
+                    batchItems = list(self.filesDomain.select(consistent_read=True, query=query))
+            assert batchItems is not None
+            items.extend(batchItems)
+        return items
+
+    def _deleteFileItems(self, items):
+        """
+        Deletes the given items from the files domain and their content from the files bucket.
+
+        SDB's batch deletes can't be made conditional, so the version of each item is deleted
+        first, by value. That leaves the version of an item that was updated since it was
+        selected in place, and such items are then deleted one by one, on the condition that
+        their version hasn't changed again, like FileInfo.delete() does. That way, the content
+        of a concurrent update isn't orphaned in the bucket.
+
+        :param list[Item] items: items selected from the files domain, including their version
+        """
+        n = self.itemsPerBatchDelete
+        batches = [items[i:i + n] for i in range(0, len(items), n)]
+        keys = []
+        for batch in batches:
+            versioned = {item.name: {'version': item['version']}
+                         for item in batch if item.get('version') is not None}
+            if versioned:
+                for attempt in retry_sdb():
+                    with attempt:
+                        self.filesDomain.batch_delete_attributes(versioned)
+                changedItems = self._selectFileItems('itemName()', list(versioned),
+                                                     condition='version is not null')
+            else:
+                changedItems = []
+            changed = {item.name: item['version'] for item in changedItems}
+            for name, version in changed.iteritems():
+                log.debug("File %s was updated while being deleted", name)
+                for attempt in retry_sdb():
+                    with attempt:
+                        self.filesDomain.delete_attributes(name, expected_values=['version',
+                                                                                  version])
+            itemsDict = {item.name: None for item in batch if item.name not in changed}
+            if itemsDict:
                 for attempt in retry_sdb():
                     with attempt:
                         self.filesDomain.batch_delete_attributes(itemsDict)
-            for item in items:
+            for item in batch:
                 version = item.get('version')
                 if version:
-                    self.filesBucket.delete_key(key_name=item.name,
-                                                version_id=version)
-                else:
-                    self.filesBucket.delete_key(key_name=item.name)
+                    keys.append((item.name, version))
+                elif version is None:
+                    keys.append(item.name)
+                # else the content was stored inline and there is nothing in the bucket
+                if changed.get(item.name):
+                    keys.append((item.name, changed[item.name]))
+        if keys:
+            self._deleteKeys(keys)
+
+    def _deleteKeys(self, keys):
+        """
+        Deletes the given keys from the files bucket using S3's multi-object delete, a single
+        request per 1000 keys. Keys that S3 fails to delete are retried and if any remain, an
+        exception is raised.
+
+        :param list[str|(str,str)] keys: the names of the keys to delete, or (name, version)
+               pairs for a particular version of a key
+        """
+        for attempt in retry_s3():
+            with attempt:
+                result = self.filesBucket.delete_keys(keys, quiet=True)
+                if result.errors:
+                    keys = [(error.key, error.version_id) if error.version_id else error.key
+                            for error in result.errors]
+                    raise MultiDeleteError(result.errors)
 
     def getEmptyFileStoreID(self, jobStoreID=None):
         info = self.FileInfo.create(jobStoreID)
@@ -390,6 +535,15 @@ class AWSJobStore(AbstractJobStore):
         with info.downloadStream() as readable:
             yield readable
 
+    def readFileRange(self, jobStoreFileID, offset, length):
+        assert offset >= 0 and length >= 0
+        info = self.FileInfo.loadOrFail(jobStoreFileID)
+        log.debug("Reading %i bytes at offset %i of %r.", length, offset, info)
+        return info.downloadRange(offset, length)
+
+    def getFileDigest(self, jobStoreFileID):
+        return self.FileInfo.loadOrFail(jobStoreFileID).digest()
+
     @contextmanager
     def readSharedFileStream(self, sharedFileName):
         assert self._validateSharedFileName(sharedFileName)
@@ -406,6 +560,12 @@ class AWSJobStore(AbstractJobStore):
         else:
             info.delete()
 
+    def deleteFiles(self, jobStoreFileIDs):
+        items = self._selectFileItems('itemName()', list(jobStoreFileIDs))
+        if items:
+            log.debug("Deleting %d file(s)", len(items))
+            self._deleteFileItems(items)
+
     def writeStatsAndLogging(self, statsAndLoggingString):
         info = self.FileInfo.create(str(self.statsFileOwnerID))
         with info.uploadStream(multipart=False) as writeable:
@@ -936,6 +1096,48 @@ class AWSJobStore(AbstractJobStore):
                     yield readable
                     thread.join()
 
+        def downloadRange(self, offset, length):
+            """
+            :return: up to length bytes of the file, starting at the given offset
+            :rtype: str
+            """
+            if self.content is not None:
+                return self.content[offset:offset + length]
+            elif self.version:
+                if length == 0:
+                    return ''
+                headers = self._s3EncryptionHeaders()
+                headers['Range'] = 'bytes=%i-%i' % (offset, offset + length - 1)
+                key = self.outer.filesBucket.get_key(self.fileID, validate=False)
+                try:
+                    return key.get_contents_as_string(headers=headers, version_id=self.version)
+                except S3ResponseError as e:
+                    # The range starts past the end of the file
+                    if e.status == 416:
+                        return ''
+                    raise
+            else:
+                assert False
+
+        def digest(self):
+            """
+            :return: a digest of this file's content, see AbstractJobStore.getFileDigest
+            :rtype: str|None
+            """
+            if self.content is not None:
+                return 'sha1-' + hashlib.sha1(self.content).hexdigest()
+            elif self.version and not self.encrypted:
+                key = self.outer.filesBucket.get_key(self.fileID, version_id=self.version)
+                etag = key.etag.strip('"')
+                # The ETag of an object uploaded in parts isn't the MD5 of its content. It is
+                # derived from the MD5s of the parts, so it only matches that of an object with
+                # the same content uploaded in parts of the same size.
+                return ('s3etag-' if '-' in etag else 'md5-') + etag
+            else:
+                # The ETag of an object encrypted with a customer-provided key is not derived
+                # from its content.
+                return None
+
         def delete(self):
             store = self.outer
             if self.previousVersion is not None:
@@ -1026,6 +1228,7 @@ class AWSJob(JobWrapper, SDBHelper):
     """
     A Job that can be converted to and from an SDB item.
     """
+    __slots__ = ()
 
     @classmethod
     def fromItem(cls, item):
@@ -1035,7 +1238,11 @@ class AWSJob(JobWrapper, SDBHelper):
         """
         binary, _ = cls.attributesToBinary(item)
         assert binary is not None
-        return cPickle.loads(binary)
+        if cls.isEncoded(binary):
+            return cls.decode(binary)
+        else:
+            # Written by an older version of Toil
+            return cPickle.loads(binary)
 
     def toItem(self):
         """
@@ -1047,4 +1254,4 @@ class AWSJob(JobWrapper, SDBHelper):
         :rtype: (str,dict)
         :return: a str for the item's name and a dictionary for the item's attributes
         """
-        return self.jobStoreID, self.binaryToAttributes(cPickle.dumps(self))
+        return self.jobStoreID, self.binaryToAttributes(self.encode())
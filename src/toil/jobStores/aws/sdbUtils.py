@@ -18,7 +18,7 @@ import bz2
 from contextlib import contextmanager
 import logging
 import types
-from boto.exception import SDBResponseError, BotoServerError
+from boto.exception import SDBResponseError, BotoServerError, S3ResponseError
 import time
 
 log = logging.getLogger(__name__)
@@ -60,6 +60,8 @@ class SDBHelper(object):
     True
 
     """
+    __slots__ = ()
+
     # The SDB documentation is not clear as to whether the attribute value size limit of 1024
     # applies to the base64-encoded value or the raw value. It suggests that responses are
     # automatically encoded from which I conclude that the limit should apply to the raw,
@@ -190,6 +192,32 @@ def sdb_unavailable(e):
     return e.__class__ == BotoServerError and e.status.startswith("503")
 
 
+# Error codes of S3 requests that may succeed when they are repeated
+s3_transient_error_codes = {'InternalError', 'OperationAborted', 'RequestTimeout',
+                            'ServiceUnavailable', 'SlowDown'}
+
+
+class MultiDeleteError(S3ResponseError):
+    """
+    Raised when some of the keys in an S3 multi-object delete could not be deleted.
+    """
+
+    def __init__(self, errors):
+        """
+        :param list[boto.s3.multidelete.Error] errors: the errors reported for the keys
+        """
+        transient = any(error.code in s3_transient_error_codes for error in errors)
+        super(MultiDeleteError, self).__init__(503 if transient else 400,
+                                               'Failed to delete %i key(s)' % len(errors))
+        self.errors = errors
+        self.error_code = errors[0].code
+
+
+def s3_transient(e):
+    return (isinstance(e, S3ResponseError)
+            and (e.status >= 500 or e.error_code in s3_transient_error_codes))
+
+
 def true(_):
     return True
 
@@ -292,3 +320,12 @@ def retry_sdb(retry_after=a_short_time,
             yield
 
         yield single_attempt()
+
+
+def retry_s3(retry_after=a_short_time,
+             retry_for=10 * a_short_time,
+             retry_while=s3_transient):
+    """
+    Like retry_sdb() but by default, retries S3 operations that failed in a transient way.
+    """
+    return retry_sdb(retry_after=retry_after, retry_for=retry_for, retry_while=retry_while)
@@ -18,6 +18,8 @@ import logging
 from contextlib import contextmanager
 import inspect
 import bz2
+import base64
+import hashlib
 import cPickle
 import socket
 import httplib
@@ -126,6 +128,8 @@ class AzureJobStore(AbstractJobStore):
     # Length of a jobID - used to test if a stats file has been read already or not
     jobIDLength = len(str(uuid.uuid4()))
 
+    maxConcurrentRequests = 16
+
     def qualify(self, name):
         return self.namePrefix + self.nameSeparator + name
 
@@ -147,16 +151,23 @@ class AzureJobStore(AbstractJobStore):
         logger.info("Processed %d total jobs" % total_processed)
 
     def create(self, command, memory, cores, disk, preemptable, predecessorNumber=0):
-        jobStoreID = self._newJobID()
-        job = AzureJob(jobStoreID=jobStoreID, command=command,
-                       memory=memory, cores=cores, disk=disk, preemptable=preemptable,
-                       remainingRetryCount=self._defaultTryCount(), logJobStoreFileID=None,
-                       predecessorNumber=predecessorNumber)
+        job = self._newJob(command, memory, cores, disk, preemptable, predecessorNumber)
         entity = job.toItem(chunkSize=self.jobChunkSize)
-        entity['RowKey'] = jobStoreID
+        entity['RowKey'] = job.jobStoreID
         self.jobItems.insert_entity(entity=entity)
         return job
 
+    def _newJob(self, command, memory, cores, disk, preemptable, predecessorNumber=0):
+        return AzureJob(jobStoreID=self._newJobID(), command=command,
+                        memory=memory, cores=cores, disk=disk, preemptable=preemptable,
+                        remainingRetryCount=self._defaultTryCount(), logJobStoreFileID=None,
+                        predecessorNumber=predecessorNumber)
+
+    def createMany(self, jobArgs):
+        jobs = [self._newJob(**kwargs) for kwargs in jobArgs]
+        self._writeJobs(jobs, insert=True)
+        return jobs
+
     def exists(self, jobStoreID):
         if self.jobItems.get_entity(row_key=jobStoreID) is None:
             return False
@@ -172,16 +183,136 @@ class AzureJobStore(AbstractJobStore):
         self.jobItems.update_entity(row_key=job.jobStoreID,
                                     entity=job.toItem(chunkSize=self.jobChunkSize))
 
+    def updateMany(self, jobs):
+        self._writeJobs(jobs, insert=False)
+
+    # An entity group transaction may contain at most 100 operations
+    maxBatchOperations = 100
+
+    # The payload of an entity group transaction may be at most 4 MB
+    maxBatchSize = 4 * 1024 * 1024
+
+    def _writeJobs(self, jobs, insert):
+        """
+        Inserts or updates the given jobs using concurrent entity group transactions. The jobs of
+        a transaction that fails are written with separate requests.
+        """
+        batches = []
+        batch, batchSize = [], 0
+        for job in jobs:
+            entity = job.toItem(chunkSize=self.jobChunkSize)
+            # Leave some room for the request headers of each operation
+            entitySize = sum(len(prop.value) for prop in entity.itervalues()) + 1024
+            if batch and (len(batch) == self.maxBatchOperations
+                          or batchSize + entitySize > self.maxBatchSize):
+                batches.append(batch)
+                batch, batchSize = [], 0
+            batch.append((job.jobStoreID, entity))
+            batchSize += entitySize
+        if batch:
+            batches.append(batch)
+
+        def writeEntity(jobItems, jobStoreID, entity):
+            if insert:
+                entity['RowKey'] = jobStoreID
+                jobItems.insert_entity(entity=entity)
+            else:
+                jobItems.update_entity(row_key=jobStoreID, entity=entity)
+
+        def write(batch):
+            try:
+                with self._entityGroupTransaction() as tableService:
+                    jobItems = AzureTable(tableService, self.jobItems.tableName)
+                    for jobStoreID, entity in batch:
+                        writeEntity(jobItems, jobStoreID, entity)
+            except AzureException as e:
+                logger.debug("Failed to write %d jobs in a single transaction, falling back to "
+                             "separate requests: %s", len(batch), e)
+                for jobStoreID, entity in batch:
+                    writeEntity(self.jobItems, jobStoreID, entity)
+
+        self._mapConcurrently(write, batches)
+
     def delete(self, jobStoreID):
         try:
             self.jobItems.delete_entity(row_key=jobStoreID)
         except AzureMissingResourceHttpError:
             # Job deletion is idempotent, and this job has been deleted already
             return
-        filterString = "PartitionKey eq '%s'" % jobStoreID
-        for fileEntity in self.jobFileIDs.query_entities(filter=filterString):
-            jobStoreFileID = fileEntity.RowKey
-            self.deleteFile(jobStoreFileID)
+        self._deleteJobFiles([jobStoreID])
+
+    def deleteMany(self, jobStoreIDs):
+        n = self.maxBatchOperations
+        for i in range(0, len(jobStoreIDs), n):
+            batch = jobStoreIDs[i:i + n]
+            try:
+                with self._entityGroupTransaction() as tableService:
+                    jobItems = AzureTable(tableService, self.jobItems.tableName)
+                    for jobStoreID in batch:
+                        jobItems.delete_entity(row_key=jobStoreID)
+            except AzureException:
+                # The transaction fails as a whole if any of the jobs has been deleted already
+                for jobStoreID in batch:
+                    self.delete(jobStoreID)
+            else:
+                self._deleteJobFiles(batch)
+
+    def commit(self, job, jobsToDelete=(), filesToDelete=()):
+        jobsToDelete = list(jobsToDelete)
+        filesToDelete = list(filesToDelete)
+        job.filesToDelete = filesToDelete
+        committed = False
+        if len(jobsToDelete) < self.maxBatchOperations:
+            # Update the job and delete the jobs chained to it in a single transaction
+            try:
+                with self._entityGroupTransaction() as tableService:
+                    jobItems = AzureTable(tableService, self.jobItems.tableName)
+                    jobItems.update_entity(row_key=job.jobStoreID,
+                                           entity=job.toItem(chunkSize=self.jobChunkSize))
+                    for jobStoreID in jobsToDelete:
+                        jobItems.delete_entity(row_key=jobStoreID)
+            except AzureException as e:
+                logger.debug("Failed to commit job %s in a single transaction, falling back to "
+                             "separate requests: %s", job.jobStoreID, e)
+            else:
+                committed = True
+                self._deleteJobFiles(jobsToDelete)
+        if not committed:
+            self.update(job)
+            self.deleteMany(jobsToDelete)
+        self.deleteFiles(filesToDelete)
+        if filesToDelete:
+            job.filesToDelete = []
+            self.update(job)
+
+    @contextmanager
+    def _entityGroupTransaction(self):
+        """
+        A context manager yielding a TableService whose requests are queued and then committed
+        as a single entity group transaction when the context exits. All requests must concern
+        the same partition of the same table and there may be at most maxBatchOperations of them.
+
+        A dedicated TableService is used so requests made concurrently by other threads, e.g.
+        by the asynchronous file writers of a worker, don't end up in the transaction.
+        """
+        tableService = TableService(account_key=self.account_key, account_name=self.accountName)
+        tableService.begin_batch()
+        try:
+            yield tableService
+        except:
+            tableService.cancel_batch()
+            raise
+        else:
+            tableService.commit_batch()
+
+    def _deleteJobFiles(self, jobStoreIDs):
+        """
+        Deletes the files associated with the given, already deleted jobs.
+        """
+        for jobStoreID in jobStoreIDs:
+            filterString = "PartitionKey eq '%s'" % jobStoreID
+            fileEntities = self.jobFileIDs.query_entities(filter=filterString)
+            self.deleteFiles([fileEntity.RowKey for fileEntity in fileEntities])
 
     def deleteJobStore(self):
         self.registryTable.delete_entity(row_key=self.namePrefix)
@@ -264,6 +395,17 @@ class AzureJobStore(AbstractJobStore):
         except AzureMissingResourceHttpError:
             pass
 
+    def deleteFiles(self, jobStoreFileIDs):
+        deleted = []
+        for jobStoreFileID in jobStoreFileIDs:
+            try:
+                self.files.delete_blob(blob_name=jobStoreFileID)
+            except AzureMissingResourceHttpError:
+                pass
+            else:
+                deleted.append(jobStoreFileID)
+        self._dissociateFilesFromJobs(deleted)
+
     def fileExists(self, jobStoreFileID):
         # As Azure doesn't have a blob_exists method (at least in the
         # python API) we just try to download the metadata, and hope
@@ -303,6 +445,34 @@ class AzureJobStore(AbstractJobStore):
         with self._downloadStream(jobStoreFileID, self.files) as fd:
             yield fd
 
+    def readFileRange(self, jobStoreFileID, offset, length):
+        assert offset >= 0 and length >= 0
+        try:
+            blobProps = self.files.get_blob_properties(blob_name=jobStoreFileID)
+        except AzureMissingResourceHttpError:
+            raise NoSuchFileException(jobStoreFileID)
+        if strict_bool(blobProps['x-ms-meta-encrypted']):
+            # Encrypted blobs consist of separately encrypted chunks whose boundaries in the blob
+            # differ from those of the plain text, so the range can't be mapped onto the blob.
+            return super(AzureJobStore, self).readFileRange(jobStoreFileID, offset, length)
+        end = min(offset + length, int(blobProps['Content-Length']))
+        if offset >= end:
+            return ''
+        return self.files.get_blob(blob_name=jobStoreFileID,
+                                   x_ms_range="bytes=%d-%d" % (offset, end - 1))
+
+    def getFileDigest(self, jobStoreFileID):
+        try:
+            blobProps = self.files.get_blob_properties(blob_name=jobStoreFileID)
+        except AzureMissingResourceHttpError:
+            raise NoSuchFileException(jobStoreFileID)
+        # The Content-MD5 of an encrypted blob is that of the cipher text. Blobs written by older
+        # versions of Toil don't have one.
+        contentMD5 = blobProps.get('content-md5')
+        if strict_bool(blobProps.get('x-ms-meta-encrypted', 'False')) or not contentMD5:
+            return None
+        return 'md5-' + base64.b64decode(contentMD5).encode('hex')
+
     @contextmanager
     def writeSharedFileStream(self, sharedFileName, isProtected=None):
         sharedFileID = self._newFileID(sharedFileName)
@@ -397,6 +567,36 @@ class AzureJobStore(AbstractJobStore):
             jobStoreID = entities[0].PartitionKey
             self.jobFileIDs.delete_entity(partition_key=jobStoreID, row_key=jobStoreFileID)
 
+    # A table query filter may contain at most 15 discrete comparisons
+    maxFilterComparisons = 15
+
+    def _dissociateFilesFromJobs(self, jobStoreFileIDs):
+        """
+        Batched version of _dissociateFileFromJob: queries the associations of up to
+        maxFilterComparisons files at a time and deletes them with one transaction per job.
+        """
+        entitiesByJob = {}
+        n = self.maxFilterComparisons
+        for i in range(0, len(jobStoreFileIDs), n):
+            filterString = ' or '.join("RowKey eq '%s'" % jobStoreFileID
+                                       for jobStoreFileID in jobStoreFileIDs[i:i + n])
+            for entity in self.jobFileIDs.query_entities(filter=filterString):
+                entitiesByJob.setdefault(entity.PartitionKey, []).append(entity.RowKey)
+        n = self.maxBatchOperations
+        for jobStoreID, fileIDs in entitiesByJob.iteritems():
+            for i in range(0, len(fileIDs), n):
+                batch = fileIDs[i:i + n]
+                try:
+                    with self._entityGroupTransaction() as tableService:
+                        jobFileIDs = AzureTable(tableService, self.jobFileIDs.tableName)
+                        for jobStoreFileID in batch:
+                            jobFileIDs.delete_entity(partition_key=jobStoreID,
+                                                     row_key=jobStoreFileID)
+                except AzureException:
+                    # Another worker may have removed some of the associations concurrently
+                    for jobStoreFileID in batch:
+                        self._dissociateFileFromJob(jobStoreFileID)
+
     def _getOrCreateTable(self, tableName):
         # This will not fail if the table already exists.
         for attempt in retry_on_error():
@@ -450,6 +650,10 @@ class AzureJobStore(AbstractJobStore):
             with os.fdopen(writable_fh, 'w') as writable:
                 def reader():
                     blockIDs = []
+                    # The service doesn't compute the MD5 of a blob committed from blocks, so it
+                    # is recorded here for getFileDigest(). Encrypted blobs are left out since
+                    # the digest of their plain text would be stored in the clear.
+                    md5 = None if encrypted else hashlib.md5()
                     try:
                         while True:
                             buf = readable.read(maxBlockSize)
@@ -459,6 +663,8 @@ class AzureJobStore(AbstractJobStore):
                                 break
                             if encrypted:
                                 buf = encryption.encrypt(buf, self.keyPath)
+                            else:
+                                md5.update(buf)
                             blockID = self._newFileID()
                             container.put_block(blob_name=jobStoreFileID,
                                                 block=buf,
@@ -470,6 +676,7 @@ class AzureJobStore(AbstractJobStore):
                         container.delete_blob(blob_name=jobStoreFileID)
                         raise
 
+                    contentMD5 = None if md5 is None else base64.b64encode(md5.digest())
                     if checkForModification and expectedVersion is not None:
                         # Acquire a (60-second) write lock,
                         leaseID = container.lease_blob(blob_name=jobStoreFileID,
@@ -485,6 +692,7 @@ class AzureJobStore(AbstractJobStore):
                         container.put_block_list(blob_name=jobStoreFileID,
                                                  block_list=blockIDs,
                                                  x_ms_lease_id=leaseID,
+                                                 x_ms_blob_content_md5=contentMD5,
                                                  x_ms_meta_name_values=dict(
                                                      encrypted=str(encrypted)))
                         # then release the lock.
@@ -496,6 +704,7 @@ class AzureJobStore(AbstractJobStore):
                         # was there.
                         container.put_block_list(blob_name=jobStoreFileID,
                                                  block_list=blockIDs,
+                                                 x_ms_blob_content_md5=contentMD5,
                                                  x_ms_meta_name_values=dict(
                                                      encrypted=str(encrypted)))
 
@@ -665,6 +874,8 @@ class AzureJob(JobWrapper):
     fact that Azure properties must start with a letter or underscore.
     """
 
+    __slots__ = ()
+
     defaultAttrs = ['PartitionKey', 'RowKey', 'etag', 'Timestamp']
 
     @classmethod
@@ -691,7 +902,11 @@ class AzureJob(JobWrapper):
             wholeJobString = chunkedJob[0][1].value
         else:
             wholeJobString = ''.join(item[1].value for item in chunkedJob)
-        return cPickle.loads(bz2.decompress(wholeJobString))
+        if cls.isEncoded(wholeJobString):
+            return cls.decode(wholeJobString)
+        else:
+            # Written by an older version of Toil
+            return cPickle.loads(bz2.decompress(wholeJobString))
 
     def toItem(self, chunkSize=maxAzureTablePropertySize):
         """
@@ -701,7 +916,7 @@ class AzureJob(JobWrapper):
         """
         assert chunkSize <= maxAzureTablePropertySize
         item = {}
-        serializedAndEncodedJob = bz2.compress(cPickle.dumps(self))
+        serializedAndEncodedJob = self.encode()
         jobChunks = [serializedAndEncodedJob[i:i + chunkSize]
                      for i in range(0, len(serializedAndEncodedJob), chunkSize)]
         for attributeOrder, chunk in enumerate(jobChunks):
@@ -23,7 +23,9 @@ import os
 import tempfile
 import stat
 import errno
+from hashlib import sha1
 from toil.lib.bioio import absSymPath
+from toil.lib.fileCopy import copyFile, copyFileObj
 from toil.jobStores.abstractJobStore import (AbstractJobStore, NoSuchJobException,
                                              NoSuchFileException)
 from toil.jobWrapper import JobWrapper
@@ -87,6 +89,27 @@ class FileJobStore(AbstractJobStore):
         self.update(job)
         return job
 
+    def createMany(self, jobArgs):
+        # Unlike create(), this remembers the temporary directories known to exist across the
+        # batch and writes each job directly instead of going through update()
+        tryCount = self._defaultTryCount()
+        existingDirs = set()
+        jobs = []
+        for kwargs in jobArgs:
+            absJobDir = tempfile.mkdtemp(prefix="job", dir=self._getTempSharedDir(existingDirs))
+            os.mkdir(os.path.join(absJobDir, "g"))
+            kwargs = dict(kwargs)
+            kwargs.setdefault('predecessorNumber', 0)
+            job = JobWrapper(jobStoreID=self._getRelativePath(absJobDir),
+                             remainingRetryCount=tryCount, **kwargs)
+            jobFile = os.path.join(absJobDir, "job")
+            # The job only exists once the rename completes, see jobs()
+            with open(jobFile + ".new", 'w') as f:
+                f.write(job.encode())
+            os.rename(jobFile + ".new", jobFile)
+            jobs.append(job)
+        return jobs
+
     def exists(self, jobStoreID):
         return os.path.exists(self._getJobFileName(jobStoreID))
 
@@ -110,7 +133,12 @@ class FileJobStore(AbstractJobStore):
         # Load a valid version of the job
         jobFile = self._getJobFileName(jobStoreID)
         with open(jobFile, 'r') as fileHandle:
-            job = JobWrapper.fromDict(pickler.load(fileHandle))
+            data = fileHandle.read()
+        if JobWrapper.isEncoded(data):
+            job = JobWrapper.decode(data)
+        else:
+            # Written by an older version of Toil
+            job = JobWrapper.fromDict(pickler.loads(data))
         # The following cleans up any issues resulting from the failure of the
         # job during writing by the batch system.
         if os.path.isfile(jobFile + ".new"):
@@ -125,7 +153,7 @@ class FileJobStore(AbstractJobStore):
         # Atomicity guarantees use the fact the underlying file systems "move"
         # function is atomic.
         with open(self._getJobFileName(job.jobStoreID) + ".new", 'w') as f:
-            pickler.dump(job.toDict(), f)
+            f.write(job.encode())
         # This should be atomic for the file system
         os.rename(self._getJobFileName(job.jobStoreID) + ".new", self._getJobFileName(job.jobStoreID))
 
@@ -153,7 +181,7 @@ class FileJobStore(AbstractJobStore):
     def _importFile(self, otherCls, url):
         if issubclass(otherCls, FileJobStore):
             fd, absPath = self._getTempFile()
-            shutil.copyfile(self._extractPathFromUrl(url), absPath)
+            copyFile(self._extractPathFromUrl(url), absPath)
             os.close(fd)
             return self._getRelativePath(absPath)
         else:
@@ -161,19 +189,19 @@ class FileJobStore(AbstractJobStore):
 
     def _exportFile(self, otherCls, jobStoreFileID, url):
         if issubclass(otherCls, FileJobStore):
-            shutil.copyfile(self._getAbsPath(jobStoreFileID), self._extractPathFromUrl(url))
+            copyFile(self._getAbsPath(jobStoreFileID), self._extractPathFromUrl(url))
         else:
             super(FileJobStore, self)._exportFile(otherCls, jobStoreFileID, url)
 
     @classmethod
     def _readFromUrl(cls, url, writable):
         with open(cls._extractPathFromUrl(url), 'r') as f:
-            writable.write(f.read())
+            copyFileObj(f, writable)
 
     @classmethod
     def _writeToUrl(cls, readable, url):
         with open(cls._extractPathFromUrl(url), 'w') as f:
-            f.write(readable.read())
+            copyFileObj(readable, f)
 
     @staticmethod
     def _extractPathFromUrl(url):
@@ -190,7 +218,7 @@ class FileJobStore(AbstractJobStore):
 
     def writeFile(self, localFilePath, jobStoreID=None):
         fd, absPath = self._getTempFile(jobStoreID)
-        shutil.copyfile(localFilePath, absPath)
+        copyFile(localFilePath, absPath)
         os.close(fd)
         return self._getRelativePath(absPath)
 
@@ -207,7 +235,9 @@ class FileJobStore(AbstractJobStore):
 
     def updateFile(self, jobStoreFileID, localFilePath):
         self._checkJobStoreFileID(jobStoreFileID)
-        shutil.copyfile(localFilePath, self._getAbsPath(jobStoreFileID))
+        absPath = self._getAbsPath(jobStoreFileID)
+        self._removeDigest(absPath)
+        copyFile(localFilePath, absPath)
 
     def readFile(self, jobStoreFileID, localFilePath):
         self._checkJobStoreFileID(jobStoreFileID)
@@ -229,12 +259,42 @@ class FileJobStore(AbstractJobStore):
                     raise
         else:
             # ... otherwise we have to copy it.
-            shutil.copyfile(jobStoreFilePath, localFilePath)
+            copyFile(jobStoreFilePath, localFilePath)
+
+    def getFileDigest(self, jobStoreFileID):
+        # The files are local, so hashing one is cheaper than copying it to a different file
+        # system. The digest is recorded next to the file, so each file is only hashed once.
+        self._checkJobStoreFileID(jobStoreFileID)
+        absPath = self._getAbsPath(jobStoreFileID)
+        digestPath = self._getDigestPath(absPath)
+        fileVersion = self._getFileVersion(absPath)
+        try:
+            with open(digestPath, 'r') as f:
+                recordedVersion, digest = f.read().rsplit(' ', 1)
+        except (IOError, ValueError):
+            pass
+        else:
+            if recordedVersion == fileVersion:
+                return digest
+        digest = sha1()
+        with open(absPath, 'r') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                digest.update(chunk)
+        digest = 'sha1-' + digest.hexdigest()
+        # A digest of a file that was updated while it was hashed would be wrong for both versions
+        if self._getFileVersion(absPath) == fileVersion:
+            fd, tempDigestPath = tempfile.mkstemp(suffix=".new", dir=os.path.dirname(absPath))
+            with os.fdopen(fd, 'w') as f:
+                f.write(fileVersion + ' ' + digest)
+            os.rename(tempDigestPath, digestPath)  # This operation is atomic
+        return digest
 
     def deleteFile(self, jobStoreFileID):
         if not self.fileExists(jobStoreFileID):
             return
-        os.remove(self._getAbsPath(jobStoreFileID))
+        absPath = self._getAbsPath(jobStoreFileID)
+        self._removeDigest(absPath)
+        os.remove(absPath)
 
     def fileExists(self, jobStoreFileID):
         absPath = self._getAbsPath(jobStoreFileID)
@@ -252,7 +312,9 @@ class FileJobStore(AbstractJobStore):
         # File objects are context managers (CM) so we could simply return what open returns.
         # However, it is better to wrap it in another CM so as to prevent users from accessing
         # the file object directly, without a with statement.
-        with open(self._getAbsPath(jobStoreFileID), 'w') as f:
+        absPath = self._getAbsPath(jobStoreFileID)
+        self._removeDigest(absPath)
+        with open(absPath, 'w') as f:
             yield f
 
     @contextmanager
@@ -261,6 +323,13 @@ class FileJobStore(AbstractJobStore):
         with open(self._getAbsPath(jobStoreFileID), 'r') as f:
             yield f
 
+    def readFileRange(self, jobStoreFileID, offset, length):
+        assert offset >= 0 and length >= 0
+        self._checkJobStoreFileID(jobStoreFileID)
+        with open(self._getAbsPath(jobStoreFileID), 'r') as f:
+            f.seek(offset)
+            return f.read(length)
+
     ##########################################
     # The following methods deal with shared files, i.e. files not associated
     # with specific jobs.
@@ -353,16 +422,50 @@ class FileJobStore(AbstractJobStore):
         if not self.fileExists(jobStoreFileID):
             raise NoSuchFileException("File %s does not exist in jobStore" % jobStoreFileID)
 
-    def _getTempSharedDir(self):
+    @staticmethod
+    def _getDigestPath(absPath):
+        """
+        :rtype : string, string is the path to the file recording the digest of the file at the
+        given path, see getFileDigest().
+        """
+        return absPath + '.sha1'
+
+    @staticmethod
+    def _getFileVersion(absPath):
+        """
+        :rtype : string, string identifies the current contents of the file at the given path.
+        It changes whenever the file is replaced or written to.
+        """
+        st = os.stat(absPath)
+        return '%d-%d-%r' % (st.st_ino, st.st_size, st.st_mtime)
+
+    def _removeDigest(self, absPath):
+        """
+        Removes the recorded digest of the file at the given path, if any.
+        """
+        try:
+            os.remove(self._getDigestPath(absPath))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _getTempSharedDir(self, existingDirs=None):
         """
         Gets a temporary directory in the hierarchy of directories in self.tempFilesDir.
         This directory may contain multiple shared jobs/files.
-        
+
+        :param set existingDirs: if given, the directories known to exist. The directories on
+               the path to the returned directory are added to it.
+
         :rtype : string, path to temporary directory in which to place files/directories.
         """
         tempDir = self.tempFilesDir
         for i in xrange(self.levels):
             tempDir = os.path.join(tempDir, random.choice(self.validDirs))
+            if existingDirs is not None:
+                if tempDir in existingDirs:
+                    continue
+                existingDirs.add(tempDir)
             if not os.path.exists(tempDir):
                 try:
                     os.mkdir(tempDir)
@@ -110,6 +110,9 @@ class GoogleJobStore(AbstractJobStore):
                 except boto.exception.GSResponseError:
                     pass
 
+    # Each job is a separate object in the bucket, so the batch methods write them concurrently
+    maxConcurrentRequests = 16
+
     def create(self, command, memory, cores, disk, preemptable, predecessorNumber=0):
         jobStoreID = self._newID()
         job = JobWrapper(jobStoreID=jobStoreID,
@@ -117,7 +120,7 @@ class GoogleJobStore(AbstractJobStore):
                          remainingRetryCount=self._defaultTryCount(), logJobStoreFileID=None,
                          preemptable=preemptable,
                          predecessorNumber=predecessorNumber)
-        self._writeString(jobStoreID, cPickle.dumps(job))
+        self._writeString(jobStoreID, job.encode())
         return job
 
     def exists(self, jobStoreID):
@@ -144,10 +147,14 @@ class GoogleJobStore(AbstractJobStore):
             jobString = self._readContents(jobStoreID)
         except NoSuchFileException:
             raise NoSuchJobException(jobStoreID)
-        return cPickle.loads(jobString)
+        if JobWrapper.isEncoded(jobString):
+            return JobWrapper.decode(jobString)
+        else:
+            # Written by an older version of Toil
+            return cPickle.loads(jobString)
 
     def update(self, job):
-        self._writeString(job.jobStoreID, cPickle.dumps(job), update=True)
+        self._writeString(job.jobStoreID, job.encode(), update=True)
 
     def delete(self, jobStoreID):
         # jobs will always be encrypted when avaliable
@@ -191,6 +198,30 @@ class GoogleJobStore(AbstractJobStore):
         with self.readSharedFileStream(jobStoreFileID, isProtected=True) as readable:
             yield readable
 
+    def readFileRange(self, jobStoreFileID, offset, length):
+        assert offset >= 0 and length >= 0
+        headers = self.encryptedHeaders
+        key = self._getKey(jobStoreFileID, headers)
+        if length == 0:
+            return ''
+        headers = dict(headers, Range='bytes=%i-%i' % (offset, offset + length - 1))
+        try:
+            return key.get_contents_as_string(headers=headers)
+        except boto.exception.GSResponseError as e:
+            # The range starts past the end of the file
+            if e.status == 416:
+                return ''
+            raise
+
+    def getFileDigest(self, jobStoreFileID):
+        if self.sseKeyPath is not None:
+            # The hashes of objects encrypted with a customer-supplied key aren't reliable, see
+            # self._writeFile
+            return None
+        # Composite objects only have a CRC32C
+        md5 = self._getKey(jobStoreFileID, self.headerValues).cloud_hashes.get('md5')
+        return None if md5 is None else 'md5-' + md5.encode('hex')
+
     def deleteFile(self, jobStoreFileID):
         headers = self.encryptedHeaders
         try:
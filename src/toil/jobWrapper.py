@@ -13,6 +13,8 @@
 # limitations under the License.
 from __future__ import absolute_import
 import logging
+import marshal
+import zlib
 
 logger = logging.getLogger( __name__ )
 
@@ -23,6 +25,14 @@ class JobWrapper( object ):
     scripts is persisted separately since it may be much bigger than the state managed by this
     class and should therefore only be held in memory for brief periods of time.
     """
+    # The leader holds a job wrapper in memory for every job in the workflow, so the attributes
+    # are stored in slots rather than in a per-instance dictionary.
+    __slots__ = ('command', 'memory', 'cores', 'disk', 'preemptable', 'jobStoreID',
+                 'remainingRetryCount', 'predecessorNumber', 'filesToDelete',
+                 'predecessorsFinished', 'stack', 'services', 'startJobStoreID',
+                 'terminateJobStoreID', 'errorJobStoreID', 'logJobStoreFileID', 'checkpoint',
+                 'checkpointFilesToDelete')
+
     def __init__( self, command, memory, cores, disk, preemptable,
                   jobStoreID, remainingRetryCount, predecessorNumber,
                   filesToDelete=None, predecessorsFinished=None, 
@@ -61,9 +71,10 @@ class JobWrapper( object ):
         # predecessorNumber then the job can be run.
         self.predecessorsFinished = predecessorsFinished or set()
         
-        # The list of successor jobs to run. Successor jobs are stored as 5-tuples of the form (
-        # jobStoreId, memory, cores, disk, predecessorNumber). Successor jobs are run in reverse
-        # order from the stack.
+        # The list of successor jobs to run. Successor jobs are stored as 6-tuples of the form (
+        # jobStoreId, memory, cores, disk, preemptable, predecessorID). Successor jobs are run in
+        # reverse order from the stack. A list of successors that is on the stack must not be
+        # modified in place, replace it instead, see copy().
         self.stack = stack or []
         
         # A jobStoreFileID of the log file for a job. This will be none unless the job failed and
@@ -118,18 +129,106 @@ class JobWrapper( object ):
 
     # Serialization support methods
 
+    # Job wrappers are encoded as a magic string, the version of the encoding and a codec
+    # character followed by the marshalled tuple of the values of the attributes in the order of
+    # __slots__. Attributes added in later versions must therefore be appended to __slots__.
+    # Unlike the dictionary returned by toDict() the tuple doesn't repeat the attribute names in
+    # every record and marshal is much faster than pickle. Large records, i.e. those of jobs with
+    # many successors, are compressed.
+    _magic = '\x00JW'
+    _version = 1
+    _uncompressed, _compressed = 'm', 'z'
+    _compressionThreshold = 4096
+
+    @classmethod
+    def isEncoded(cls, data):
+        """
+        Returns True if the given string was produced by :meth:`encode`, or False if it is a job
+        wrapper that was serialised by an older version of Toil.
+
+        :param str data: a serialised job wrapper
+        :rtype: bool
+        """
+        return data.startswith(cls._magic)
+
+    def encode(self):
+        """
+        Returns a compact binary representation of this job wrapper that can be turned back into
+        a job wrapper with :meth:`decode`.
+
+        :rtype: str
+        """
+        data = marshal.dumps(tuple(getattr(self, name) for name in JobWrapper.__slots__))
+        if len(data) > self._compressionThreshold:
+            codec, data = self._compressed, zlib.compress(data, 1)
+        else:
+            codec = self._uncompressed
+        return self._magic + chr(self._version) + codec + data
+
+    @classmethod
+    def decode(cls, data):
+        """
+        Returns the job wrapper encoded in the given string by :meth:`encode`.
+
+        :param str data: the encoded job wrapper
+        :rtype: JobWrapper
+        """
+        if not cls.isEncoded(data):
+            raise ValueError('Not an encoded job wrapper')
+        offset = len(cls._magic)
+        version, codec = ord(data[offset]), data[offset + 1]
+        if version > cls._version:
+            raise ValueError('The job wrapper was encoded with version %i of the encoding but only '
+                             'versions up to %i are supported' % (version, cls._version))
+        data = buffer(data, offset + 2)
+        if codec == cls._compressed:
+            data = zlib.decompress(data)
+        elif codec != cls._uncompressed:
+            raise ValueError("Unknown codec '%s' in encoded job wrapper" % codec)
+        values = marshal.loads(data)
+        # Attributes that were appended to __slots__ by a later version are ignored, and those
+        # that a prior version didn't have get their default value
+        return cls(**dict(zip(JobWrapper.__slots__, values)))
+
     def toDict( self ):
-        return self.__dict__.copy( )
+        d = {name: getattr(self, name) for name in JobWrapper.__slots__ if hasattr(self, name)}
+        # Subclasses without __slots__ may have additional attributes
+        d.update(getattr(self, '__dict__', {}))
+        return d
 
     @classmethod
     def fromDict( cls, d ):
         return cls( **d )
 
+    def __getstate__(self):
+        return self.toDict()
+
+    def __setstate__(self, state):
+        # Also used to unpickle job wrappers pickled by older versions of Toil
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     def copy(self):
         """
+        Returns a copy of this job wrapper that can be modified without affecting the original.
+
+        The segments of the stack, i.e. the lists of successor tuples, are never modified in place
+        once they have been added to the stack, only popped off or replaced. They are therefore
+        shared between the copy and the original so that the cost of copying is proportional to
+        the depth of the stack rather than the number of successors on it. The remaining
+        containers are small and are copied.
+
         :rtype: JobWrapper
         """
-        return self.__class__( **self.__dict__ )
+        d = self.toDict()
+        d['stack'] = list(self.stack)
+        # Service lists are appended to while services are serialised, so copy them
+        d['services'] = [list(serviceJobList) for serviceJobList in self.services]
+        d['filesToDelete'] = list(self.filesToDelete)
+        d['predecessorsFinished'] = set(self.predecessorsFinished)
+        if self.checkpointFilesToDelete is not None:
+            d['checkpointFilesToDelete'] = list(self.checkpointFilesToDelete)
+        return self.__class__( **d )
     
     def __hash__( self ):
         return hash( self.jobStoreID )
@@ -149,7 +248,7 @@ class JobWrapper( object ):
         return not self.__eq__( other )
 
     def __repr__( self ):
-        return '%s( **%r )' % ( self.__class__.__name__, self.__dict__ )
+        return '%s( **%r )' % ( self.__class__.__name__, self.toDict() )
     
     def __str__(self):
         return str(self.toDict())
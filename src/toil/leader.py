@@ -689,10 +689,12 @@ def mainLoop(config, batchSystem, provisioner, jobStore, rootJobWrapper, jobCach
         raise FailedJobsException( config.jobStore, len(toilState.totalFailedJobs) )
 
     # Parse out the return value from the root job
+    from toil.job import decompressPickle
     with jobStore.readSharedFileStream("rootJobReturnValue") as jobStoreFileID:
         with jobStore.readFileStream(jobStoreFileID.read()) as fH:
             try:
-                return cPickle.load(fH)  # rootJobReturnValue
+                # The file maps the index of the promised value to the value itself
+                return cPickle.loads(decompressPickle(fH.read()))[None]  # rootJobReturnValue
             except EOFError:
                 logger.exception("Failed to unpickle root job return value")
                 raise FailedJobsException(jobStoreFileID, toilState.totalFailedJobs)
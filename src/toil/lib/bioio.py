@@ -19,6 +19,8 @@ import sys
 import os
 import logging
 import resource
+import threading
+import time
 import logging.handlers
 import tempfile
 import random
@@ -158,7 +160,7 @@ def getTotalCpuTimeAndMemoryUsage():
     me = resource.getrusage(resource.RUSAGE_SELF)
     childs = resource.getrusage(resource.RUSAGE_CHILDREN)
     totalCPUTime = me.ru_utime+me.ru_stime+childs.ru_utime+childs.ru_stime
-    totalMemoryUsage = me.ru_maxrss+ me.ru_maxrss
+    totalMemoryUsage = me.ru_maxrss + childs.ru_maxrss
     return totalCPUTime, totalMemoryUsage
 
 def getTotalCpuTime():
@@ -171,6 +173,157 @@ def getTotalMemoryUsage():
     """
     return getTotalCpuTimeAndMemoryUsage()[1]
 
+def getProcessTreeMemoryUsage(pid=None):
+    """Gets the resident set size in KB of the given process and all of its live descendants,
+    as reported by /proc. Returns None if /proc is unavailable.
+
+    :param int pid: the root of the process tree, defaults to the current process
+    :rtype: int|None
+    """
+    if pid is None:
+        pid = os.getpid()
+    try:
+        pids = [int(p) for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return None
+    children = {}
+    for p in pids:
+        try:
+            with open('/proc/%d/stat' % p) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue  # The process went away
+        # The command name in field 2 may contain spaces, so parse from the closing parenthesis
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(p)
+    pageSize = resource.getpagesize()
+    total = 0
+    pending = [pid]
+    while pending:
+        p = pending.pop()
+        try:
+            with open('/proc/%d/statm' % p) as f:
+                total += int(f.read().split()[1]) * pageSize
+        except (IOError, OSError):
+            continue
+        pending.extend(children.get(p, ()))
+    return total / 1024
+
+def getIOCounters():
+    """Gets the number of bytes read from and written to storage by the current process,
+    including any children it has waited for, as reported by /proc/self/io. Returns (0, 0) if
+    the counters are unavailable.
+
+    :rtype: tuple(int, int)
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                counters[key] = int(value)
+    except (IOError, OSError, ValueError):
+        return 0, 0
+    return counters.get('read_bytes', 0), counters.get('write_bytes', 0)
+
+def getDirSize(dirName):
+    """Gets the number of bytes occupied by the files in the given directory tree, counting
+    hard-linked files once.
+
+    :rtype: int
+    """
+    total = 0
+    seen = set()
+    for root, dirs, files in os.walk(dirName):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue  # The file was removed while we were walking
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+class ResourceMonitor(object):
+    """Tracks the resources used by the current process tree between calls to start() and
+    stop(): cpu time, peak resident memory of the process and its descendants, bytes read and
+    written and the high-water mark of disk usage in a directory. Memory and disk are sampled by a
+    daemon thread, the other counters are deltas of rusage and /proc/self/io.
+
+    Measuring the disk usage walks the whole directory tree, so it is done less and less often,
+    up to every maxDiskInterval seconds, and once more when sampling stops.
+    """
+    def __init__(self, dirName=None, interval=1.0, maxDiskInterval=60.0):
+        """
+        :param str dirName: the directory whose disk usage should be tracked, if any
+        :param float interval: the number of seconds between samples
+        :param float maxDiskInterval: the maximum number of seconds between measurements of the
+               disk usage
+        """
+        self.dirName = dirName
+        self.interval = interval
+        self.maxDiskInterval = max(interval, maxDiskInterval)
+        self.peakMemory = 0
+        self.peakDisk = 0
+        self._stopEvent = threading.Event()
+        self._thread = None
+        self._startClock = None
+        self._startIO = None
+        self._startChildMemory = None
+        self._diskInterval = interval
+        self._nextDiskSample = 0
+
+    def _sample(self, final=False):
+        memory = getProcessTreeMemoryUsage()
+        if memory is not None:
+            self.peakMemory = max(self.peakMemory, memory)
+        if self.dirName is not None and (final or time.time() >= self._nextDiskSample):
+            self._sampleDisk()
+
+    def _sampleDisk(self):
+        # Other users of the file system, like the cache, free space and fill it up independently
+        # of the directory, so only walking the directory tells whether it grew
+        self.peakDisk = max(self.peakDisk, getDirSize(self.dirName))
+        self._diskInterval = min(2 * self._diskInterval, self.maxDiskInterval)
+        self._nextDiskSample = time.time() + self._diskInterval
+
+    def _run(self):
+        while not self._stopEvent.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._startClock = getTotalCpuTime()
+        self._startIO = getIOCounters()
+        self._startChildMemory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        self._sample()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and returns the resources used since start() was called.
+
+        :return: the keys clock (seconds), memory (KB), readBytes, writeBytes and disk (bytes)
+        :rtype: dict
+        """
+        self._stopEvent.set()
+        self._thread.join()
+        self._sample(final=True)
+        # A child that ran and was reaped between samples is only visible through rusage. The
+        # children's maxrss is a lifetime maximum, so it only tells us something if it grew.
+        childMemory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if childMemory > self._startChildMemory:
+            self.peakMemory = max(self.peakMemory, childMemory)
+        readBytes, writeBytes = getIOCounters()
+        return dict(clock=getTotalCpuTime() - self._startClock,
+                    memory=self.peakMemory,
+                    readBytes=readBytes - self._startIO[0],
+                    writeBytes=writeBytes - self._startIO[1],
+                    disk=self.peakDisk)
+
 def absSymPath(path):
     """like os.path.abspath except it doesn't dereference symlinks
     """
@@ -0,0 +1,203 @@
+# Copyright (C) 2015 UCSC Computational Genomics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Copies files without pulling their contents through user space where the operating system allows
+it. On file systems that can share data between files, like XFS or btrfs, a copy of a whole file
+is made by reflinking it, which takes constant time and space. Otherwise the kernel copies the
+data with copy_file_range() or sendfile(), and if neither works the data is copied in chunks of
+bounded size, so files are never read into memory as a whole.
+"""
+
+from __future__ import absolute_import
+
+import ctypes
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import sys
+
+# The ioctl making a file share the data of another one, from linux/fs.h
+FICLONE = 0x40049409
+
+# The maximum number of bytes copied by a single system call
+maxChunkSize = 1 << 30
+
+# The size of the chunks copied in user space when the system calls can't be used
+defaultBufferSize = 1024 * 1024
+
+# The errors with which the system calls signal that they can't copy between the given files
+_unsupportedErrors = frozenset((errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                                errno.ENOTTY, errno.EBADF, errno.ETXTBSY, errno.EPERM,
+                                errno.EOVERFLOW))
+
+
+def _libcFunction(name, argtypes):
+    """
+    :return: the function of the given name in the C library, or None if the library doesn't
+             have it or the platform is not Linux
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        # The symbols of the running program include those of the C library
+        function = getattr(ctypes.CDLL(None, use_errno=True), name)
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = argtypes
+    function.restype = ctypes.c_ssize_t
+    return function
+
+
+_offsetPointer = ctypes.POINTER(ctypes.c_int64)
+_copyFileRange = _libcFunction('copy_file_range', [ctypes.c_int, _offsetPointer, ctypes.c_int,
+                                                   _offsetPointer, ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _libcFunction('sendfile', [ctypes.c_int, ctypes.c_int, _offsetPointer,
+                                       ctypes.c_size_t])
+
+
+def copyFile(srcPath, dstPath):
+    """
+    Copies the contents of the file at srcPath to dstPath, like :func:`shutil.copyfile`.
+
+    :param str srcPath: the path of the file to copy
+    :param str dstPath: the path of the copy, which is overwritten if it exists
+    """
+    try:
+        if os.path.samefile(srcPath, dstPath):
+            raise shutil.Error("`%s` and `%s` are the same file" % (srcPath, dstPath))
+    except OSError:
+        pass
+    with open(srcPath, 'rb') as src:
+        with open(dstPath, 'wb') as dst:
+            copyFileObj(src, dst)
+
+
+def copyFileObj(src, dst, bufferSize=defaultBufferSize):
+    """
+    Copies the contents of the file object src from its current position to the file object dst,
+    like :func:`shutil.copyfileobj`. If both objects are backed by file descriptors, the kernel
+    copies the data.
+
+    :param src: the file object to read from
+    :param dst: the file object to write to
+    :param int bufferSize: the size of the chunks to copy if the data has to be copied in user
+           space
+    """
+    try:
+        srcFd, dstFd = src.fileno(), dst.fileno()
+    except (AttributeError, IOError, ValueError):
+        pass
+    else:
+        if _copyFd(src, srcFd, dst, dstFd):
+            return
+    shutil.copyfileobj(src, dst, bufferSize)
+
+
+def _copyFd(src, srcFd, dst, dstFd):
+    """
+    Copies the data from src to dst using the system calls working on their file descriptors.
+    The positions of the file objects are updated to reflect the data copied, so the rest of the
+    data can be copied in user space if the system calls stopped early.
+
+    :return: True if all data was copied and False otherwise
+    :rtype: bool
+    """
+    if not stat.S_ISREG(os.fstat(srcFd).st_mode):
+        return False
+    dstIsFile = stat.S_ISREG(os.fstat(dstFd).st_mode)
+    dst.flush()
+    # The file objects buffer data, so the positions of the descriptors can differ from theirs.
+    # The data is therefore copied between explicit offsets.
+    srcOffset = ctypes.c_int64(src.tell())
+    dstOffset = ctypes.c_int64(dst.tell()) if dstIsFile else None
+    copiers = []
+    if dstIsFile:
+        if srcOffset.value == 0 and dstOffset.value == 0 and os.fstat(dstFd).st_size == 0:
+            copiers.append(_reflink)
+        if _copyFileRange is not None:
+            copiers.append(_copyFileRangeChunks)
+    if _sendfile is not None:
+        copiers.append(_sendfileChunks)
+    try:
+        return any(copier(srcFd, srcOffset, dstFd, dstOffset) for copier in copiers)
+    finally:
+        src.seek(srcOffset.value)
+        if dstIsFile:
+            dst.seek(dstOffset.value)
+
+
+def _reflink(srcFd, srcOffset, dstFd, dstOffset):
+    """
+    Makes the empty file dstFd share the data of the file srcFd.
+
+    :return: True if the file system supports it and False otherwise
+    :rtype: bool
+    """
+    try:
+        fcntl.ioctl(dstFd, FICLONE, srcFd)
+    except (IOError, OSError) as e:
+        if e.errno in _unsupportedErrors:
+            return False
+        raise
+    srcOffset.value = dstOffset.value = os.fstat(srcFd).st_size
+    return True
+
+
+def _copyChunks(copyChunk):
+    """
+    Calls the given system call until it reports the end of the source file.
+
+    :param copyChunk: a function copying up to the given number of bytes and returning the number
+           of bytes copied, or -1 on error
+    :return: True if all data was copied and False if the system call can't copy between the
+             files
+    :rtype: bool
+    """
+    copied = 0
+    while True:
+        chunkSize = copyChunk(maxChunkSize)
+        if chunkSize > 0:
+            copied += chunkSize
+        elif chunkSize == 0:
+            # The system calls copy nothing from files that report a size of zero without being
+            # empty, like those in procfs, so these are left to be copied in user space
+            return copied > 0
+        else:
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            elif error in _unsupportedErrors:
+                return False
+            raise OSError(error, os.strerror(error))
+
+
+def _copyFileRangeChunks(srcFd, srcOffset, dstFd, dstOffset):
+    # The kernel advances both offsets
+    return _copyChunks(lambda count: _copyFileRange(srcFd, ctypes.byref(srcOffset),
+                                                    dstFd, ctypes.byref(dstOffset), count, 0))
+
+
+def _sendfileChunks(srcFd, srcOffset, dstFd, dstOffset):
+    # The kernel advances the source offset, but writes to the current position of dstFd
+    def sendChunk(count):
+        chunkSize = _sendfile(dstFd, srcFd, ctypes.byref(srcOffset), count)
+        if chunkSize > 0 and dstOffset is not None:
+            dstOffset.value += chunkSize
+        return chunkSize
+    if dstOffset is not None:
+        os.lseek(dstFd, dstOffset.value, os.SEEK_SET)
+    return _copyChunks(sendChunk)
@@ -317,6 +317,10 @@ class ModuleDescriptor(namedtuple('ModuleDescriptor', ('dirPath', 'name'))):
     >>> rmtree( dirPath )
     """
 
+    # Caches the results of forModule() and globalize(), which are invoked for every job created
+    _forModuleCache = {}
+    _globalizeCache = {}
+
     @classmethod
     def forModule(cls, name):
         """
@@ -326,6 +330,15 @@ class ModuleDescriptor(namedtuple('ModuleDescriptor', ('dirPath', 'name'))):
         specified name has already been loaded.
         """
         module = sys.modules[name]
+        key = cls, name, module.__file__
+        try:
+            return cls._forModuleCache[key]
+        except KeyError:
+            descriptor = cls._forModuleCache[key] = cls._forModule(name, module)
+            return descriptor
+
+    @classmethod
+    def _forModule(cls, name, module):
         filePath = os.path.abspath(module.__file__)
         filePath = filePath.split(os.path.sep)
         filePath[-1], extension = os.path.splitext(filePath[-1])
@@ -430,6 +443,13 @@ class ModuleDescriptor(namedtuple('ModuleDescriptor', ('dirPath', 'name'))):
         """
         Reverse the effect of localize().
         """
+        try:
+            return self._globalizeCache[self]
+        except KeyError:
+            globalized = self._globalizeCache[self] = self._globalize()
+            return globalized
+
+    def _globalize(self):
         try:
             with open(os.path.join(self.dirPath, '.original')) as f:
                 return self.__class__(*json.loads(f.read()))
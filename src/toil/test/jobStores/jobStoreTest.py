@@ -407,6 +407,69 @@ class hidden:
                     # NB: the fooStream() methods return context managers
                     self.assertRaises(NoSuchFileException, master.readFileStream(fileID).__enter__)
 
+        def testBatchedDeletion(self):
+            """
+            Tests the batched loading and deletion of jobs and files and the commit of a finished
+            job.
+            """
+            master = self.master
+            n = self._batchDeletionSize()
+            job = master.create('1', 2, 3, 4, preemptable=True)
+            others = [master.create('2', 2, 3, 4, preemptable=True) for _ in xrange(n + 1)]
+            ownedFileIDs = [master.getEmptyFileStoreID(others[0].jobStoreID) for _ in xrange(2)]
+            fileIDs = [master.getEmptyFileStoreID(job.jobStoreID) for _ in xrange(n + 1)]
+            keptFileID = master.getEmptyFileStoreID(job.jobStoreID)
+
+            # Deletion is idempotent
+            master.deleteMany([others[-1].jobStoreID])
+            master.deleteFiles([fileIDs[-1]])
+            self.assertFalse(master.exists(others[-1].jobStoreID))
+            self.assertFalse(master.fileExists(fileIDs[-1]))
+
+            # Bulk loading skips missing jobs
+            loaded = master.loadMany([other.jobStoreID for other in others])
+            self.assertEquals(sorted(other.jobStoreID for other in loaded),
+                              sorted(other.jobStoreID for other in others[:-1]))
+
+            job.command = None
+            master.commit(job,
+                          jobsToDelete=[other.jobStoreID for other in others],
+                          filesToDelete=fileIDs)
+            self.assertEquals(job.filesToDelete, [])
+            job2 = master.load(job.jobStoreID)
+            self.assertEquals(job2.command, None)
+            self.assertEquals(job2.filesToDelete, [])
+            for other in others:
+                self.assertFalse(master.exists(other.jobStoreID))
+            for fileID in fileIDs + ownedFileIDs:
+                self.assertFalse(master.fileExists(fileID))
+            self.assertTrue(master.fileExists(keptFileID))
+
+        def testBatchedCreation(self):
+            """
+            Tests the batched creation and update of jobs and the concurrent writing of files.
+            """
+            master = self.master
+            n = self._batchDeletionSize() * 2 + 1
+            jobs = master.createMany([dict(command=str(i), memory=2, cores=3, disk=4,
+                                           preemptable=True, predecessorNumber=i)
+                                      for i in xrange(n)])
+            self.assertEquals(len(set(job.jobStoreID for job in jobs)), n)
+            fileIDs = master.writeFilesFromStrings([str(i) for i in xrange(n)],
+                                                   jobs[0].jobStoreID)
+            for i, job in enumerate(jobs):
+                self.assertEquals(master.load(job.jobStoreID).predecessorNumber, i)
+                job.command = fileIDs[i]
+            master.updateMany(jobs)
+            loaded = master.loadMany([job.jobStoreID for job in jobs])
+            self.assertEquals(len(loaded), n)
+            for job in loaded:
+                with master.readFileStream(job.command) as f:
+                    self.assertEquals(f.read(), str(job.predecessorNumber))
+            master.delete(jobs[0].jobStoreID)
+            for fileID in fileIDs:
+                self.assertFalse(master.fileExists(fileID))
+
         def testMultipartUploads(self):
             """
             This test is meant to cover multi-part uploads in the AWSJobStore but it doesn't hurt
@@ -503,6 +566,36 @@ class hidden:
                 self.assertEquals(f.read(), "")
             self.master.delete(job.jobStoreID)
 
+        def testFileDigests(self):
+            job = self.master.create('1', 2, 3, 4, preemptable=True)
+            fileIDs = self.master.writeFilesFromStrings(['foo', 'foo', 'bar'], job.jobStoreID)
+            digests = map(self.master.getFileDigest, fileIDs)
+            # Job stores don't have to know the digests of their files
+            if digests != [None] * 3:
+                self.assertEquals(digests[0], digests[1])
+                self.assertNotEquals(digests[0], digests[2])
+                # Asking again gives the same answer, and updating a file changes its digest
+                self.assertEquals(self.master.getFileDigest(fileIDs[0]), digests[0])
+                with self.master.updateFileStream(fileIDs[0]) as f:
+                    f.write('bar')
+                self.assertEquals(self.master.getFileDigest(fileIDs[0]), digests[2])
+                self.assertEquals(self.master.getFileDigest(fileIDs[1]), digests[0])
+            self.master.delete(job.jobStoreID)
+
+        def testFileRanges(self):
+            job = self.master.create('1', 2, 3, 4, preemptable=True)
+            content = os.urandom(self._partSize() + 100)
+            fileID = self.master.writeFilesFromStrings([content], job.jobStoreID)[0]
+            ranges = ((0, 0), (0, 10), (5, len(content)), (self._partSize() - 3, 6),
+                      (len(content) - 1, 10), (len(content), 1), (len(content) + 10, 1))
+            for offset, length in ranges:
+                expected = content[offset:offset + length]
+                self.assertEquals(self.master.readFileRange(fileID, offset, length), expected)
+                # Job stores that override readFileRange must agree with the default
+                self.assertEquals(AbstractJobStore.readFileRange(self.master, fileID, offset,
+                                                                 length), expected)
+            self.master.delete(job.jobStoreID)
+
         def testLargeFile(self):
             dirPath = self._createTempDir()
             filePath = os.path.join(dirPath, 'large')
@@ -0,0 +1,65 @@
+# Copyright (C) 2015 UCSC Computational Genomics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from StringIO import StringIO
+
+from toil.cachePolicies import CacheSimulator, evictionPolicies, getEvictionPolicy
+from toil.test import ToilTest
+from toil.utils.toilCacheSim import readTrace
+
+
+class CachePoliciesTest(ToilTest):
+
+    @staticmethod
+    def _hotFileTrace(scans=10):
+        # A big file that is read by every other job, interleaved with jobs that read two files
+        # each which are never read again
+        trace = [('hot', 60)]
+        for i in xrange(scans):
+            trace.extend([('hot', 60), ('scan%i' % (2 * i), 50), ('scan%i' % (2 * i + 1), 50)])
+        return trace
+
+    def _simulate(self, name, trace, capacity=120):
+        return CacheSimulator(getEvictionPolicy(name), capacity).replay(trace)
+
+    def testHotFileSurvivesScans(self):
+        trace = self._hotFileTrace()
+        lru = self._simulate('lru', trace)
+        # The hot file is the least recently used one whenever the second scanned file is read
+        self.assertEquals(lru.hits, 1)
+        for name in ('lfu', 'gdsf'):
+            simulator = self._simulate(name, trace)
+            self.assertEquals(simulator.hits, 10)
+            self.assertEquals(simulator.hitBytes, 600)
+            self.assertTrue(simulator.byteHitRatio > lru.byteHitRatio)
+
+    def testCapacity(self):
+        trace = self._hotFileTrace()
+        for name in evictionPolicies:
+            simulator = self._simulate(name, trace, capacity=1000)
+            self.assertEquals((simulator.hits, simulator.misses), (10, 21))
+            simulator = CacheSimulator(getEvictionPolicy(name), 100)
+            for fileID, size in trace:
+                simulator.read(fileID, size)
+                # Only the file being read may exceed the capacity
+                self.assertTrue(simulator.cached <= max(100, size))
+
+    def testUnknownPolicy(self):
+        self.assertRaises(RuntimeError, getEvictionPolicy, 'fifo')
+
+    def testReadTrace(self):
+        trace = StringIO('# fileID size\n\nfile 1\nother file  20\n')
+        self.assertEquals(list(readTrace(trace)), [('file', 1), ('other file', 20)])
@@ -0,0 +1,78 @@
+# Copyright (C) 2015 UCSC Computational Genomics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import os
+import shutil
+from StringIO import StringIO
+
+from toil.lib import fileCopy
+from toil.lib.fileCopy import copyFile, copyFileObj
+from toil.test import ToilTest
+
+
+class FileCopyTest(ToilTest):
+
+    def setUp(self):
+        super(FileCopyTest, self).setUp()
+        self.tempDir = self._createTempDir()
+        self.content = os.urandom(3 * 1024 * 1024 + 17)
+        self.srcPath = os.path.join(self.tempDir, 'src')
+        with open(self.srcPath, 'w') as f:
+            f.write(self.content)
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def testCopyFile(self):
+        dstPath = os.path.join(self.tempDir, 'dst')
+        with open(dstPath, 'w') as f:
+            f.write('This should be overwritten by the copy of a longer file')
+        copyFile(self.srcPath, dstPath)
+        self.assertEquals(self._read(dstPath), self.content)
+        self.assertRaises(shutil.Error, copyFile, self.srcPath, self.srcPath)
+
+    def testCopyFileObjFromPosition(self):
+        dstPath = os.path.join(self.tempDir, 'dst')
+        with open(self.srcPath) as src:
+            with open(dstPath, 'w') as dst:
+                # Leave data buffered in both file objects
+                head = src.read(100)
+                dst.write(head)
+                copyFileObj(src, dst)
+                dst.write('tail')
+                self.assertEquals(src.read(), '')
+        self.assertEquals(self._read(dstPath), self.content + 'tail')
+
+    def testCopyFileObjWithoutDescriptors(self):
+        dst = StringIO()
+        with open(self.srcPath) as src:
+            copyFileObj(src, dst, bufferSize=1000)
+        self.assertEquals(dst.getvalue(), self.content)
+
+    def testFallbacks(self):
+        # Every way of copying must produce the same result, however many of them are unsupported
+        originals = fileCopy._copyFileRange, fileCopy._sendfile
+        try:
+            for copyFileRange, sendfile in ((originals[0], None), (None, originals[1]),
+                                            (None, None)):
+                fileCopy._copyFileRange, fileCopy._sendfile = copyFileRange, sendfile
+                dstPath = os.path.join(self.tempDir, 'dst')
+                copyFile(self.srcPath, dstPath)
+                self.assertEquals(self._read(dstPath), self.content)
+                os.remove(dstPath)
+        finally:
+            fileCopy._copyFileRange, fileCopy._sendfile = originals
@@ -18,6 +18,7 @@ Affiliation : UCSC BME, UCSC Genomics Institute
 File : src/toil/test/src/JobCacheTest.py
 """
 from __future__ import print_function
+import base64
 import collections
 import os
 import sys
@@ -26,13 +27,19 @@ import signal
 import time
 import unittest
 
+from fcntl import flock, LOCK_EX
+from hashlib import sha1
 from struct import pack, unpack
+from threading import Thread
 from uuid import uuid4
 
+from toil.cachePolicies import CacheSimulator, getEvictionPolicy
+from toil.common import cacheDirName, trashDirName
 from toil.job import Job, CacheError
 from toil.test import ToilTest, needs_aws, needs_azure, needs_google
 from toil.leader import FailedJobsException
 from toil.jobStores.abstractJobStore import NoSuchFileException
+from toil.utils.toilCacheSim import readTrace
 
 # Some tests take too long on the AWS and Azure Job stores and are unquitable for CI.  They can be
 # be run during manual tests by setting this to False.
@@ -157,6 +164,152 @@ class Hidden:
                 assert cacheInfo.nlink == 0
                 assert cacheInfo.cached > 1
 
+        def testCacheStateDatabase(self):
+            """
+            Exercise the bookkeeping of the cache state database directly: the values of the
+            caching equation, the trash, and the files owned by a job.
+            """
+            cacheStateFile = os.path.join(self._createTempDir(), '_cacheState.db')
+            cacheState = Job.CachedFileStore._CacheState
+            cacheState.create(cacheStateFile, dict(nlink=1, attemptNumber=0, total=70, cached=0,
+                                                   sigmaJob=0, trashed=0, cacheDir=None,
+                                                   inflation=0.0))
+            with cacheState.transaction(cacheStateFile) as cacheInfo:
+                cacheInfo.setTrash('a', 30)
+                cacheInfo.setTrash('b', 20)
+                cacheInfo.setTrash('a', 10)
+                jobState = cacheInfo.jobState('job')
+                self.assertFalse(jobState.exists())
+                jobState.create(50, '/jobDir')
+                cacheInfo.sigmaJob += 50
+                jobState.addToJobSpecFiles('fsID1', '/jobDir/x', 10, True)
+                jobState.addToJobSpecFiles('fsID1', '/jobDir/y', -1, None)
+                jobState.addToJobSpecFiles('fsID2', '/jobDir/x', 0.0, False)
+                jobState.addToJobSpecFiles('fsID3', None, 0.0, False)
+                self.assertRaises(RuntimeError,
+                                  jobState.addToJobSpecFiles, 'fsID1', '/jobDir/x', 10, True)
+            cacheInfo = cacheState._load(cacheStateFile)
+            self.assertEquals((cacheInfo.trashed, cacheInfo.sigmaJob), (30, 50))
+            self.assertFalse(cacheInfo.isBalanced())
+            # A failed transaction leaves the state untouched
+            try:
+                with cacheState.transaction(cacheStateFile) as cacheInfo:
+                    cacheInfo.setTrash('a', None)
+                    cacheInfo.jobState('job').remove()
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+            with cacheState.transaction(cacheStateFile, readOnly=True) as cacheInfo:
+                self.assertEquals(cacheInfo.trashed, 30)
+                jobState = cacheInfo.jobState('job')
+                self.assertEquals(jobState.jobReqs, 40)
+                self.assertEquals(jobState.jobDir, '/jobDir')
+                self.assertEquals(sorted(jobState.fileStoreIDs()), ['fsID1', 'fsID2', 'fsID3'])
+                self.assertEquals(sorted(jobState.getFiles('fsID1')),
+                                  [('/jobDir/x', 10), ('/jobDir/y', -1)])
+                self.assertEquals(jobState.countFileStoreIDs('/jobDir/x'), 2)
+                self.assertTrue(jobState.hasFilePath(None))
+                self.assertFalse(jobState.hasFileStoreID('fsID4'))
+            with cacheState.transaction(cacheStateFile) as cacheInfo:
+                cacheInfo.setTrash('a', None)
+                jobState = cacheInfo.jobState('job')
+                jobState.removeFile('fsID3', None)
+                self.assertFalse(jobState.hasFileStoreID('fsID3'))
+                jobState.remove()
+                self.assertEquals(jobState.fileStoreIDs(), [])
+            self.assertEquals(cacheState._load(cacheStateFile).trashed, 20)
+            # Accesses to cached files are tracked for the eviction policy
+            policy = getEvictionPolicy('lfu')
+            with cacheState.transaction(cacheStateFile) as cacheInfo:
+                cacheInfo.recordAccess('fsID1', 10, policy)
+                cacheInfo.recordAccess('fsID2', 20, policy)
+                cacheInfo.recordAccess('fsID1', 10, policy)
+            with cacheState.transaction(cacheStateFile) as cacheInfo:
+                accessRecords = cacheInfo.accessRecords()
+                self.assertEquals(policy.evictionOrder(accessRecords), ['fsID2', 'fsID1'])
+                self.assertEquals(accessRecords['fsID1'].accessCount, 2)
+                cacheInfo.removeAccesses('fsID2')
+                self.assertEquals(cacheInfo.accessRecords().keys(), ['fsID1'])
+
+        def testTrashAccounting(self):
+            """
+            A worker directory is counted in the trash with the given bound on its size until the
+            reaper has deleted it. Sizes of directories that were deleted already are ignored.
+            """
+            workflowID = str(uuid4())
+            workflowDir = self._createTempDir()
+            cacheDir = os.path.join(workflowDir, cacheDirName(workflowID))
+            os.mkdir(cacheDir)
+            cacheStateFile = os.path.join(cacheDir, '_cacheState.db')
+            cacheState = Job.CachedFileStore._CacheState
+            cacheState.create(cacheStateFile, dict(nlink=1, attemptNumber=0, total=10 ** 9,
+                                                   cached=0, sigmaJob=0, trashed=0, cacheDir=None,
+                                                   inflation=0.0))
+            Job.CachedFileStore._accountForTrash(workflowDir, workflowID,
+                                                 os.path.join(workflowDir, 'missing'), 10)
+            self.assertEquals(cacheState._load(cacheStateFile).trashed, 0)
+            workerDir = os.path.join(workflowDir, 'worker')
+            os.makedirs(os.path.join(workerDir, 'job'))
+            with open(os.path.join(workerDir, 'job', 'scratch'), 'w') as f:
+                f.write('x' * 100000)
+            Job.CachedFileStore.removeWorkerTempDir(workerDir, workflowID, 10 ** 6)
+            self.assertFalse(os.path.exists(workerDir))
+            trashDir = os.path.join(workflowDir, trashDirName(workflowID))
+            # The reaper records the deletion after deleting the directory
+            for attempt in xrange(300):
+                if not os.listdir(trashDir) and cacheState._load(cacheStateFile).trashed == 0:
+                    break
+                time.sleep(0.1)
+            self.assertEquals(os.listdir(trashDir), [])
+            self.assertEquals(cacheState._load(cacheStateFile).trashed, 0)
+            # A worker that failed to load its job doesn't know a bound on the directory's size
+            os.makedirs(workerDir)
+            Job.CachedFileStore.removeWorkerTempDir(workerDir, workflowID, None)
+            self.assertFalse(os.path.exists(workerDir))
+            self.assertEquals(cacheState._load(cacheStateFile).trashed, 0)
+
+        def testNodeCache(self):
+            """
+            Move the files downloaded by a finished workflow to the node cache and check that the
+            least recently used files are evicted to keep it within its size limit.
+            """
+            workflowID = str(uuid4())
+            workflowDir = self._createTempDir()
+            nodeCacheDir = os.path.join(self._createTempDir(), 'nodeCache')
+            nodeCache = Job.CachedFileStore._NodeCache(nodeCacheDir, 25)
+            # An older file, that was used by an earlier workflow
+            nodeCache.put('sha1-a', self._createNodeCacheFile(self._createTempDir(), 'a', 10))
+            os.utime(os.path.join(nodeCacheDir, 'sha1-a'), (0, 0))
+            cacheDir = os.path.join(workflowDir, 'cache-' + workflowID)
+            os.mkdir(cacheDir)
+            cacheState = Job.CachedFileStore._CacheState
+            cacheStateFile = os.path.join(cacheDir, '_cacheState.db')
+            cacheState.create(cacheStateFile, dict(nlink=1, attemptNumber=0, total=100, cached=0,
+                                                   sigmaJob=0, trashed=0, cacheDir=cacheDir,
+                                                   inflation=0.0))
+            with cacheState.transaction(cacheStateFile) as cacheInfo:
+                for fileStoreID in ('b', 'c', 'deleted'):
+                    cacheInfo.setDigest(fileStoreID, 'sha1-' + fileStoreID)
+            for fileStoreID in ('b', 'c'):
+                self._createNodeCacheFile(cacheDir, base64.urlsafe_b64encode(fileStoreID), 10)
+            Job.CachedFileStore.moveToNodeCache(workflowDir, workflowID, nodeCacheDir, 25)
+            self.assertEquals(sorted(os.listdir(nodeCacheDir)),
+                              ['.nodeCacheLock', 'sha1-b', 'sha1-c'])
+            self.assertEquals(os.listdir(cacheDir), ['_cacheState.db'])
+            # The next workflow takes the file out of the node cache
+            localFilePath = os.path.join(self._createTempDir(), 'b')
+            self.assertTrue(nodeCache.take('sha1-b', localFilePath))
+            self.assertEquals(os.path.getsize(localFilePath), 10)
+            self.assertFalse(nodeCache.take('sha1-b', localFilePath + '.2'))
+            self.assertFalse(os.path.exists(os.path.join(nodeCacheDir, 'sha1-b')))
+
+        @staticmethod
+        def _createNodeCacheFile(dirPath, fileName, size):
+            filePath = os.path.join(dirPath, fileName)
+            with open(filePath, 'w') as fileHandle:
+                fileHandle.write('x' * size)
+            return filePath
+
         def testCacheEvictionPartialEvict(self):
             """
             Ensure the cache eviction happens as expected.  Two files (20MB and 30MB) are written
@@ -464,6 +617,200 @@ class Hidden:
             """
             self._testMultipleJobsReadGlobalFileFunction(cacheHit=False)
 
+        def testPrefetchGlobalFiles(self):
+            """
+            Read files concurrently with prefetchGlobalFiles and readGlobalFiles while the job
+            reads some of the same files itself, with and without the shared cache.
+            """
+            for disableSharedCache in (False, True):
+                self.options.disableSharedCache = disableSharedCache
+                workdir = self._createTempDir(purpose='nonLocalDir')
+                A = Job.wrapJobFn(self._writeFilesWithDigests, nonLocalDir=workdir, numFiles=4)
+                B = Job.wrapJobFn(self._prefetchReader, filesWithDigests=A.rv())
+                A.addChild(B)
+                Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _writeFilesWithDigests(job, nonLocalDir, numFiles):
+            filesWithDigests = []
+            for _ in xrange(numFiles):
+                fsID = _writeFileToJobStore(job, isLocalFile=False, nonLocalDir=nonLocalDir)
+                with job.fileStore.readGlobalFileStream(fsID) as fileHandle:
+                    filesWithDigests.append((fsID, sha1(fileHandle.read()).hexdigest()))
+            return filesWithDigests
+
+        @staticmethod
+        def _prefetchReader(job, filesWithDigests):
+            fsIDs, digests = zip(*filesWithDigests)
+            futures = job.fileStore.prefetchGlobalFiles(fsIDs)
+            # Race the downloads in the background
+            paths = [job.fileStore.readGlobalFile(fsIDs[0]), job.fileStore.readGlobalFile(fsIDs[1])]
+            paths += [future.get() for future in futures]
+            paths += job.fileStore.readGlobalFiles(fsIDs, mutable=True)
+            for path, digest in zip(paths, digests[:2] + digests + digests):
+                with open(path) as fileHandle:
+                    assert sha1(fileHandle.read()).hexdigest() == digest
+            # Downloads the job doesn't wait for must not interfere with the cleanup
+            job.fileStore.prefetchGlobalFiles(fsIDs)
+
+        def testCacheTrace(self):
+            """
+            Record a trace of the cache lookups of a job that reads a file twice, with and without
+            the shared cache, and replay it with the simulator used by toil cachesim.
+            """
+            for disableSharedCache in (False, True):
+                self.options.disableSharedCache = disableSharedCache
+                self.options.cacheTrace = os.path.join(self._createTempDir(), 'trace')
+                workdir = self._createTempDir(purpose='nonLocalDir')
+                A = Job.wrapJobFn(self._writeFileToJobStore, isLocalFile=False,
+                                  nonLocalDir=workdir)
+                B = Job.wrapJobFn(self._readFileTwice, fsID=A.rv())
+                A.addChild(B)
+                fsID = Job.Runner.startToil(A, self.options)
+                with open(self.options.cacheTrace) as fileHandle:
+                    trace = list(readTrace(fileHandle))
+                self.assertEquals(trace, [(fsID, 1024 * 1024)] * 2)
+                simulator = CacheSimulator(getEvictionPolicy('lru'), 2 * 1024 * 1024)
+                simulator.replay(trace)
+                self.assertEquals((simulator.hits, simulator.misses), (1, 1))
+
+        @staticmethod
+        def _readFileTwice(job, fsID):
+            for _ in xrange(2):
+                job.fileStore.readGlobalFile(fsID)
+
+        def testStreamedFilesAreCached(self):
+            """
+            Files written with writeGlobalFileStream, and files read to the end with
+            readGlobalFileStream, are added to the cache, with and without the shared cache.
+            """
+            for disableSharedCache in (False, True):
+                self.options.disableSharedCache = disableSharedCache
+                Job.Runner.startToil(Job.wrapJobFn(self._streamToCache), self.options)
+
+        @staticmethod
+        def _streamToCache(job):
+            fileStore = job.fileStore
+            if isinstance(fileStore, Job.CachedFileStore):
+                isCached = fileStore._fileIsCached
+                # Files in a job store on the same file system are linked into the cache instead
+                cachingExpected = fileStore.nlinkThreshold == 1
+            else:
+                isCached = lambda fsID: fsID in fileStore._jobStoreFileIDToCacheLocation
+                cachingExpected = True
+            with fileStore.writeGlobalFileStream() as (stream, writtenID):
+                stream.write('foo\n')
+                stream.writelines(['bar\n', 'baz\n'])
+            assert isCached(writtenID) == cachingExpected
+            readIDs = []
+            for _ in xrange(2):
+                with fileStore.jobStore.writeFileStream() as (stream, readID):
+                    stream.write('foo\nbar\n')
+                readIDs.append(readID)
+            with fileStore.readGlobalFileStream(readIDs[0]) as stream:
+                assert list(stream) == ['foo\n', 'bar\n']
+            assert isCached(readIDs[0]) == cachingExpected
+            # Only a stream that is read to the end can be cached
+            with fileStore.readGlobalFileStream(readIDs[1]) as stream:
+                assert stream.readline() == 'foo\n'
+            assert not isCached(readIDs[1])
+            for fsID, contents in zip([writtenID] + readIDs,
+                                      ['foo\nbar\nbaz\n', 'foo\nbar\n', 'foo\nbar\n']):
+                with open(fileStore.readGlobalFile(fsID)) as fileHandle:
+                    assert fileHandle.read() == contents
+
+        def testStreamedFilesExceedingCache(self):
+            """
+            Streams of files too large for the cache go through without being cached, and the
+            space reserved for their copies is returned to the caching equation. Without the shared
+            cache, the copies are kept within the cache size of the job.
+            """
+            Job.Runner.startToil(Job.wrapJobFn(self._streamPastCache), self.options)
+            self.options.disableSharedCache = True
+            Job.Runner.startToil(Job.wrapJobFn(self._streamPastJobCache, cache=1024), self.options)
+
+        @staticmethod
+        def _streamPastCache(job):
+            fileStore = job.fileStore
+            # Copy the streams even if the job store is on the same file system
+            fileStore.nlinkThreshold = 1
+            with fileStore._CacheState.open(fileStore) as cacheInfo:
+                equation = (cacheInfo.cached, cacheInfo.sigmaJob)
+                # Leave room for one small file only
+                cacheInfo.total = cacheInfo.cached + cacheInfo.sigmaJob + cacheInfo.trashed + 1024
+            data = os.urandom(1024 * 1024)
+            with fileStore.writeGlobalFileStream() as (stream, writtenID):
+                stream.write(data[:512])
+                stream.write(data[512:])
+                # The copy in the cache directory was dropped when it no longer fit
+                partialFileName = '/.'.join(os.path.split(fileStore.encodedFileID(writtenID)))
+                assert os.path.getsize(partialFileName) <= 1024
+            with fileStore.jobStore.writeFileStream() as (stream, readID):
+                stream.write(data)
+            with fileStore.readGlobalFileStream(readID) as stream:
+                assert stream.read() == data
+            smallFileIDs = []
+            for _ in xrange(2):
+                with fileStore.writeGlobalFileStream() as (stream, smallFileID):
+                    stream.write(data[:1000])
+                smallFileIDs.append(smallFileID)
+            # Only the first small file fits into the cache
+            assert [fileStore._fileIsCached(fsID)
+                    for fsID in [writtenID, readID] + smallFileIDs] == [False, False, True, False]
+            with fileStore._CacheState.open(fileStore) as cacheInfo:
+                assert (cacheInfo.cached, cacheInfo.sigmaJob) == (equation[0] + 1000, equation[1])
+            for fsID in writtenID, readID:
+                with fileStore.jobStore.readFileStream(fsID) as stream:
+                    assert stream.read() == data
+
+        def testReadGlobalFileWhileStreaming(self):
+            """
+            A file that is being streamed into the cache can be read with readGlobalFile and
+            prefetchGlobalFiles by the job streaming it, without waiting for the stream.
+            """
+            Job.Runner.startToil(Job.wrapJobFn(self._readWhileStreaming), self.options)
+
+        @staticmethod
+        def _readWhileStreaming(job):
+            fileStore = job.fileStore
+            # Copy the stream even if the job store is on the same file system
+            fileStore.nlinkThreshold = 1
+            with fileStore.jobStore.writeFileStream() as (stream, fsID):
+                stream.write('foo\nbar\n')
+            with fileStore.readGlobalFileStream(fsID) as stream:
+                assert stream.readline() == 'foo\n'
+                paths = [fileStore.readGlobalFile(fsID), fileStore.readGlobalFile(fsID)]
+                paths += fileStore.readGlobalFiles([fsID])
+                # The copies were downloaded without being added to the cache
+                assert not fileStore._fileIsCached(fsID)
+                assert stream.read() == 'bar\n'
+            assert fileStore._fileIsCached(fsID)
+            for path in paths:
+                with open(path) as fileHandle:
+                    assert fileHandle.read() == 'foo\nbar\n'
+
+        @staticmethod
+        def _streamPastJobCache(job):
+            fileStore = job.fileStore
+            isCached = lambda fsID: fsID in fileStore._jobStoreFileIDToCacheLocation
+            data = os.urandom(1024 * 1024)
+            with fileStore.writeGlobalFileStream() as (stream, writtenID):
+                stream.write(data)
+            with fileStore.jobStore.writeFileStream() as (stream, readID):
+                stream.write(data)
+            with fileStore.readGlobalFileStream(readID) as stream:
+                assert stream.read() == data
+            smallFileIDs = []
+            for _ in xrange(2):
+                with fileStore.writeGlobalFileStream() as (stream, smallFileID):
+                    stream.write(data[:1000])
+                smallFileIDs.append(smallFileID)
+            # Only the first small file fits into the cache of the job
+            assert map(isCached, [writtenID, readID] + smallFileIDs) == [False, False, True, False]
+            assert fileStore._streamReserved == 0
+            # The dropped copies were removed
+            assert len(os.listdir(fileStore.localTempDir)) == 1
+
         def _testMultipleJobsReadGlobalFileFunction(self, cacheHit):
             """
             This function does what the two Multiple File reading tests want to do
@@ -525,6 +872,62 @@ class Hidden:
             # the file
             time.sleep(3)
 
+        def testWaitForDownloadingWorker(self):
+            """
+            Read a file while another worker holds its harbinger, i.e. is downloading it. The read
+            must resume as soon as the other worker is done, rather than polling for it.
+            """
+            self._testHarbinger(dead=False)
+
+        def testStaleHarbinger(self):
+            """
+            Read a file whose harbinger was left behind by a worker that died while downloading
+            it. The read must neither hang nor wait for the harbinger to be removed.
+            """
+            self._testHarbinger(dead=True)
+
+        def _testHarbinger(self, dead):
+            """
+            :param bool dead: Is the worker that created the harbinger dead(T) or alive(F)?
+            """
+            workdir = self._createTempDir(purpose='nonLocalDir')
+            A = Job.wrapJobFn(self._writeFileToJobStore, isLocalFile=False, nonLocalDir=workdir)
+            B = Job.wrapJobFn(self._readWithHarbinger, fsID=A.rv(), dead=dead)
+            A.addChild(B)
+            Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _readWithHarbinger(job, fsID, dead):
+            """
+            Create the harbinger of fsID as another worker would, then read fsID.
+
+            :param str fsID: job store file ID
+            :param bool dead: Is the worker that created the harbinger dead(T) or alive(F)?
+            """
+            harbingerFileName = job.fileStore._harbingerFileName(
+                job.fileStore.encodedFileID(fsID))
+            harbinger = open(harbingerFileName, 'w')
+            if dead:
+                harbinger.close()
+            else:
+                flock(harbinger, LOCK_EX)
+
+                def finishDownload():
+                    time.sleep(2)
+                    with job.fileStore.cacheLock():
+                        os.remove(harbingerFileName)
+                        harbinger.close()
+
+                Thread(target=finishDownload).start()
+            start = time.time()
+            job.fileStore.readGlobalFile(fsID, cache=True)
+            elapsed = time.time() - start
+            assert job.fileStore._fileIsCached(fsID)
+            assert not os.path.exists(harbingerFileName)
+            assert elapsed < 10, elapsed
+            if not dead:
+                assert elapsed >= 2, elapsed
+
         # Testing for the return of file sizes to the sigma job pool.
         def testReturnFileSizes(self):
             """
@@ -646,14 +1049,14 @@ class Hidden:
             state file is equal to the values we expect.
             """
             with job.fileStore._CacheState.open(job.fileStore) as cacheInfo:
-                jobState = cacheInfo.jobState[job.fileStore.hashedJobCommand]
+                jobReqs = cacheInfo.jobState(job.fileStore.hashedJobCommand).jobReqs
                 # cached should have a value only if the job store is on a different file system
                 # than the cache
                 if cacheInfo.nlink != 2:
                     assert cacheInfo.cached == cached
                 else:
                     assert cacheInfo.cached == 0
-            assert jobState['jobReqs'] == jobDisk
+            assert jobReqs == jobDisk
 
         # Testing the resumability of a failed worker
         def testControlledFailedWorkerRetry(self):
@@ -847,6 +1250,7 @@ _sleepy = Hidden.AbstractCacheTest._sleepy
 _readFromJobStore = Hidden.AbstractCacheTest._readFromJobStore
 _probeJobReqs = Hidden.AbstractCacheTest._probeJobReqs
 _multipleFileReader = Hidden.AbstractCacheTest._multipleFileReader
+_readWithHarbinger = Hidden.AbstractCacheTest._readWithHarbinger
 _selfishLocker = Hidden.AbstractCacheTest._selfishLocker
 _setUpLockFile = Hidden.AbstractCacheTest._setUpLockFile
 _raceTestSuccess = Hidden.AbstractCacheTest._raceTestSuccess
@@ -858,3 +1262,10 @@ _parseAssertionError = Hidden.AbstractCacheTest._parseAssertionError
 _controlledFailTestFn = Hidden.AbstractCacheTest._controlledFailTestFn
 _removeReadFileFn = Hidden.AbstractCacheTest._removeReadFileFn
 _deleteLocalFileFn = Hidden.AbstractCacheTest._deleteLocalFileFn
+_writeFilesWithDigests = Hidden.AbstractCacheTest._writeFilesWithDigests
+_prefetchReader = Hidden.AbstractCacheTest._prefetchReader
+_streamToCache = Hidden.AbstractCacheTest._streamToCache
+_streamPastCache = Hidden.AbstractCacheTest._streamPastCache
+_streamPastJobCache = Hidden.AbstractCacheTest._streamPastJobCache
+_readWhileStreaming = Hidden.AbstractCacheTest._readWhileStreaming
+_readFileTwice = Hidden.AbstractCacheTest._readFileTwice
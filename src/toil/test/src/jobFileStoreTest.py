@@ -75,7 +75,30 @@ class JobFileStoreTest(ToilTest):
         self.testJobFileStoreWithSmallCache(retryCount=100, badWorker=0.5, 
                          stringNo=5, stringLength=1000000, 
                          cacheSize=3000000)
-        
+
+    def testJobFileStoreWithBoundedUploadQueue(self):
+        """
+        Tests that the files written by a job are uploaded intact when writing them blocks on a
+        full upload queue.
+        """
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.logLevel = "INFO"
+        options.disableSharedCache = True
+        options.uploadThreads = 1
+        options.uploadQueueSize = 1
+        Job.Runner.startToil(Job.wrapJobFn(uploadTestJob, 10), options)
+
+    def testJobFileStoreRangeReads(self):
+        """
+        Tests reading parts of files and mapping files into memory, both with and without the
+        shared cache.
+        """
+        for disableSharedCache in (True, False):
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            options.disableSharedCache = disableSharedCache
+            Job.Runner.startToil(Job.wrapJobFn(rangeTestJob), options)
+
 def fileTestJob(job, inputFileStoreIDs, testStrings, chainLength):
     """
     Test job exercises Job.FileStore functions
@@ -130,3 +153,53 @@ def fileTestJob(job, inputFileStoreIDs, testStrings, chainLength):
     if chainLength > 0:
         #Make a child that will read these files and check it gets the same results
         job.addChildJobFn(fileTestJob, outputFileStoreIds, testStrings, chainLength-1)
+
+def uploadTestJob(job, fileNo):
+    """
+    Test job writing more files than fit into the upload queue
+    """
+    testStrings = {}
+    for i in xrange(fileNo):
+        testString = str(i) * 100000
+        tempFile = job.fileStore.getLocalTempFile()
+        with open(tempFile, 'w') as fH:
+            fH.write(testString)
+        testStrings[job.fileStore.writeGlobalFile(tempFile)] = testString
+    #The single upload thread is started on demand
+    assert len(job.fileStore.workers) == 1
+    job.addChildJobFn(checkUploadsJob, testStrings)
+
+def checkUploadsJob(job, testStrings):
+    """
+    Test job checking the files written by uploadTestJob
+    """
+    for fileStoreID, testString in testStrings.iteritems():
+        with job.fileStore.readGlobalFileStream(fileStoreID) as fH:
+            assert fH.read() == testString
+
+def rangeTestJob(job):
+    """
+    Test job reading parts of a file, first from the job store and then from the cache
+    """
+    testString = os.urandom(100000)
+    tempFile = job.fileStore.getLocalTempFile()
+    with open(tempFile, 'w') as fH:
+        fH.write(testString)
+    #Imported files are not cached
+    fileStoreID = job.fileStore.importFile('file://' + tempFile)
+    ranges = ((0, 10), (1000, 50000), (99990, 20), (100000, 1), (200000, 1), (500, 0))
+    for offset, length in ranges:
+        data = job.fileStore.readGlobalFileRange(fileStoreID, offset, length)
+        assert data == testString[offset:offset + length]
+    assert job.fileStore.cacheMetrics.hits == 0
+    #Mapping the file adds it to the cache
+    mapped = job.fileStore.mmapGlobalFile(fileStoreID)
+    try:
+        assert len(mapped) == len(testString)
+        assert mapped[1000:2000] == testString[1000:2000]
+    finally:
+        mapped.close()
+    for offset, length in ranges:
+        data = job.fileStore.readGlobalFileRange(fileStoreID, offset, length)
+        assert data == testString[offset:offset + length]
+    assert job.fileStore.cacheMetrics.hits == len(ranges)
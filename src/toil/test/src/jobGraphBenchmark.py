@@ -0,0 +1,133 @@
+# Copyright (C) 2015 UCSC Computational Genomics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Times the validation and ordering of large synthetic job graphs and measures the memory used to
+build them, e.g.
+
+    python -m toil.test.src.jobGraphBenchmark --jobs 1000000
+
+With --serialise, each graph is also serialised to a temporary file job store. As the peak memory
+use of the process can only grow, the memory figures are most accurate with a single shape.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+from toil.common import Toil
+from toil.job import Job
+
+
+def chain(n):
+    """
+    A path of alternating child and follow-on edges.
+    """
+    jobs = [Job() for _ in xrange(n)]
+    for i in xrange(1, n):
+        if i % 2:
+            jobs[i - 1].addChild(jobs[i])
+        else:
+            jobs[i - 1].addFollowOn(jobs[i])
+    return jobs[0]
+
+
+def fan(n):
+    """
+    A root with n - 2 children, all of which precede a single follow-on of the root.
+    """
+    root, followOn = Job(), Job()
+    for _ in xrange(n - 2):
+        root.addChild(Job())
+    root.addFollowOn(followOn)
+    return root
+
+
+def tree(n, degree=4):
+    """
+    A random tree whose jobs have up to the given number of successors, each being a child or
+    follow-on with equal probability.
+    """
+    jobs = [Job()]
+    for i in xrange(1, n):
+        parent = jobs[(i - 1) // degree]
+        if random.random() < 0.5:
+            parent.addChild(Job())
+            jobs.append(parent._children[-1])
+        else:
+            parent.addFollowOn(Job())
+            jobs.append(parent._followOns[-1])
+    return jobs[0]
+
+
+shapes = dict(chain=chain, fan=fan, tree=tree)
+
+
+def peakMemory():
+    """
+    The peak resident set size of this process in bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def serialise(root):
+    """
+    Serialises the graph rooted at the given job to a temporary file job store.
+    """
+    tempDir = tempfile.mkdtemp()
+    try:
+        options = Job.Runner.getDefaultOptions(os.path.join(tempDir, 'jobStore'))
+        options.logLevel = 'WARNING'
+        with Toil(options) as toil:
+            root._serialiseFirstJob(toil._jobStore)
+    finally:
+        shutil.rmtree(tempDir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=1000000,
+                        help='The number of jobs in each graph')
+    parser.add_argument('--shapes', nargs='+', choices=sorted(shapes), default=sorted(shapes),
+                        help='The shapes of the graphs to time')
+    parser.add_argument('--serialise', action='store_true',
+                        help='Also serialise the graphs to a temporary file job store')
+    options = parser.parse_args()
+    for shape in options.shapes:
+        startMemory = peakMemory()
+        start = time.time()
+        root = shapes[shape](options.jobs)
+        created = time.time()
+        createdMemory = peakMemory()
+        root.checkJobGraphForDeadlocks()
+        checked = time.time()
+        ordering = root.getTopologicalOrderingOfJobs()
+        ordered = time.time()
+        assert len(ordering) == options.jobs
+        del ordering
+        print('%s: created %i jobs in %.2fs using %i bytes per job, checked in %.2fs, '
+              'ordered in %.2fs' % (shape, options.jobs, created - start,
+                                    (createdMemory - startMemory) / options.jobs,
+                                    checked - created, ordered - checked))
+        if options.serialise:
+            serialise(root)
+            print('%s: serialised in %.2fs, peak memory %i bytes per job' %
+                  (shape, time.time() - ordered, (peakMemory() - startMemory) / options.jobs))
+
+
+if __name__ == '__main__':
+    main()
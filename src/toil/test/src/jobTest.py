@@ -15,9 +15,13 @@ from __future__ import absolute_import
 import unittest
 import os
 import random
+import cPickle
+from io import BytesIO
 
 from toil.lib.bioio import getTempFile
-from toil.job import Job, JobGraphDeadlockException
+from toil.common import Toil
+from toil.job import (Job, JobArray, JobGraphDeadlockException, SharedPickles, compressPickle,
+                      decompressPickle, minCompressedPickleSize)
 from toil.test import ToilTest
 
 
@@ -204,6 +208,189 @@ class JobTest(ToilTest):
                         (fNode, tNode) not in childEdges):
                 checkFollowOnEdgeCycleDetection(fNode, tNode)
 
+    def testDeepJobGraph(self):
+        """
+        Checks that job graphs much deeper than the recursion limit can be validated and ordered
+        """
+        jobs = [Job() for _ in xrange(20000)]
+        for i, job in enumerate(jobs[1:]):
+            if i % 2:
+                jobs[i].addChild(job)
+            else:
+                jobs[i].addFollowOn(job)
+        jobs[0].checkJobGraphForDeadlocks()
+        self.assertEquals(jobs[0].getRootJobs(), {jobs[0]})
+        self.assertEquals(jobs[0].getTopologicalOrderingOfJobs(), jobs)
+        # Close the chain to form a cycle
+        jobs[-1].addChild(jobs[0])
+        self.assertRaises(JobGraphDeadlockException, jobs[-1].checkJobGraphAcylic)
+
+    def testIncrementalDeadlockDetection(self):
+        """
+        Randomly grows job graphs one edge at a time and checks that the incrementally
+        maintained checks agree with a full traversal of the graph after every edge
+        """
+        def check(f, *args):
+            try:
+                f(*args)
+            except JobGraphDeadlockException:
+                return False
+            return True
+
+        for test in xrange(100):
+            jobs = [Job(checkpoint=random.random() < 0.2) for _ in xrange(random.choice(xrange(2, 20)))]
+            for job in jobs:
+                if random.random() < 0.5:
+                    job.addService(TrivialService())
+            for edge in xrange(random.choice(xrange(1, 30))):
+                fJob, tJob = random.choice(jobs), random.choice(jobs)
+                if tJob in fJob._children or tJob in fJob._followOns:
+                    continue
+                if random.random() < 0.5:
+                    fJob.addChild(tJob)
+                else:
+                    fJob.addFollowOn(tJob)
+                job = random.choice(jobs)
+                connectedJobs = job._getConnectedJobs()
+                roots = {j for j in connectedJobs if not j._directPredecessors}
+                self.assertEquals(check(job.checkJobGraphConnected),
+                                  check(Job._checkRootJobs, connectedJobs))
+                self.assertEquals(check(job.checkJobGraphAcylic),
+                                  len(roots) > 0 and
+                                  check(Job._getAugmentedOrdering, connectedJobs))
+                self.assertEquals(check(job.checkNewCheckpointsAreLeafVertices),
+                                  check(Job._checkNewCheckpointsAreLeafVertices,
+                                        connectedJobs, roots))
+
+    def testJobArray(self):
+        """
+        Runs a nested job array and checks the return values of its calls
+        """
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        root = Job.wrapJobFn(jobArrayTest, range(10))
+        self.assertEquals(Job.Runner.startToil(root, options), [(i * i, 7) for i in xrange(10)])
+
+    def testSharedPickles(self):
+        """
+        Checks that a large argument passed to several jobs is only pickled and stored once
+        """
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        with Toil(options) as toil:
+            jobStore = toil._jobStore
+            sharedPickles = SharedPickles(jobStore)
+            arg = range(100000)
+            jobs = [Job.wrapFn(fn2Test, arg, "s", None) for _ in xrange(3)]
+            pickledJobs = [job._pickleJob(sharedPickles) for job in jobs]
+            for pickledJob in pickledJobs:
+                self.assertTrue(len(pickledJob) < SharedPickles.minSize)
+            self.assertEquals(len(set(persistentID for _, persistentID
+                                      in sharedPickles.objects.itervalues())), 1)
+            # Unpickle twice, the second time from the copy on this node
+            for _ in xrange(2):
+                job = Job._unpickle(None, BytesIO(pickledJobs[0]), jobStore)
+                self.assertEquals(job._args, (arg, "s", None))
+
+    def testSharedPicklesIdentity(self):
+        """
+        Checks that equal but distinct large arguments are stored once but remain distinct
+        objects, and that a single object referenced twice remains a single object
+        """
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        with Toil(options) as toil:
+            jobStore = toil._jobStore
+            sharedPickles = SharedPickles(jobStore)
+            arg = range(100000)
+            job = Job.wrapFn(fn2Test, arg, range(100000), arg)
+            pickledJob = job._pickleJob(sharedPickles)
+            self.assertEquals(len(sharedPickles._stored), 1)
+            args = Job._unpickle(None, BytesIO(decompressPickle(pickledJob)), jobStore)._args
+            self.assertEquals(args[0], args[1])
+            self.assertIsNot(args[0], args[1])
+            self.assertIs(args[0], args[2])
+
+    def testSharedPicklesEviction(self):
+        """
+        Checks that the least recently used local copies of shared objects are evicted
+        """
+        localDir = self._createTempDir()
+        for i in xrange(3):
+            localPath = os.path.join(localDir, str(i))
+            with open(localPath, 'w') as f:
+                f.write('a' * 10)
+            os.utime(localPath, (i, i))
+        SharedPickles._evict(localDir, 25)
+        self.assertEquals(sorted(os.listdir(localDir)), ['.lock', '1', '2'])
+
+    def testSharedPicklesInSeparateWorkflows(self):
+        """
+        Runs two workflows in one process that both pass the same large argument to their jobs,
+        and checks that their work directories are removed
+        """
+        for _ in xrange(2):
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.workDir = self._createTempDir()
+            options.cleanWorkDir = 'onSuccess'
+            root = Job.wrapJobFn(sharedArgTest, range(100000))
+            self.assertEquals(Job.Runner.startToil(root, options), 200000)
+            self.assertEquals(os.listdir(options.workDir), [])
+
+    def testAddChildrenFrom(self):
+        """
+        Checks that the children produced by iterables are run, whether they are added by a
+        running job or by a job that hasn't been run yet
+        """
+        tempDir = self._createTempDir()
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        root = Job.wrapJobFn(childrenFromTest, tempDir, 7)
+        root.addChild(Job()).addChildrenFrom(Job.wrapFn(touchTest, tempDir, 'static%i' % i)
+                                             for i in xrange(2))
+        self.assertEquals(Job.Runner.startToil(root, options), 9)
+
+    def testNestedAddChildrenFrom(self):
+        """
+        Checks that the children produced by iterables are run if they, or their successors, add
+        children from iterables themselves
+        """
+        tempDir = self._createTempDir()
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        root = Job.wrapJobFn(nestedChildrenFromTest, tempDir, 'dynamic', 3)
+        root.addChild(Job()).addChildrenFrom(nestedChildren(tempDir, 'static', 2))
+        self.assertEquals(Job.Runner.startToil(root, options), 4 + 9)
+
+    def testPickleJob(self):
+        """
+        Checks that jobs, whose attributes are stored in slots, can be pickled with the oldest
+        and the newest pickle protocol
+        """
+        for protocol in 0, cPickle.HIGHEST_PROTOCOL:
+            job = Job(memory='1M')
+            child = job.addChildFn(lenTest, 'foo')
+            job.note = 'bar'
+            copy = cPickle.loads(cPickle.dumps(job, protocol))
+            self.assertEquals(copy.memory, job.memory)
+            self.assertEquals(copy.note, 'bar')
+            self.assertIsNone(copy._component)
+            copyChild, = copy._children
+            self.assertEquals(copyChild._args, child._args)
+            self.assertEquals(copyChild._directPredecessors, (copy,))
+
+    def testPickleCompression(self):
+        """
+        Checks that large pickles are compressed and that plain pickles can still be read
+        """
+        small = cPickle.dumps(range(10), cPickle.HIGHEST_PROTOCOL)
+        self.assertEquals(compressPickle(small), small)
+        large = cPickle.dumps(range(minCompressedPickleSize), cPickle.HIGHEST_PROTOCOL)
+        compressed = compressPickle(large)
+        self.assertTrue(len(compressed) < len(large))
+        self.assertEquals(decompressPickle(small), small)
+        self.assertEquals(decompressPickle(large), large)
+        self.assertEquals(decompressPickle(compressed), large)
+        # Pickles written with protocol 0 are left alone, too
+        legacy = cPickle.dumps(range(minCompressedPickleSize), 0)
+        self.assertEquals(decompressPickle(legacy), legacy)
+        self.assertRaises(ValueError, decompressPickle, compressed[:3] + 'x' + compressed[4:])
+
     def testEvaluatingRandomDAG(self):
         """
         Randomly generate test input then check that the ordering of the running
@@ -439,6 +626,65 @@ def fn1Test(string, outputFile, promises=[]):
         fH.write(rV)
     return rV
 
+class SmallJobArray(JobArray):
+    maxSuccessors = 3
+
+def jobArrayTest(job, items):
+    """
+    Job function that runs the items through a job array, returns the promised return values of
+    the array.
+    """
+    return job.addChild(SmallJobArray(squareTest, items, 7, jobFn=True, memory='1M')).rv()
+
+def squareTest(job, item, extra):
+    assert job.memory == 1024 * 1024
+    return item * item, extra
+
+def childrenFromTest(job, tempDir, n):
+    """
+    Job function that adds n children touching a file each in batches, returns the number of
+    files in tempDir once they have run
+    """
+    job.childBatchSize = 3
+    job.addChildrenFrom(Job.wrapFn(touchTest, tempDir, str(i)) for i in xrange(n))
+    return job.addFollowOnFn(countFilesTest, tempDir).rv()
+
+def nestedChildren(tempDir, prefix, n):
+    """
+    Yields n jobs whose follow-ons each add n children from an iterable of jobs touching a file
+    """
+    def touchJobs(name):
+        return (Job.wrapFn(touchTest, tempDir, '%s.%i' % (name, j)) for j in xrange(n))
+    for i in xrange(n):
+        parent = Job()
+        parent.addFollowOn(Job()).addChildrenFrom(touchJobs('%s%i' % (prefix, i)))
+        yield parent
+
+def nestedChildrenFromTest(job, tempDir, prefix, n):
+    """
+    Job function that adds the jobs yielded by nestedChildren() in batches, returns the number of
+    files in tempDir once they have run
+    """
+    job.childBatchSize = 2
+    job.addChildrenFrom(nestedChildren(tempDir, prefix, n))
+    return job.addFollowOnFn(countFilesTest, tempDir).rv()
+
+def countFilesTest(tempDir):
+    return len(os.listdir(tempDir))
+
+def touchTest(tempDir, name):
+    open(os.path.join(tempDir, name), 'w').close()
+
+def sharedArgTest(job, arg):
+    lengths = [job.addChildFn(lenTest, arg).rv() for _ in xrange(2)]
+    return job.addFollowOnFn(sumTest, *lengths).rv()
+
+def lenTest(arg):
+    return len(arg)
+
+def sumTest(*values):
+    return sum(values)
+
 def fn2Test(pStrings, s, outputFile):
     """
     Function concatenates the strings in pStrings and s, in that order, and writes
@@ -448,5 +694,13 @@ def fn2Test(pStrings, s, outputFile):
         fH.write(" ".join(pStrings) + " " + s)
     return s
 
+
+class TrivialService(Job.Service):
+    def start(self, fileStore):
+        pass
+
+    def stop(self, fileStore):
+        pass
+
 if __name__ == '__main__':
     unittest.main()
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 from __future__ import absolute_import
+import cPickle
+import marshal
 import os
 from argparse import ArgumentParser
 from toil.common import Toil
@@ -77,3 +79,58 @@ class JobWrapperTest(ToilTest):
         self.assertNotEquals(j, j2)
         
         ###TODO test other functionality
+
+    def testCopy(self):
+        """
+        Tests that a copy of a job wrapper shares the segments of its stack but can be modified
+        independently of the original.
+        """
+        children = [("child%i" % i, 1, 1, 1, False, None) for i in xrange(1000)]
+        followOns = [("followOn", 1, 1, 1, False, None)]
+        j = JobWrapper("command", 1, 1, 1, False, "jobStoreID", 1, 0,
+                       stack=[followOns, children], services=[[("service", 1, 1, 1, "a", "b", "c")]])
+        j2 = j.copy()
+        self.assertEquals(j, j2)
+        self.assertTrue(j2.stack[-1] is children)
+        # Pop and extend the stack and modify the remaining containers of the copy, as the
+        # worker does when chaining jobs
+        j2.stack.pop()
+        j2.stack += [[("successor", 1, 1, 1, False, None)]]
+        j2.services[0].append(("service2", 1, 1, 1, "d", "e", "f"))
+        j2.filesToDelete.append("file")
+        j2.predecessorsFinished.add("predecessor")
+        self.assertEquals(j.stack, [followOns, children])
+        self.assertEquals(len(children), 1000)
+        self.assertEquals(j.services, [[("service", 1, 1, 1, "a", "b", "c")]])
+        self.assertEquals(j.filesToDelete, [])
+        self.assertEquals(j.predecessorsFinished, set())
+
+    def testEncoding(self):
+        """
+        Tests the binary encoding of job wrappers and the decoding of job wrappers that were
+        serialised by older versions of Toil.
+        """
+        children = [("child%i" % i, 2.0 ** 31, 1.0, 1.5, False, None if i % 2 else str(i))
+                    for i in xrange(1000)]
+        j = JobWrapper(u"command \u00e9", 1, 2.5, 2L ** 64, True, "jobStoreID", 1, 2,
+                       filesToDelete=["file"], predecessorsFinished={"a", "b"},
+                       stack=[children[:1], children],
+                       services=[[("service", 1, 1, 1, "a", "b", "c")]],
+                       checkpoint="checkpoint", checkpointFilesToDelete=[])
+        for job in (j, JobWrapper("command", 1, 1, 1, False, "jobStoreID", 1, 0)):
+            data = job.encode()
+            self.assertTrue(JobWrapper.isEncoded(data))
+            job2 = JobWrapper.decode(data)
+            self.assertEquals(job2.toDict(), job.toDict())
+            for name, value in job.toDict().iteritems():
+                self.assertEquals(type(getattr(job2, name)), type(value))
+        # Large records are compressed
+        self.assertTrue(len(j.encode()) < len(marshal.dumps(j.toDict())) / 2)
+        # Pickling still works
+        self.assertEquals(cPickle.loads(cPickle.dumps(j)).toDict(), j.toDict())
+        # Older versions of Toil pickled the instance dictionary of job wrappers
+        legacy = ("ccopy_reg\n_reconstructor\n(ctoil.jobWrapper\nJobWrapper\nc__builtin__\n"
+                  "object\nNtR(dS'command'\nS'command'\nsS'jobStoreID'\nS'jobStoreID'\nsb.")
+        self.assertFalse(JobWrapper.isEncoded(legacy))
+        job = cPickle.loads(legacy)
+        self.assertEquals((job.command, job.jobStoreID), ('command', 'jobStoreID'))
@@ -12,7 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import absolute_import
-from toil.job import Job
+from toil.common import Config, Toil
+from toil.job import Job, Promise
 from toil.test import ToilTest
 
 class CachedUnpicklingJobStoreTest(ToilTest):
@@ -30,6 +31,58 @@ class CachedUnpicklingJobStoreTest(ToilTest):
             value = Job.Runner.startToil(root, options)
 
 
+class PromiseFilesTest(ToilTest):
+    def test(self):
+        """
+        Tests that the promises made by one job to another are resolved from a single file
+        """
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.logLevel = "INFO"
+        root = Job.wrapJobFn(bundlingParent)
+        self.assertEqual(Job.Runner.startToil(root, options), sum(range(10)) * 2)
+
+    def testLegacyPromises(self):
+        """
+        Tests that jobs pickled before promises were bundled write their promised values to files
+        holding a single value each, which is what the promises pickled with them expect
+        """
+        config = Config()
+        config.jobStore = self._getTestJobStorePath()
+        jobStore = Toil.loadOrCreateJobStore(config.jobStore, config=config)
+        try:
+            fileIDs = [jobStore.getEmptyFileStoreID() for _ in range(3)]
+            job = Job()
+            state = {name: getattr(job, name) for name in Job.__slots__
+                     if name not in ('__dict__', '_promiseFiles')}
+            state['_rvs'] = {None: fileIDs[:1], 1: fileIDs[1:]}
+            legacyJob = Job.__new__(Job)
+            legacyJob.__setstate__(state)
+            self.assertFalse(hasattr(legacyJob, '_rvs'))
+            legacyJob._setReturnValuesForPromises(('a', 'b'), jobStore)
+            self.assertEqual(Promise._resolve(config.jobStore, fileIDs[0]), ('a', 'b'))
+            for fileID in fileIDs[1:]:
+                self.assertEqual(Promise._resolve(config.jobStore, fileID), 'b')
+        finally:
+            Promise.filesToDelete.clear()
+            Promise.clearCache()
+            jobStore.deleteJobStore()
+
+
+def bundlingParent(job):
+    child = job.addChildFn(tupleChild)
+    return child.addChildFn(bundlingConsumer, child.rv(), *[child.rv(i) for i in range(10)]).rv()
+
+
+def tupleChild():
+    return tuple(range(10))
+
+
+def bundlingConsumer(values, *items):
+    assert len(Promise.filesToDelete) == 1
+    assert values == items
+    return sum(values) + sum(items)
+
+
 def parent(job):
     return job.addChildFn(child).rv()
 
@@ -15,6 +15,7 @@
 from __future__ import absolute_import
 
 import os
+import socket
 import sys
 from subprocess import CalledProcessError, check_call
 
@@ -182,6 +183,41 @@ class UtilsTest(ToilTest):
         stats = getStats(options)
         collatedStats =  processData(jobStore.config, stats, options)
         self.assertTrue(len(collatedStats.job_types)==2,"Some jobs are not represented in the stats")
+        # Every job reports its own resource usage
+        jobs = [job for worker in stats.jobs for job in worker]
+        self.assertEquals(len(jobs), 2)
+        for job in jobs:
+            self.assertTrue(int(job.memory) > 0)
+            for key in ('readBytes', 'writeBytes', 'disk'):
+                self.assertTrue(int(job[key]) >= 0)
+
+    def testCacheStats(self):
+        """
+        Tests that the reads served from the cache are counted in the stats, in total and for the
+        node the jobs ran on
+        """
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.clean = 'never'
+        options.stats = True
+        Job.Runner.startToil(Job.wrapJobFn(writeCachedFile), options)
+
+        jobStore = Toil.loadOrCreateJobStore(options.jobStore)
+        collatedStats = processData(jobStore.config, getStats(options), options)
+        for cache in (collatedStats.cache, collatedStats.cache_nodes[socket.gethostname()]):
+            self.assertEquals((cache.hits, cache.misses), (2, 0))
+            self.assertEquals(cache.bytesFromCache, 2000)
+            self.assertEquals(cache.hit_ratio, 1.0)
+
+def writeCachedFile(job):
+    # Files written from the local temp dir are added to the cache
+    localFilePath = job.fileStore.getLocalTempFile()
+    with open(localFilePath, 'w') as f:
+        f.write('x' * 1000)
+    job.addChildJobFn(readCachedFile, job.fileStore.writeGlobalFile(localFilePath))
+
+def readCachedFile(job, fileStoreID):
+    for _ in xrange(2):
+        job.fileStore.readGlobalFile(fileStoreID)
 
 def printUnicodeCharacter():
     # We want to get a unicode character to stdout but we can't print it directly because of
@@ -0,0 +1,76 @@
+# Copyright (C) 2015 UCSC Computational Genomics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the cache eviction policies on a recorded trace of file reads
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import logging
+
+from bd2k.util.humanize import human2bytes
+
+from toil.cachePolicies import CacheSimulator, evictionPolicies, getEvictionPolicy
+from toil.lib.bioio import getBasicOptionParser
+from toil.lib.bioio import parseBasicOptions
+from toil.version import version
+
+logger = logging.getLogger( __name__ )
+
+
+def readTrace(fileHandle):
+    """
+    Parses a trace of file reads. Each line of a trace holds the ID of the file that was read and
+    its size in bytes, separated by white space. Empty lines and lines starting with # are ignored.
+    Workers record traces in this format with the --cacheTrace option.
+
+    :param fileHandle: the file to read the trace from
+    :return: a generator of (fileID, size) tuples
+    """
+    for line in fileHandle:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            fileID, size = line.rsplit(None, 1)
+            yield fileID, int(size)
+
+
+def main():
+    """Replays a trace of file reads against caches using the different eviction policies and
+    reports their hit ratios.
+    """
+    parser = getBasicOptionParser()
+    parser.add_argument("trace", type=str,
+                        help="A file holding one line for every file read, with the ID of the "
+                             "file and its size in bytes separated by white space, as recorded "
+                             "by the --cacheTrace option of a workflow.")
+    parser.add_argument("--cacheSize", dest="cacheSize", type=str, required=True,
+                        help="The size of the simulated cache. Standard suffixes like K, Ki, M, "
+                             "Mi, G or Gi are supported.")
+    parser.add_argument("--policy", dest="policies", action="append",
+                        choices=sorted(evictionPolicies), default=None,
+                        help="A policy to simulate. May be given multiple times. Default is to "
+                             "simulate all policies.")
+    parser.add_argument("--version", action='version', version=version)
+    options = parseBasicOptions(parser)
+
+    with open(options.trace) as fileHandle:
+        trace = list(readTrace(fileHandle))
+    logger.info("Read a trace of %i file reads", len(trace))
+    capacity = human2bytes(options.cacheSize)
+    print('%-8s %10s %10s %10s %14s' % ('policy', 'hits', 'misses', 'hit ratio', 'byte hit ratio'))
+    for name in options.policies or sorted(evictionPolicies):
+        simulator = CacheSimulator(getEvictionPolicy(name), capacity).replay(trace)
+        print('%-8s %10i %10i %10.3f %14.3f' % (name, simulator.hits, simulator.misses,
+                                                simulator.hitRatio, simulator.byteHitRatio))
@@ -32,7 +32,7 @@ def main():
 
 def loadModules():
     # noinspection PyUnresolvedReferences
-    from toil.utils import toilKill, toilStats, toilStatus, toilClean
+    from toil.utils import toilKill, toilStats, toilStatus, toilClean, toilCacheSim
     return {name[4:].lower(): module for name, module in locals().iteritems()}
 
 
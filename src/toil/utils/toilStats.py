@@ -411,6 +411,12 @@ def reportPrettyData(root, worker, job, job_types, options):
     for t in job_types:
         out_str += " %s\n" % t.name
         out_str += sprintTag(t.name, t, options, columnWidths=columnWidths)
+    cache = root.get("cache")
+    if cache and cache.hits + cache.misses + cache.evictions > 0:
+        out_str += "Cache\n"
+        out_str += sprintCache("Total", cache, options)
+        for node in sorted(root.cache_nodes):
+            out_str += sprintCache(node, root.cache_nodes[node], options)
     return out_str
 
 def computeColumnWidths(job_types, worker, job, options):
@@ -515,6 +521,46 @@ def createSummary(element, containingItems, containingItemName, getFn):
     element["min_number_per_%s" % containingItemName] = min(itemCounts)
     element["max_number_per_%s" % containingItemName] = max(itemCounts)
 
+# The counters kept by the caches of the file stores, see toil.job.Job.FileStore
+cacheCounters = ["hits", "misses", "nodeCacheHits", "harbingerWaits", "harbingerWaitTime",
+                 "bytesDownloaded", "bytesFromCache", "evictions", "bytesEvicted", "lockTime"]
+
+def summariseCache(items):
+    """ Sum up the cache counters of the given jobs.
+    """
+    summary = Expando((counter, 0.0) for counter in cacheCounters)
+    for item in items:
+        cache = item.get("cache")
+        if cache:
+            for counter in cacheCounters:
+                summary[counter] += float(cache.get(counter, 0))
+    reads = summary.hits + summary.misses
+    summary.hit_ratio = summary.hits / reads if reads else 0.0
+    bytesRead = summary.bytesFromCache + summary.bytesDownloaded
+    summary.byte_hit_ratio = summary.bytesFromCache / bytesRead if bytesRead else 0.0
+    return summary
+
+def sprintCache(name, cache, options):
+    """ Generate a pretty-print ready string from the summed up cache counters.
+    """
+    return (" %s\n"
+            "  Hits: %s  Misses: %s  Hit Ratio: %.3f  Node Cache Hits: %s\n"
+            "  From Cache: %s  Downloaded: %s  Byte Hit Ratio: %.3f\n"
+            "  Evictions: %s  Evicted: %s  Harbinger Waits: %s  Waited: %s  Lock Held: %s\n" % (
+        name,
+        reportNumber(cache.hits, options),
+        reportNumber(cache.misses, options),
+        cache.hit_ratio,
+        reportNumber(cache.nodeCacheHits, options),
+        reportMemory(cache.bytesFromCache, options, isBytes=True),
+        reportMemory(cache.bytesDownloaded, options, isBytes=True),
+        cache.byte_hit_ratio,
+        reportNumber(cache.evictions, options),
+        reportMemory(cache.bytesEvicted, options, isBytes=True),
+        reportNumber(cache.harbingerWaits, options),
+        reportTime(cache.harbingerWaitTime, options),
+        reportTime(cache.lockTime, options)))
+
 def getStats(options):
     """ Collect and return the stats and config data.
     """
@@ -577,6 +623,15 @@ def processData(config, stats, options):
     for jobName in jobNames:
         jobTypes = [ job for job in jobs if job.class_name == jobName ]
         buildElement(jobTypesTag, jobTypes, jobName)
+    # Sum up the cache counters, in total and for each node as the caches are shared by the jobs
+    # on a node
+    collatedStatsTag.cache = summariseCache(jobs)
+    nodeJobs = {}
+    for workerStats, workerJobs in zip(stats.get("workers", []), stats.get("jobs", [])):
+        if workerStats and workerStats.get("node"):
+            nodeJobs.setdefault(workerStats.node, []).extend(workerJobs or [])
+    collatedStatsTag.cache_nodes = Expando((node, summariseCache(nodeJobs[node]))
+                                           for node in nodeJobs)
     collatedStatsTag.name = "collatedStatsTag"
     return collatedStatsTag
 
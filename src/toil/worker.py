@@ -15,7 +15,6 @@
 from __future__ import absolute_import
 import os
 import sys
-import copy
 import random
 import json
 
@@ -25,10 +24,10 @@ import time
 import socket
 import logging
 import cPickle
-import shutil
 from threading import Thread
 from bd2k.util.expando import Expando, MagicExpando
 from toil.common import Toil
+from toil.lib.fileCopy import copyFileObj
 import signal
 
 logger = logging.getLogger( __name__ )
@@ -211,6 +210,8 @@ def main():
         # Setup the caching variable now in case of an exception during loading of jobwrapper, etc
         # Flag to identify if the run is cached or not.
         FileStore = Job.FileStore if config.disableSharedCache else Job.CachedFileStore
+        # The size of the worker directory is unknown until the jobWrapper is loaded
+        workerDisk = None
 
         ##########################################
         #Load the jobWrapper
@@ -218,6 +219,8 @@ def main():
         
         jobWrapper = jobStore.load(jobStoreID)
         logger.debug("Parsed jobWrapper")
+        # The jobs chained in this worker don't need more disk than the first one
+        workerDisk = jobWrapper.disk
         
         ##########################################
         #Cleanup from any earlier invocation of the jobWrapper
@@ -266,19 +269,31 @@ def main():
                                  (jobWrapper.stack, jobWrapper.services))
 
                     # Delete everything on the stack, as these represent successors to clean
-                    # up as we restart the queue
-                    def recursiveDelete(jobWrapper2):
-                        # Recursive walk the stack to delete all remaining jobs
-                        for jobs in jobWrapper2.stack + jobWrapper2.services:
-                            for jobTuple in jobs:
-                                if jobStore.exists(jobTuple[0]):
-                                    recursiveDelete(jobStore.load(jobTuple[0]))
-                                else:
-                                    logger.debug("Job %s has already been deleted", jobTuple[0])
-                        if jobWrapper2 != jobWrapper:
-                            logger.debug("Checkpoint is deleting old successor job: %s", jobWrapper2.jobStoreID)
-                            jobStore.delete(jobWrapper2.jobStoreID)
-                    recursiveDelete(jobWrapper)
+                    # up as we restart the queue. Walk the successors breadth first, loading
+                    # each level of the subtree in bulk, then delete the levels deepest first.
+                    # Every job that remains after an interruption is thus still reachable from
+                    # the checkpoint, and the walk is repeated when the checkpoint is restarted
+                    # again.
+                    levels = []
+                    seen = {jobWrapper.jobStoreID}
+                    frontier = [jobWrapper]
+                    while frontier:
+                        levelIDs = []
+                        for jobWrapper2 in frontier:
+                            for jobs in jobWrapper2.stack + jobWrapper2.services:
+                                for jobTuple in jobs:
+                                    if jobTuple[0] not in seen:
+                                        seen.add(jobTuple[0])
+                                        levelIDs.append(jobTuple[0])
+                        frontier = jobStore.loadMany(levelIDs)
+                        if len(frontier) < len(levelIDs):
+                            logger.debug("%d successor jobs have already been deleted",
+                                         len(levelIDs) - len(frontier))
+                        if frontier:
+                            levels.append([jobWrapper2.jobStoreID for jobWrapper2 in frontier])
+                    for level in reversed(levels):
+                        logger.debug("Checkpoint is deleting %d old successor jobs", len(level))
+                        jobStore.deleteMany(level)
 
                     jobWrapper.stack = [ [], [] ] # Initialise the job to mimic the state of a job
                     # that has been previously serialised but which as yet has no successors
@@ -293,7 +308,7 @@ def main():
             else:
                 logger.debug("The checkpoint jobs seems to have completed okay, removing any checkpoint files to delete.")
                 #Delete any remnant files
-                map(jobStore.deleteFile, filter(jobStore.fileExists, jobWrapper.checkpointFilesToDelete))
+                jobStore.deleteFiles(jobWrapper.checkpointFilesToDelete)
 
         ##########################################
         #Setup the stats, if requested
@@ -413,7 +428,7 @@ def main():
             ##########################################
             
             #Clone the jobWrapper and its stack
-            jobWrapper = copy.deepcopy(jobWrapper)
+            jobWrapper = jobWrapper.copy()
             
             #Remove the successor jobWrapper
             jobWrapper.stack.pop()
@@ -446,7 +461,7 @@ def main():
             
             #Clone the jobWrapper and its stack again, so that updates to it do 
             #not interfere with this update
-            jobWrapper = copy.deepcopy(jobWrapper)
+            jobWrapper = jobWrapper.copy()
             
             logger.debug("Starting the next jobWrapper")
         
@@ -458,6 +473,8 @@ def main():
             statsDict.workers.time = str(time.time() - startTime)
             statsDict.workers.clock = str(totalCPUTime - startClock)
             statsDict.workers.memory = str(totalMemoryUsage)
+            # The jobs on a node share its cache, see toil.utils.toilStats
+            statsDict.workers.node = socket.gethostname()
 
         # log the worker log path here so that if the file is truncated the path can still be found
         logger.info("Worker log can be found at %s. Set --cleanWorkDir to retain this log", localWorkerTempDir)
@@ -522,7 +539,7 @@ def main():
             with open(tempWorkerLogPath, "r") as f:
                 if os.path.getsize(tempWorkerLogPath) > logFileByteReportLimit:
                     f.seek(-logFileByteReportLimit, 2)  # seek to last tooBig bytes of file
-                w.write(f.read())
+                copyFileObj(f, w)
         jobStore.update(jobWrapper)
 
     elif debugging:  # write log messages
@@ -538,7 +555,7 @@ def main():
     #Remove the temp dir
     cleanUp = config.cleanWorkDir
     if cleanUp == 'always' or (cleanUp == 'onSuccess' and not workerFailed) or (cleanUp == 'onError' and workerFailed):
-        shutil.rmtree(localWorkerTempDir)
+        FileStore.removeWorkerTempDir(localWorkerTempDir, config.workflowID, workerDisk)
     
     #This must happen after the log file is done with, else there is no place to put the log
     if (not workerFailed) and jobWrapper.command == None and len(jobWrapper.stack) == 0 and len(jobWrapper.services) == 0: